@@ -1,6 +1,7 @@
 import logging
 import os
 import json
+import asyncio
 from dotenv import load_dotenv
 
 from livekit.agents import JobContext, WorkerOptions, cli, tts, stt, llm, vad
@@ -9,15 +10,15 @@ from livekit.plugins import google
 
 # Import Brain and Input Processor
 from brain import AlanBrain
-from input_processor import input_processor, InputSource
-try:
-    import torch
-except ImportError:
-    torch = None
-    logger.warning("Torch not found. VAD fallback capabilities will be limited.")
-
-import numpy as np
-from PIL import Image
+from input_processor import input_processor, InputSource, VISION_FLAG
+from monitoring import LoopLagMonitor
+from audio_input import SpeechRingBuffer, StreamResampler, VoiceActivityDetector, load_vad_session
+from audio_output import AudioOutput
+from vision import VisionFrameService
+from scheduler import InputScheduler
+from pcm_cache import PcmCache
+from speech import pipelined_synthesis, split_sentences, SentenceChunker, TTS_SAMPLE_RATE, TTS_CHANNELS
+from contextlib import aclosing
 
 # ... (rest of imports)
 
@@ -32,15 +33,45 @@ logger = logging.getLogger("alan-agent")
 
 # BRAIN INSTANCE
 brain = AlanBrain()
+# Decoded audio for stock phrases, shared by every session of this worker
+tts_cache = PcmCache.from_env()
 
 def prewarm(proc: JobContext):
     proc.userdata["brain"] = brain
+    # One Silero session per worker, shared by every track (each track keeps its own model state)
+    proc.userdata["vad_session"] = load_vad_session()
+    brain.retention.start()
 
 async def entrypoint(ctx: JobContext):
     logger.info(f"Starting ALAN Agent in room {ctx.room.name}")
     
     # 1. Connect
     await ctx.connect()
+
+    # Catch anything that blocks the loop (audio, VAD and data packets stall with it)
+    lag_monitor = LoopLagMonitor()
+    lag_monitor.start()
+
+    # Make sure queued episodic writes hit disk when the job ends
+    async def flush_memory():
+        try:
+            lag_monitor.stop()
+            logger.info(f"Event loop stalls this session: {lag_monitor.stats()}")
+            logger.info(f"Response cache this session: {brain.response_cache.stats()}")
+            logger.info(f"TTS audio cache: {tts_cache.stats()}")
+            logger.info(f"Agent audio output this session: {audio_out.stats()}")
+            logger.info(f"Vision frames this session: {vision.stats()}")
+            await audio_out.aclose()
+            await scheduler.stop()
+            logger.info(f"Input scheduler this session: {scheduler.stats()}")
+            logger.info(f"LLM backends this session: {brain.backend_stats()['dispatch']}")
+        except Exception as e:
+            # e.g. the job ended before the session objects were created
+            logger.error(f"Session teardown failed: {e}")
+        finally:
+            # Durable write last, whatever happened above
+            await asyncio.to_thread(brain.memory.flush)
+    ctx.add_shutdown_callback(flush_memory)
     
     # 2. Init Agent
     # We use Google's Realtime API (Gemini 2.0)
@@ -71,121 +102,109 @@ async def entrypoint(ctx: JobContext):
     state = {"active": False}
 
     # --- FALLBACK: EdgeTTS (Free) & SpeechRecognition (Free) ---
-    import edge_tts
     import speech_recognition as sr
-    import tempfile
-    import asyncio
-    from livekit.plugins import silero
     
-    # State for interruption
-    state["speech_id"] = 0
+    # Agent voice: one track for the whole session, published once
+    audio_out = AudioOutput(ctx.room, TTS_SAMPLE_RATE, TTS_CHANNELS)
+    # Screen share / camera snapshots for the brain
+    vision = VisionFrameService.from_env()
 
     # TTS Helper (EdgeTTS)
     async def speak_text(text: str):
         """Generates audio using EdgeTTS and plays it via LiveKit."""
-        # Interrupt previous
-        state["speech_id"] += 1
-        current_id = state["speech_id"]
-        
         logger.info(f"Speaking (EdgeTTS): {text}")
+        await speak_stream(split_sentences(text), cache=tts_cache)
+
+    async def speak_stream(chunks, cache=None):
+        """Plays text chunks (list or async iterable) as one continuous utterance."""
+        # Interrupt previous
+        audio_out.interrupt()
+
         try:
-            communicate = edge_tts.Communicate(text, "en-US-ChristopherNeural")
-            with tempfile.NamedTemporaryFile(suffix=".mp3", delete=False) as fp:
-                temp_filename = fp.name
-            await communicate.save(temp_filename)
-            
-            # LiveKit AudioSource expects consistent input. 
-            target_sample_rate = 24000
-            target_channels = 1
-            source = rtc.AudioSource(target_sample_rate, target_channels)
-            track = rtc.LocalAudioTrack.create_audio_track("agent_voice", source)
-            await ctx.room.local_participant.publish_track(track)
-
-            # Offload heavy AV processing to a thread
-            def process_audio_file():
-                import av
-                frames_data = [] 
-                container = av.open(temp_filename)
-                stream = container.streams.audio[0]
-                
-                resampler = av.AudioResampler(
-                    format='s16',
-                    layout='mono',
-                    rate=target_sample_rate
-                )
-
-                for frame in container.decode(stream):
-                    resampled_frames = resampler.resample(frame)
-                    for rf in resampled_frames:
-                        frames_data.append((
-                            rf.to_ndarray().tobytes(),
-                            target_sample_rate,
-                            target_channels,
-                            rf.samples
-                        ))
-                return frames_data
-
-            loop = asyncio.get_event_loop()
-            frames = await loop.run_in_executor(None, process_audio_file)
-            
-            for (data, rate, channels, samples) in frames:
-                # CHECK INTERRUPTION
-                if state["speech_id"] != current_id:
+            # Sentence N plays while sentence N+1 is synthesizing
+            async with aclosing(pipelined_synthesis(chunks, cache=cache)) as pcm_stream:
+                if not await audio_out.play(pcm_stream):
                     logger.info("TTS Interrupted.")
-                    break
-                    
-                lk_frame = rtc.AudioFrame(
-                    data=data,
-                    sample_rate=rate,
-                    num_channels=channels,
-                    samples_per_channel=samples
-                )
-                await source.capture_frame(lk_frame)
-            
-            os.remove(temp_filename)
         except Exception as e:
             logger.error(f"EdgeTTS Failed: {e}")
 
-    def convert_frame_to_image(frame) -> Image.Image:
-        """Converts a LiveKit VideoFrame to a PIL Image."""
-        try:
-            # Convert to RGBA
-            # Note: The availability of 'convert' depends on the LiveKit SDK version.
-            # Assuming recent SDK where convert returns a new buffer/frame with specific format.
-            argb_frame = frame.convert(rtc.VideoBufferType.RGBA)
-            
-            # Create PIL Image
-            img = Image.frombytes("RGBA", (argb_frame.width, argb_frame.height), argb_frame.data)
-            return img.convert("RGB")
-        except Exception as e:
-            logger.error(f"Frame conversion failed: {e}")
-            return None
-
     # Helper to process text
-    async def process_text_input(text: str, source: str = "text"):
+    def submit_input(text: str, source: str = "text"):
+        """Normalizes the input and queues it; the scheduler runs turns one at a time by priority."""
+        # Create Unified Event (classifies intent, vision flag and priority)
+        input_type = InputSource.TEXT if source == "text" else InputSource.VOICE
+        event = input_processor.process(input_type, text)
+        scheduler.submit(event)
+
+    async def process_text_input(event):
+        text = event.normalized
         # Stop any current speech immediately when thinking starts
-        state["speech_id"] += 1 
-        
+        audio_out.interrupt()
+
         # VISION CHECK
         images_to_send = []
-        # If user implies seeing something, and we have a frame
-        if "see" in text.lower() or "look" in text.lower() or "screen" in text.lower():
-            if state.get("latest_frame"):
-                logger.info("Processing visual context for Brain...")
-                pil_img = convert_frame_to_image(state["latest_frame"])
-                if pil_img:
-                    images_to_send = [pil_img]
+        # If user refers to what's on screen, and we have a frame
+        if VISION_FLAG in event.flags:
+            snapshot = vision.take()
+            uploaded = vision.prior_upload(snapshot) if snapshot else None
+            if uploaded is not None:
+                # Same screen as the last image the brain saw: attach the uploaded copy, no bytes
+                logger.info("Screen unchanged since the last image sent; attaching its uploaded copy")
+                images_to_send = [uploaded]
+            elif snapshot:
+                logger.info(f"Sending {snapshot.width}x{snapshot.height} frame ({len(snapshot.jpeg)} B, "
+                            f"{snapshot.age:.1f}s old) to Brain")
+                # Uploaded once: this turn and later unchanged-screen turns attach the handle
+                handle = await brain.upload_image(snapshot.jpeg)
+                # Upload failed: send the bytes inline so this turn still sees the screen
+                images_to_send = [handle if handle is not None else snapshot.jpeg]
+                vision.mark_sent(snapshot, handle)
         
-        # Create Unified Event
-        input_type = InputSource.TEXT if source == "text" else InputSource.VOICE
-        event = input_processor.process(input_type, text)
-        
-        # Brain thinks about the event
-        response_text = await brain.think(event, ctx, images=images_to_send)
-        
-        reply = {"type": "agent_chat", "text": response_text}
-        await ctx.room.local_participant.publish_data(json.dumps(reply).encode("utf-8"), reliable=True)
-        await speak_text(response_text)
+        # Brain streams its reply: deltas go to the UI, finished sentences go to TTS
+        spoken_chunks = asyncio.Queue()
+
+        async def generate_reply():
+            chunker = SentenceChunker()
+            parts = []
+            try:
+                # aclosing: if we're cancelled mid-publish, the brain's stream (and backend) is closed right away
+                async with aclosing(brain.think_stream(event, ctx, images=images_to_send)) as deltas:
+                    async for delta in deltas:
+                        parts.append(delta)
+                        partial = {"type": "agent_chat_delta", "id": event.id, "text": delta}
+                        await ctx.room.local_participant.publish_data(json.dumps(partial).encode("utf-8"), reliable=True)
+                        for chunk in chunker.feed(delta):
+                            spoken_chunks.put_nowait(chunk)
+                for chunk in chunker.flush():
+                    spoken_chunks.put_nowait(chunk)
+
+                reply = {"type": "agent_chat", "id": event.id, "text": "".join(parts)}
+                await ctx.room.local_participant.publish_data(json.dumps(reply).encode("utf-8"), reliable=True)
+            except asyncio.CancelledError:
+                if parts:
+                    # Close the UI's streamed message with what was said so far (we can't await here:
+                    # the turn's own cleanup cancels this task again)
+                    aborted = {"type": "agent_chat", "id": event.id, "text": "".join(parts), "aborted": True}
+                    asyncio.create_task(ctx.room.local_participant.publish_data(
+                        json.dumps(aborted).encode("utf-8"), reliable=True))
+                raise
+            finally:
+                spoken_chunks.put_nowait(None)
+
+        async def reply_chunks():
+            while (chunk := await spoken_chunks.get()) is not None:
+                yield chunk
+
+        generation = asyncio.create_task(generate_reply())
+        try:
+            await speak_stream(reply_chunks())
+            await generation
+        finally:
+            # Preempted by a newer turn: stop generating too, not just speaking
+            generation.cancel()
+
+    scheduler = InputScheduler(process_text_input)
+    scheduler.start()
 
     # 3. Handle Chat
     @ctx.room.on("data_received")
@@ -196,7 +215,10 @@ async def entrypoint(ctx: JobContext):
             if payload.get('type') == 'user_chat':
                 user_text = payload.get('text')
                 if user_text:
-                    asyncio.create_task(process_text_input(user_text, source="text"))
+                    submit_input(user_text, source="text")
+            elif payload.get('type') == 'get_backend_stats':
+                stats = {"type": "backend_stats", "stats": brain.backend_stats()}
+                asyncio.create_task(ctx.room.local_participant.publish_data(json.dumps(stats).encode("utf-8"), reliable=True))
         except Exception as e:
             logger.error(f"Error handling data: {e}")
 
@@ -207,32 +229,8 @@ async def entrypoint(ctx: JobContext):
         if track.kind == rtc.TrackKind.KIND_VIDEO:
             logger.info(f"Visual Input Detected: {track.name} ({publication.source})")
             
-            async def process_video_track():
-                video_stream = rtc.VideoStream(track)
-                last_process_time = 0
-                process_interval = 2.0 # Analyze every 2 seconds
-                
-                async for event in video_stream:
-                    import time
-                    now = time.time()
-                    if now - last_process_time > process_interval:
-                        last_process_time = now
-                        
-                        # Convert Frame to JPEG Bytes
-                        frame = event.frame
-                        # LiveKit VideoFrame -> RGB -> JPEG
-                        # This requires converting the YUV frame to RGB
-                        # For simplicity in this fallback, we might skip complex conversion 
-                        # OR use a library if available. 
-                        # Ideally, we send the intent "I see <description>" to the brain.
-                        
-                        # Saving frame for potential "Look at this" queries
-                        state["latest_frame"] = frame
-                        
-                        # If user ASKED to look, we can process immediately. 
-                        # Otherwise, we just cache it.
-                        
-            asyncio.create_task(process_video_track())
+            # Samples the newest frame every few seconds into ready-to-send JPEGs for "look at this" queries
+            asyncio.create_task(vision.run(track))
             return
 
         # --- AUDIO (Fallback) ---
@@ -241,68 +239,75 @@ async def entrypoint(ctx: JobContext):
             
             async def transcribe_track():
                 # VAD Setup
-                vad = silero.VAD.load()
-                model = vad
+                vad = VoiceActivityDetector(ctx.proc.userdata.get("vad_session"))
                 
                 audio_stream = rtc.AudioStream(track)
                 recognizer = sr.Recognizer()
                 target_rate = 16000
                 
-                import av
-                import audioop
-                import numpy as np
-                
-                # Audio Accumulation
-                speech_buffer = bytearray()
                 
+                # Audio Accumulation: preallocated ring, utterances handed off in pooled buffers
+                ring = SpeechRingBuffer()
+                stt_lock = asyncio.Lock() # STT runs off the audio loop, but utterances stay in order
+
+                async def recognize(utterance):
+                    try:
+                        async with stt_lock:
+                            audio_data = sr.AudioData(utterance.data, target_rate, 2)
+                            loop = asyncio.get_running_loop()
+                            text = await loop.run_in_executor(None, lambda: recognizer.recognize_google(audio_data))
+
+                        # Publish Live Caption
+                        caption_msg = {"type": "transcription", "text": text, "is_final": True, "participant": "user"}
+                        await ctx.room.local_participant.publish_data(json.dumps(caption_msg).encode("utf-8"), reliable=True)
+
+                        if text:
+                            logger.info(f"STT Heard: {text}")
+                            submit_input(text, source="voice")
+                    except sr.UnknownValueError:
+                        pass # Nothing intelligible
+                    except Exception as e:
+                        logger.warning(f"STT failed: {e}")
+                    finally:
+                        utterance.release()
+
                 # State
+                resampler = None
                 speaking = False
                 silence_frames = 0
+                voiced_samples = 0 # Speech since onset, without pre-roll or trailing silence
                 required_silence_frames = 10 # Optimized: ~0.3s silence
+                min_voiced_samples = 2000 # ~0.125s of actual speech
 
                 async for event in audio_stream:
-                    state["speech_id"] += 0 # Keep checking for interruption externally?
-                    
                     frame = event.frame
                     
-                    # Manual Resampling for STT & VAD (16kHz Mono)
-                    data = frame.data
-                    if frame.sample_rate != target_rate:
-                        data, _ = audioop.ratecv(data, 2, 1, frame.sample_rate, target_rate, None)
-                        if frame.num_channels == 2:
-                            data = audioop.tomono(data, 2, 0.5, 0.5)
-
-                    # 1. Run VAD
-                    # Silero expects float32 array
-                    audio_int16 = np.frombuffer(data, dtype=np.int16)
-                    audio_float32 = audio_int16.astype(np.float32) / 32768.0
-                    
-                    speech_prob = 0
-                    try:
-                        if torch:
-                            speech_prob = model(torch.from_numpy(audio_float32), target_rate).item()
-                        else:
-                            raise ImportError("Torch not available")
-                    except:
-                        # Fallback to RMS
-                        if audioop.rms(data, 2) > 500:
-                            speech_prob = 0.8
-                    
+                    # Resampling for STT & VAD (16kHz Mono), filter state carried across frames
+                    if resampler is None or (resampler.in_rate, resampler.channels) != (frame.sample_rate, frame.num_channels):
+                        resampler = StreamResampler(frame.sample_rate, frame.num_channels, target_rate)
+                    samples = resampler.process(frame.data)
+                    ring.write(samples)
+
+                    # 1. Run VAD (Silero on fixed 512-sample windows, RMS fallback)
+                    speech_prob = vad.process(samples)
                     is_speech = speech_prob > 0.5
 
                     # 2. Logic
                     if is_speech:
                         if not speaking:
                             logger.info("VAD: Speech Started")
-                            # Interrupt Agent
-                            state["speech_id"] += 1
+                            # Interrupt Agent: stop speaking and stop generating a spoken reply
+                            # (text-chat turns keep going; only their audio is cut)
+                            audio_out.interrupt()
+                            scheduler.interrupt(InputSource.VOICE)
+                            ring.begin()
+                            voiced_samples = 0
                         speaking = True
                         silence_frames = 0
-                        speech_buffer.extend(data)
+                        voiced_samples += len(samples)
                     else:
                         if speaking:
-                            silence_frames += 1
-                            speech_buffer.extend(data) # Capture trailing silence
+                            silence_frames += 1 # Trailing silence is already in the ring
                             
                             if silence_frames > required_silence_frames:
                                 # END OF SPEECH DETECTED
@@ -311,35 +316,24 @@ async def entrypoint(ctx: JobContext):
                                 silence_frames = 0
                                 
                                 # Process Buffer
-                                if len(speech_buffer) > 4000: # Min duration ~0.1s
-                                    audio_data = sr.AudioData(bytes(speech_buffer), target_rate, 2)
-                                    speech_buffer = bytearray()
-                                    
-                                    try:
-                                        loop = asyncio.get_event_loop()
-                                        text = await loop.run_in_executor(None, lambda: recognizer.recognize_google(audio_data))
-                                        
-                                        # Publish Live Caption
-                                        caption_msg = {"type": "transcription", "text": text, "is_final": True, "participant": "user"}
-                                        await ctx.room.local_participant.publish_data(json.dumps(caption_msg).encode("utf-8"), reliable=True)
-
-                                        if text:
-                                            logger.info(f"STT Heard: {text}")
-                                            await process_text_input(text, source="voice")
-                                    except:
-                                        pass
+                                utterance = ring.end()
+                                if voiced_samples >= min_voiced_samples:
+                                    asyncio.create_task(recognize(utterance))
                                 else:
                                     # Too short, discard
-                                    speech_buffer = bytearray()
+                                    utterance.release()
                         else:
                             # Just noise/silence
                             pass
 
+                logger.info(f"VAD stats for {track.sid}: {vad.stats()}, buffers: {ring.stats()}")
+
             asyncio.create_task(transcribe_track())
 
     # 5. Start Agent
     participant = await ctx.wait_for_participant()
     logger.info(f"Starting agent for participant: {participant.identity}")
+    await audio_out.start()
     
     greeting = {"type": "agent_chat", "text": "Hello sir, I am Friday, your personal assistant."}
     await ctx.room.local_participant.publish_data(json.dumps(greeting).encode("utf-8"), reliable=True)
@@ -0,0 +1,268 @@
+import logging
+import time
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+logger = logging.getLogger("alan.audio_input")
+
+VAD_SAMPLE_RATE = 16000
+VAD_WINDOW = 512           # Samples per Silero window at 16 kHz (32 ms)
+RMS_SPEECH_LEVEL = 500     # int16 RMS treated as speech when the model is unavailable
+_INT16_SCALE = np.float32(1 / 32768)
+
+
+def load_vad_session():
+    """
+    The Silero ONNX session, loaded once per worker process (see agent.prewarm) and shared
+    by every track's VoiceActivityDetector. None if the plugin / onnxruntime is missing.
+    """
+    try:
+        from livekit.plugins.silero import onnx_model
+        return onnx_model.new_inference_session(force_cpu=True)
+    except Exception as e:
+        logger.warning(f"Silero VAD unavailable, using RMS energy fallback: {e}")
+        return None
+
+
+class VoiceActivityDetector:
+    """
+    Per-track speech detector over 16 kHz mono int16 audio.
+    LiveKit frames (10 ms) are collected in a fixed window buffer and the model runs once
+    per full 512-sample window with its own recurrent state; between windows the last
+    probability is reported. Falls back to RMS energy when the model is missing or fails.
+    """
+    def __init__(self, session=None):
+        self.model = None
+        if session is not None:
+            from livekit.plugins.silero import onnx_model
+            self.model = onnx_model.OnnxModel(onnx_session=session, sample_rate=VAD_SAMPLE_RATE)
+        self.window_size = self.model.window_size_samples if self.model else VAD_WINDOW
+        self._window = np.zeros(self.window_size, dtype=np.float32)
+        self._fill = 0
+        self.probability = 0.0
+        # Metrics
+        self.windows = 0
+        self.fallback_windows = 0
+        self.inference_time = 0.0
+        self._errors_logged = 0
+
+    def process(self, samples: np.ndarray) -> float:
+        """Feeds int16 samples; returns the speech probability of the latest full window."""
+        offset = 0
+        while offset < len(samples):
+            n = min(self.window_size - self._fill, len(samples) - offset)
+            # int16 -> float32 straight into the window: cast-copy then scale in place (no temporaries)
+            target = self._window[self._fill:self._fill + n]
+            target[...] = samples[offset:offset + n]
+            target *= _INT16_SCALE
+            self._fill += n
+            offset += n
+            if self._fill == self.window_size:
+                self.probability = self._run_window()
+                self._fill = 0
+        return self.probability
+
+    def _run_window(self) -> float:
+        self.windows += 1
+        if self.model is not None:
+            start = time.process_time()
+            try:
+                return self.model(self._window)
+            except Exception as e:
+                if self._errors_logged < 3:
+                    self._errors_logged += 1
+                    logger.error(f"Silero VAD inference failed, using RMS for this window: {e}")
+            finally:
+                self.inference_time += time.process_time() - start
+        self.fallback_windows += 1
+        rms = float(np.sqrt(np.dot(self._window, self._window) / self.window_size)) * 32768
+        return 0.8 if rms > RMS_SPEECH_LEVEL else 0.0
+
+    def stats(self) -> dict:
+        audio_seconds = self.windows * self.window_size / VAD_SAMPLE_RATE
+        return {
+            "windows": self.windows,
+            "fallback_windows": self.fallback_windows,
+            "fallback_rate": round(self.fallback_windows / self.windows, 3) if self.windows else 0.0,
+            "cpu_ms_per_audio_s": round(self.inference_time * 1000 / audio_seconds, 2) if audio_seconds else 0.0,
+        }
+
+
+class Utterance:
+    """A finished utterance in a pooled buffer. `data` is a zero-copy view; call release() when done."""
+    def __init__(self, ring, buffer: np.ndarray, samples: int):
+        self._ring = ring
+        self._buffer = buffer
+        self.samples = samples
+        self.data = memoryview(buffer[:samples]).cast("B")
+
+    @property
+    def duration(self) -> float:
+        return self.samples / VAD_SAMPLE_RATE
+
+    def release(self):
+        if self._buffer is not None:
+            self.data.release()
+            self._ring._recycle(self._buffer)
+            self._buffer = None
+
+
+class SpeechRingBuffer:
+    """
+    Preallocated ring of 16 kHz mono int16 audio for the speech accumulation path.
+    Every frame is written into the ring (no per-frame allocation); begin() marks an
+    utterance start (with a little pre-roll, since VAD fires late), end() copies the
+    utterance once into a buffer from a small pool and hands it off as an Utterance.
+    """
+    def __init__(self, seconds: float = 30.0, preroll: float = 0.3, pool_size: int = 2):
+        self.capacity = int(seconds * VAD_SAMPLE_RATE)
+        self.preroll = int(preroll * VAD_SAMPLE_RATE)
+        self._ring = np.zeros(self.capacity, dtype=np.int16)
+        self._written = 0      # Total samples ever written; ring position is _written % capacity
+        self._start = None     # Utterance start, in _written coordinates
+        self._pool = [np.empty(self.capacity, dtype=np.int16) for _ in range(pool_size)]
+        # Metrics
+        self.utterances = 0
+        self.truncated = 0
+        self.pool_misses = 0
+
+    @property
+    def active(self) -> bool:
+        return self._start is not None
+
+    def write(self, samples: np.ndarray):
+        n = len(samples)
+        if n > self.capacity:
+            samples, n = samples[-self.capacity:], self.capacity
+        pos = self._written % self.capacity
+        first = min(n, self.capacity - pos)
+        self._ring[pos:pos + first] = samples[:first]
+        if first < n:
+            self._ring[:n - first] = samples[first:]
+        self._written += n
+
+    def begin(self):
+        self._start = max(0, self._written - self.preroll)
+
+    def cancel(self):
+        self._start = None
+
+    def end(self):
+        """Closes the current utterance; returns an Utterance (or None if none was open)."""
+        if self._start is None:
+            return None
+        length = self._written - self._start
+        if length > self.capacity:
+            # Older audio was overwritten; keep the most recent `capacity` samples
+            self.truncated += 1
+            length = self.capacity
+        self._start = None
+
+        buffer = self._pool.pop() if self._pool else None
+        if buffer is None:
+            self.pool_misses += 1
+            buffer = np.empty(self.capacity, dtype=np.int16)
+        start = (self._written - length) % self.capacity
+        first = min(length, self.capacity - start)
+        buffer[:first] = self._ring[start:start + first]
+        if first < length:
+            buffer[first:length] = self._ring[:length - first]
+        self.utterances += 1
+        return Utterance(self, buffer, length)
+
+    def _recycle(self, buffer: np.ndarray):
+        self._pool.append(buffer)
+
+    def stats(self) -> dict:
+        return {"utterances": self.utterances, "truncated": self.truncated, "pool_misses": self.pool_misses}
+
+
+def lowpass_taps(factor: int, taps_per_phase: int = 16, beta: float = 8.0) -> np.ndarray:
+    """Kaiser-windowed sinc anti-aliasing filter for decimation by `factor` (unity DC gain)."""
+    n = factor * taps_per_phase + 1
+    cutoff = 0.9 / factor / 2  # Cycles/sample: 90% of the output Nyquist
+    t = np.arange(n) - (n - 1) / 2
+    taps = 2 * cutoff * np.sinc(2 * cutoff * t) * np.kaiser(n, beta)
+    return (taps / taps.sum()).astype(np.float32)
+
+
+class StreamResampler:
+    """
+    Per-track int16 -> 16 kHz mono int16 converter.
+    Downmixes first (so filtering runs on one channel), then low-pass filters and
+    decimates with a FIR whose history carries across frames, so frame boundaries are
+    seamless. Integer ratios (48k, 32k -> 16k) are vectorized numpy into reusable scratch
+    buffers; other rates go through PyAV's (also stateful) swresample.
+    The returned array is a view into scratch space, valid until the next call.
+    """
+    def __init__(self, in_rate: int, channels: int = 1, out_rate: int = VAD_SAMPLE_RATE):
+        self.in_rate = in_rate
+        self.channels = channels
+        self.out_rate = out_rate
+        self.factor = in_rate // out_rate if in_rate % out_rate == 0 else None
+        self._av = None
+        if self.factor is None:
+            import av
+            self._av = av.AudioResampler(format="s16", layout="mono", rate=out_rate)
+        self._taps = lowpass_taps(self.factor) if self.factor and self.factor > 1 else None
+        self._history = len(self._taps) - 1 if self._taps is not None else 0
+        self._phase = 0
+        self._allocate(480 * max(1, self.factor or 1))
+
+    def _allocate(self, frame_samples: int):
+        self._capacity = frame_samples
+        self._work = np.zeros(self._history + frame_samples, dtype=np.float32)
+        self._mixed = np.zeros(frame_samples, dtype=np.float32)
+        self._out = np.zeros(frame_samples // max(1, self.factor or 1) + 2, dtype=np.float32)
+        self._out16 = np.zeros(len(self._out), dtype=np.int16)
+
+    def process(self, data) -> np.ndarray:
+        """`data` is interleaved int16 PCM (bytes / memoryview / ndarray) at in_rate."""
+        pcm = np.frombuffer(data, dtype=np.int16)
+        if self._av is not None:
+            return self._process_av(pcm)
+        n = len(pcm) // self.channels
+        if self.channels == 1 and self.factor == 1:
+            return pcm
+        if n > self._capacity:
+            self._allocate(n) # Only if LiveKit ever sends a bigger frame than seen so far
+            self._phase = 0
+
+        # 1. Downmix into float32 scratch (right after the filter history)
+        mixed = self._work[self._history:self._history + n] if self._taps is not None else self._mixed[:n]
+        if self.channels == 1:
+            mixed[...] = pcm
+        else:
+            frames = pcm[:n * self.channels].reshape(n, self.channels)
+            mixed[...] = frames[:, 0]
+            for c in range(1, self.channels):
+                mixed += frames[:, c]
+            mixed *= np.float32(1 / self.channels)
+
+        if self._taps is None:
+            out = mixed
+        else:
+            # 2. FIR + decimate: one output per `factor` inputs, continuing from last frame's phase
+            windows = sliding_window_view(self._work[:self._history + n], len(self._taps))[self._phase:n:self.factor]
+            m = len(windows)
+            out = self._out[:m]
+            np.matmul(windows, self._taps, out=out) # Taps are symmetric, so no flip needed
+            self._phase = self._phase + m * self.factor - n
+            # Keep the last `history` input samples for the next frame
+            self._work[:self._history] = self._work[n:n + self._history]
+
+        # 3. Back to int16 in scratch
+        out16 = self._out16[:len(out)]
+        np.rint(out, out=out)
+        np.clip(out, -32768, 32767, out=out)
+        out16[...] = out
+        return out16
+
+    def _process_av(self, pcm: np.ndarray) -> np.ndarray:
+        import av
+        layout = "mono" if self.channels == 1 else "stereo"
+        frame = av.AudioFrame.from_ndarray(pcm.reshape(1, -1), format="s16", layout=layout)
+        frame.sample_rate = self.in_rate
+        chunks = [f.to_ndarray().reshape(-1) for f in self._av.resample(frame)]
+        return np.concatenate(chunks) if chunks else np.zeros(0, dtype=np.int16)
@@ -0,0 +1,117 @@
+import asyncio
+import logging
+import time
+
+from livekit import rtc
+
+logger = logging.getLogger("alan.audio_output")
+
+
+class AudioOutput:
+    """
+    The agent's voice for one session: one AudioSource and one LocalAudioTrack, published once.
+    Utterances are enqueued frame by frame into a bounded playout queue that a single task
+    drains into the source. interrupt() drops everything still queued, both here and in the
+    source's own buffer, so barge-in is immediate without re-publishing anything.
+    """
+    def __init__(self, room, sample_rate: int, channels: int = 1, track_name: str = "agent_voice",
+                 queue_frames: int = 50):
+        self.room = room
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.track_name = track_name
+        self.source = None
+        self.track = None
+        self._queue = asyncio.Queue(maxsize=queue_frames)  # (generation, pcm or end-marker future, samples)
+        self._generation = 0
+        self._publish_lock = asyncio.Lock()
+        self._player = None
+        self.publish_time = 0.0
+        self.counters = {"publishes": 0, "utterances": 0, "interrupted": 0, "frames": 0, "dropped_frames": 0}
+
+    async def start(self):
+        """Publishes the track. Idempotent; play() calls it too."""
+        async with self._publish_lock:
+            if self.track is not None:
+                return
+            start = time.perf_counter()
+            self.source = rtc.AudioSource(self.sample_rate, self.channels)
+            self.track = rtc.LocalAudioTrack.create_audio_track(self.track_name, self.source)
+            await self.room.local_participant.publish_track(self.track)
+            self.publish_time = time.perf_counter() - start
+            self.counters["publishes"] += 1
+            self._player = asyncio.create_task(self._playout())
+            logger.info(f"Published agent audio track in {self.publish_time * 1000:.0f} ms")
+
+    async def play(self, pcm_stream) -> bool:
+        """
+        Enqueues one utterance from an (async) iterable of (pcm_bytes, samples).
+        Returns once all of it has been handed to the source; False if it was interrupted.
+        """
+        await self.start()
+        generation = self._generation
+        self.counters["utterances"] += 1
+        try:
+            async for data, samples in pcm_stream:
+                if generation != self._generation:
+                    return False
+                await self._queue.put((generation, data, samples))
+            if generation != self._generation:
+                return False
+            done = asyncio.get_running_loop().create_future()
+            await self._queue.put((generation, done, 0))
+            await done
+            return generation == self._generation
+        except asyncio.CancelledError:
+            # Abandoned mid-utterance (e.g. the turn was preempted): don't leave it playing
+            if generation == self._generation:
+                self.interrupt()
+            raise
+
+    def interrupt(self):
+        """Drops queued audio and bumps the generation so in-progress play() calls stop."""
+        self._generation += 1
+        dropped = 0
+        while not self._queue.empty():
+            _, data, _ = self._queue.get_nowait()
+            if isinstance(data, asyncio.Future):
+                if not data.done():
+                    data.set_result(None)
+            else:
+                dropped += 1
+        buffered = self.source is not None and self.source.queued_duration > 0
+        if self.source is not None:
+            self.source.clear_queue()
+        if dropped or buffered:
+            self.counters["interrupted"] += 1
+            self.counters["dropped_frames"] += dropped
+
+    def stats(self) -> dict:
+        return {**self.counters, "publish_ms": round(self.publish_time * 1000, 1), "queued_frames": self._queue.qsize()}
+
+    async def aclose(self):
+        if self._player:
+            self._player.cancel()
+            await asyncio.gather(self._player, return_exceptions=True)
+        if self.source is not None:
+            await self.source.aclose()
+
+    async def _playout(self):
+        while True:
+            generation, data, samples = await self._queue.get()
+            if isinstance(data, asyncio.Future):
+                if not data.done():
+                    data.set_result(None)
+                continue
+            if generation != self._generation:
+                self.counters["dropped_frames"] += 1
+                continue
+            frame = rtc.AudioFrame(data=data, sample_rate=self.sample_rate, num_channels=self.channels,
+                                   samples_per_channel=samples)
+            try:
+                await self.source.capture_frame(frame)
+                self.counters["frames"] += 1
+                if generation != self._generation:
+                    self.source.clear_queue()  # Interrupted while this frame was in flight
+            except Exception as e:
+                logger.error(f"Audio capture failed: {e}")
@@ -0,0 +1,472 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+from context_builder import approx_tokens
+
+logger = logging.getLogger("alan.backends")
+
+GEMINI_MODEL = "gemini-2.0-flash-exp"
+OPENROUTER_MODEL = "meta-llama/llama-3.2-3b-instruct:free"
+OPENROUTER_BASE_URL = "https://openrouter.ai/api/v1"
+
+
+class HttpTimings:
+    """
+    Connection and time-to-first-byte stats for one backend's HTTP pool,
+    collected through httpx event hooks and httpcore trace events.
+    """
+    def __init__(self):
+        self.requests = 0
+        self.new_connections = 0
+        self.connect_ms = []
+        self.tls_ms = []
+        self.ttfb_ms = []
+        self._lock = threading.Lock()
+
+    def event_hooks(self) -> dict:
+        """Hooks for an httpx.AsyncClient (async clients need async hooks and traces)."""
+        async def on_request(request):
+            trace = self._tracer()
+            async def atrace(event_name: str, info: dict):
+                trace(event_name, info)
+            request.extensions["trace"] = atrace
+        return {"request": [on_request]}
+
+    def _tracer(self):
+        start = time.perf_counter()
+        marks = {}
+
+        def trace(event_name: str, info: dict):
+            now = time.perf_counter()
+            if event_name.endswith(".started"):
+                marks[event_name[:-len(".started")]] = now
+            elif event_name == "connection.connect_tcp.complete":
+                self._record(self.connect_ms, now - marks.get("connection.connect_tcp", now), new_connection=True)
+            elif event_name == "connection.start_tls.complete":
+                self._record(self.tls_ms, now - marks.get("connection.start_tls", now))
+            elif event_name.endswith("receive_response_headers.complete"):
+                self._record(self.ttfb_ms, now - start)
+
+        with self._lock:
+            self.requests += 1
+        return trace
+
+    def _record(self, samples: list, seconds: float, new_connection: bool = False):
+        with self._lock:
+            samples.append(seconds * 1000)
+            del samples[:-200] # Rolling window
+            if new_connection:
+                self.new_connections += 1
+
+    def stats(self) -> dict:
+        avg = lambda xs: round(sum(xs) / len(xs), 1) if xs else None
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "new_connections": self.new_connections,
+                "reused_connections": max(0, self.requests - self.new_connections),
+                "avg_connect_ms": avg(self.connect_ms),
+                "avg_tls_ms": avg(self.tls_ms),
+                "avg_ttfb_ms": avg(self.ttfb_ms),
+                "last_ttfb_ms": round(self.ttfb_ms[-1], 1) if self.ttfb_ms else None,
+            }
+
+
+class BackendRegistry:
+    """
+    Builds each cloud LLM client lazily, once per process, and keeps its HTTP
+    keep-alive pool open between turns instead of paying a new TLS handshake per request.
+    Clients are the native async ones (genai `client.aio`, AsyncOpenAI), so calls never
+    block the event loop.
+    """
+    def __init__(self, keepalive_expiry: float = 120.0, openrouter_base_url: str = None, openrouter_key: str = None,
+                 gemini_base_url: str = None, gemini_key: str = None):
+        self.keepalive_expiry = keepalive_expiry
+        self.gemini_base_url = gemini_base_url or os.getenv("GEMINI_BASE_URL")
+        self.gemini_key = gemini_key
+        self.openrouter_base_url = openrouter_base_url or os.getenv("OPENROUTER_BASE_URL", OPENROUTER_BASE_URL)
+        self.openrouter_key = openrouter_key
+        self.timings = {"gemini": HttpTimings(), "openrouter": HttpTimings()}
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def gemini(self):
+        return self._get("gemini", self._build_gemini)
+
+    def openrouter(self):
+        return self._get("openrouter", self._build_openrouter)
+
+    def stats(self) -> dict:
+        return {name: timings.stats() for name, timings in self.timings.items()}
+
+    def _get(self, name: str, build):
+        client = self._clients.get(name)
+        if client is None:
+            with self._lock:
+                client = self._clients.get(name)
+                if client is None:
+                    client = build()
+                    self._clients[name] = client
+        return client
+
+    def _limits(self):
+        import httpx
+        return httpx.Limits(max_keepalive_connections=10, keepalive_expiry=self.keepalive_expiry)
+
+    def _build_gemini(self):
+        from google import genai
+        from google.genai import types
+        api_key = self.gemini_key or os.getenv("GOOGLE_API_KEY1") or os.getenv("GOOGLE_API_KEY")
+        import httpx
+        # Our own httpx client: with aiohttp installed (livekit pulls it in) genai would otherwise
+        # use aiohttp for client.aio and ignore the pool limits and timing hooks
+        http_client = httpx.AsyncClient(limits=self._limits(), event_hooks=self.timings["gemini"].event_hooks())
+        try:
+            http_options = types.HttpOptions(httpx_async_client=http_client, base_url=self.gemini_base_url)
+            return genai.Client(api_key=api_key, http_options=http_options)
+        except Exception as e:
+            # Older google-genai without httpx_async_client: still one client, just untimed
+            logger.warning(f"Gemini client without pooled timings: {e}")
+            return genai.Client(api_key=api_key)
+
+    def _build_openrouter(self):
+        from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+        or_key = self.openrouter_key or os.getenv("OPENROUTER_API")
+        if not or_key:
+            raise Exception("No OPENROUTER_API key configured.")
+        http_client = DefaultAsyncHttpxClient(
+            limits=self._limits(),
+            event_hooks=self.timings["openrouter"].event_hooks(),
+        )
+        return AsyncOpenAI(base_url=self.openrouter_base_url, api_key=or_key, http_client=http_client)
+
+
+# --- Dispatch ---
+class AllBackendsFailed(Exception):
+    pass
+
+
+class BackendStats:
+    """Rolling time-to-first-token and error rate for one backend."""
+    def __init__(self, window: int = 50):
+        self.latencies = deque(maxlen=window)
+        self.outcomes = deque(maxlen=window) # True = success
+        self.requests = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.hedged = 0     # Times a hedge was fired because this backend was slow
+        self.cancelled = 0  # Times this backend lost a race and was cancelled
+        # Generations aborted because nobody wanted the reply any more (barge-in / preemption)
+        self.reply_tokens = deque(maxlen=window)
+        self.aborted = 0
+        self.aborted_tokens = 0  # Generated before the abort (spent anyway)
+        self.tokens_avoided = 0  # Estimated remainder that was never generated
+
+    def record_success(self, latency: float):
+        self.requests += 1
+        self.latencies.append(latency)
+        self.outcomes.append(True)
+
+    def record_failure(self, timeout: bool = False):
+        self.requests += 1
+        self.failures += 1
+        self.timeouts += timeout
+        self.outcomes.append(False)
+
+    def record_reply(self, tokens: int):
+        self.reply_tokens.append(tokens)
+
+    def record_abort(self, tokens: int) -> int:
+        """Returns the estimated tokens avoided: a typical reply's length minus what was already generated."""
+        typical = sum(self.reply_tokens) / len(self.reply_tokens) if self.reply_tokens else 0
+        avoided = max(0, round(typical) - tokens)
+        self.aborted += 1
+        self.aborted_tokens += tokens
+        self.tokens_avoided += avoided
+        return avoided
+
+    def percentile(self, pct: float):
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+    @property
+    def error_rate(self) -> float:
+        return self.outcomes.count(False) / len(self.outcomes) if self.outcomes else 0.0
+
+    def snapshot(self) -> dict:
+        ms = lambda v: round(v * 1000, 1) if v is not None else None
+        return {
+            "requests": self.requests,
+            "failures": self.failures,
+            "timeouts": self.timeouts,
+            "hedged": self.hedged,
+            "cancelled": self.cancelled,
+            "error_rate": round(self.error_rate, 3),
+            "p50_ms": ms(self.percentile(50)),
+            "p95_ms": ms(self.percentile(95)),
+            "aborted": self.aborted,
+            "aborted_tokens": self.aborted_tokens,
+            "tokens_avoided_est": self.tokens_avoided,
+        }
+
+
+class CircuitBreaker:
+    """
+    Health state for one backend.
+    - closed: requests flow; `failure_threshold` consecutive failures open it.
+    - open: requests are refused without touching the backend until the probe interval passes.
+    - half-open: a single probe request is let through; success closes the breaker,
+      failure re-opens it with the probe interval doubled (up to `max_interval`).
+    """
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, name: str, failure_threshold: int = 3, base_interval: float = 5.0,
+                 max_interval: float = 300.0, clock=time.monotonic):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.base_interval = base_interval
+        self.max_interval = max_interval
+        self.clock = clock
+        self.state = self.CLOSED
+        self.interval = base_interval
+        self.open_until = 0.0
+        self.consecutive_failures = 0
+        self.probing = False
+        # Metrics
+        self.opens = 0
+        self.short_circuits = 0
+        self.probes = 0
+
+    def allow(self) -> bool:
+        """True if a request may go to the backend now (claims the probe slot when half-open)."""
+        if self.state == self.OPEN:
+            if self.clock() < self.open_until:
+                self.short_circuits += 1
+                return False
+            self.state = self.HALF_OPEN
+            logger.info(f"Circuit {self.name}: half-open, probing.")
+        if self.state == self.HALF_OPEN:
+            if self.probing:
+                self.short_circuits += 1
+                return False
+            self.probing = True
+            self.probes += 1
+        return True
+
+    def record_success(self):
+        if self.state != self.CLOSED:
+            logger.info(f"Circuit {self.name}: closed, backend recovered.")
+        self.state = self.CLOSED
+        self.interval = self.base_interval
+        self.consecutive_failures = 0
+        self.probing = False
+
+    def record_failure(self):
+        self.consecutive_failures += 1
+        if self.state == self.HALF_OPEN:
+            self.interval = min(self.interval * 2, self.max_interval)
+            self._open()
+        elif self.state == self.CLOSED and self.consecutive_failures >= self.failure_threshold:
+            self._open()
+
+    def release(self):
+        """The request was cancelled before an outcome; free the probe slot without judging."""
+        self.probing = False
+
+    def _open(self):
+        self.state = self.OPEN
+        self.probing = False
+        self.open_until = self.clock() + self.interval
+        self.opens += 1
+        logger.warning(f"Circuit {self.name}: open after {self.consecutive_failures} failures; next probe in {self.interval:.0f}s.")
+
+    def snapshot(self) -> dict:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "opens": self.opens,
+            "short_circuits": self.short_circuits,
+            "probes": self.probes,
+            "retry_in_s": round(max(0.0, self.open_until - self.clock()), 1) if self.state == self.OPEN else 0.0,
+        }
+
+
+class Backend:
+    """A named streaming LLM backend: `stream_fn(*args)` returns an async iterator of text deltas."""
+    def __init__(self, name: str, stream_fn, first_token_timeout: float = 15.0, idle_timeout: float = 30.0,
+                 breaker: CircuitBreaker = None):
+        self.name = name
+        self.stream_fn = stream_fn
+        self.first_token_timeout = first_token_timeout
+        self.idle_timeout = idle_timeout
+        self.stats = BackendStats()
+        self.breaker = breaker or CircuitBreaker(name)
+
+
+class Dispatcher:
+    """
+    Runs a request against an ordered list of backends.
+    - Each backend gets its own first-token and idle timeouts.
+    - Backends whose circuit breaker is open are skipped without being called.
+    - Backends whose rolling error rate is over `max_error_rate` are tried last.
+    - With hedging on, if the current backend hasn't produced a token by its own p95,
+      the next backend is started too; the first to produce a token wins and the
+      loser is cancelled.
+    """
+    def __init__(self, backends: list, hedge: bool = True, max_error_rate: float = 0.5,
+                 min_samples: int = 5, min_hedge_delay: float = 0.25):
+        self.backends = {b.name: b for b in backends}
+        self.order = [b.name for b in backends]
+        self.hedge = hedge
+        self.max_error_rate = max_error_rate
+        self.min_samples = min_samples
+        self.min_hedge_delay = min_hedge_delay
+
+    def route(self, names: list = None) -> list:
+        candidates = [self.backends[n] for n in (names or self.order)]
+        # Stable sort keeps configured priority among healthy backends
+        return sorted(candidates, key=lambda b: b.stats.error_rate > self.max_error_rate)
+
+    def hedge_delay(self, backend: Backend):
+        if not self.hedge or len(backend.stats.latencies) < self.min_samples:
+            return None
+        return max(self.min_hedge_delay, backend.stats.percentile(95))
+
+    def stats(self) -> dict:
+        return {
+            name: {**self.backends[name].stats.snapshot(), "circuit": self.backends[name].breaker.snapshot()}
+            for name in self.order
+        }
+
+    async def stream(self, names: list, *args):
+        """Async generator of text deltas from whichever backend answers first."""
+        loop = asyncio.get_running_loop()
+        candidates = self.route(names)
+        attempts = {}  # first-token task -> (backend, iterator, started_at)
+        winner = None
+        launched = 0
+        errors = []
+
+        def launch() -> bool:
+            nonlocal launched
+            while launched < len(candidates):
+                backend = candidates[launched]
+                launched += 1
+                if not backend.breaker.allow():
+                    errors.append(f"{backend.name}: circuit open")
+                    continue
+                iterator = backend.stream_fn(*args).__aiter__()
+                task = asyncio.ensure_future(iterator.__anext__())
+                attempts[task] = (backend, iterator, loop.time())
+                return True
+            return False
+
+        try:
+            while winner is None:
+                if not attempts and not launch():
+                    raise AllBackendsFailed("; ".join(errors) or "no backends available")
+
+                # Wake up for the earliest first-token deadline or hedge point
+                now = loop.time()
+                wake = [started + b.first_token_timeout for b, _, started in attempts.values()]
+                newest, _, newest_start = max(attempts.values(), key=lambda a: a[2])
+                hedge_at = None
+                if launched < len(candidates) and self.hedge_delay(newest) is not None:
+                    hedge_at = newest_start + self.hedge_delay(newest)
+                    wake.append(hedge_at)
+                done, _ = await asyncio.wait(list(attempts), timeout=max(0.0, min(wake) - now),
+                                             return_when=asyncio.FIRST_COMPLETED)
+
+                for task in done:
+                    backend, iterator, started = attempts.pop(task)
+                    error = task.exception()
+                    if error is None:
+                        if winner is None:
+                            winner = (backend, iterator, task.result(), started)
+                            continue
+                        attempts[task] = (backend, iterator, started) # Lost a photo finish
+                        continue
+                    reason = "empty reply" if isinstance(error, StopAsyncIteration) else str(error)
+                    logger.warning(f"Backend {backend.name} failed: {reason}")
+                    errors.append(f"{backend.name}: {reason}")
+                    backend.stats.record_failure()
+                    backend.breaker.record_failure()
+
+                if winner is not None:
+                    break
+
+                now = loop.time()
+                for task, (backend, iterator, started) in list(attempts.items()):
+                    if now - started >= backend.first_token_timeout:
+                        logger.warning(f"Backend {backend.name} timed out waiting for first token.")
+                        errors.append(f"{backend.name}: first-token timeout")
+                        backend.stats.record_failure(timeout=True)
+                        backend.breaker.record_failure()
+                        del attempts[task]
+                        await _cancel(task, iterator)
+                if hedge_at is not None and now >= hedge_at and launched < len(candidates) and newest in [a[0] for a in attempts.values()]:
+                    if launch():
+                        logger.info(f"Backend {newest.name} past its p95; hedged.")
+                        newest.stats.hedged += 1
+        except (GeneratorExit, asyncio.CancelledError):
+            # The caller gave up before any token arrived: nothing generated, all of it avoided
+            for backend, _, _ in attempts.values():
+                backend.stats.record_abort(0)
+            raise
+        finally:
+            # Cancel every attempt that didn't win (or all of them if we're being cancelled)
+            for task, (backend, iterator, _) in attempts.items():
+                if winner is not None:
+                    backend.stats.cancelled += 1
+                backend.breaker.release()
+                await _cancel(task, iterator)
+
+        backend, iterator, first, started = winner
+        backend.stats.record_success(loop.time() - started)
+        backend.breaker.record_success()
+        parts = [first]
+        try:
+            yield first
+            while True:
+                try:
+                    # asyncio.timeout, not wait_for: 3.11's wait_for can swallow a cancellation
+                    # that races with a token arriving, and barge-in depends on it propagating
+                    async with asyncio.timeout(backend.idle_timeout):
+                        delta = await iterator.__anext__()
+                except StopAsyncIteration:
+                    break
+                parts.append(delta)
+                yield delta
+            backend.stats.record_reply(approx_tokens("".join(parts)))
+        except (GeneratorExit, asyncio.CancelledError):
+            generated = approx_tokens("".join(parts))
+            avoided = backend.stats.record_abort(generated)
+            logger.info(f"Cancelled {backend.name} generation after ~{generated} tokens (~{avoided} avoided).")
+            raise
+        except Exception:
+            backend.breaker.record_failure()
+            raise
+        finally:
+            # Closing the backend iterator stops local generation / aborts the HTTP stream
+            await _close(iterator)
+
+
+async def _cancel(task, iterator):
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    await _close(iterator)
+
+
+async def _close(iterator):
+    aclose = getattr(iterator, "aclose", None)
+    if aclose:
+        try:
+            await aclose()
+        except Exception:
+            pass
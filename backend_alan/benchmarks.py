@@ -0,0 +1,1374 @@
+"""
+ALAN backend micro-benchmarks.
+
+Usage:
+    python benchmarks.py tts [--voice VOICE]
+    python benchmarks.py memory-pool [--ops N]
+    python benchmarks.py memory-search [--rows N] [--queries N]
+    python benchmarks.py backend-reuse [--requests N]
+    python benchmarks.py dispatch
+    python benchmarks.py response-cache [--turns N] [--threshold T]
+    python benchmarks.py prompt-prefix [--turns N] [--budget TOKENS]
+    python benchmarks.py intent [--repeat N]
+    python benchmarks.py scheduler
+    python benchmarks.py vad [--seconds N]
+    python benchmarks.py audio-alloc [--seconds N]
+    python benchmarks.py resample [--seconds N]
+    python benchmarks.py pcm-cache [--repeat N]
+    python benchmarks.py audio-output [--utterances N] [--publish-ms MS]
+    python benchmarks.py vision [--width W] [--height H] [--frames N]
+    python benchmarks.py scene-change [--width W] [--height H]
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def _peak_rss_mb() -> float:
+    if resource is None:
+        return float("nan")
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS reports bytes
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+# --- TTS ---
+TTS_TEXTS = {
+    "short": "Hello sir, I am Friday, your personal assistant.",
+    "medium": (
+        "The build finished without errors. Three tests were skipped because the GPU runner "
+        "was offline, and the deployment is waiting for your approval. Shall I proceed?"
+    ),
+    "long": " ".join([
+        "Here is a summary of today's activity.",
+        "You had four meetings, two of which ran over time by about ten minutes each.",
+        "The backend service was deployed twice, once in the morning and once after lunch.",
+        "Memory usage on the agent worker stayed below two gigabytes for the whole day.",
+        "There were three reports of delayed speech output, all from long replies.",
+        "I recommend reviewing the streaming synthesis path and the sentence chunker.",
+        "Your next meeting is tomorrow at nine, and the agenda has already been shared.",
+    ] * 3),
+}
+
+
+async def _tts_save_then_decode(text: str, voice: str):
+    """Baseline: save the whole MP3 to disk, then decode it in one pass."""
+    import av
+    import edge_tts
+    from speech import TTS_SAMPLE_RATE
+
+    start = time.perf_counter()
+    with tempfile.NamedTemporaryFile(suffix=".mp3", delete=False) as fp:
+        temp_filename = fp.name
+    try:
+        await edge_tts.Communicate(text, voice).save(temp_filename)
+        container = av.open(temp_filename)
+        resampler = av.AudioResampler(format="s16", layout="mono", rate=TTS_SAMPLE_RATE)
+        frames = []
+        for frame in container.decode(container.streams.audio[0]):
+            for rf in resampler.resample(frame):
+                frames.append(rf.to_ndarray().tobytes())
+        container.close()
+        # The first frame only goes out once everything is decoded
+        first = time.perf_counter()
+    finally:
+        os.remove(temp_filename)
+    return first - start, time.perf_counter() - start
+
+
+async def _tts_streaming(text: str, voice: str):
+    from speech import synthesize_stream
+
+    start = time.perf_counter()
+    first = None
+    async for _ in synthesize_stream(text, voice):
+        if first is None:
+            first = time.perf_counter()
+    return (first or time.perf_counter()) - start, time.perf_counter() - start
+
+
+def _tts_case(job):
+    mode, name, voice = job
+    runner = _tts_streaming if mode == "stream" else _tts_save_then_decode
+    ttff, total = asyncio.run(runner(TTS_TEXTS[name], voice))
+    return mode, name, ttff, total, _peak_rss_mb()
+
+
+def bench_tts(args):
+    from speech import DEFAULT_VOICE
+
+    voice = args.voice or DEFAULT_VOICE
+    jobs = [(mode, name, voice) for name in TTS_TEXTS for mode in ("file", "stream")]
+    print(f"{'mode':<8}{'text':<8}{'chars':>7}{'first frame ms':>16}{'total ms':>10}{'peak RSS MB':>13}")
+    # Fresh process per case so peak RSS is not inherited from the previous run
+    with multiprocessing.Pool(processes=1, maxtasksperchild=1) as pool:
+        for mode, name, ttff, total, rss in pool.imap(_tts_case, jobs):
+            print(f"{mode:<8}{name:<8}{len(TTS_TEXTS[name]):>7}{ttff * 1000:>16.1f}{total * 1000:>10.1f}{rss:>13.1f}")
+
+
+# --- Memory ---
+class _ConnectPerCallMemory:
+    """Baseline: the old AlanMemory access pattern, one sqlite3.connect per call."""
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+
+    def log_interaction(self, role: str, content: str):
+        import sqlite3
+        from datetime import datetime
+        conn = sqlite3.connect(self.db_path)
+        conn.execute("INSERT INTO episodic_memory (role, content, timestamp) VALUES (?, ?, ?)",
+                     (role, content, datetime.now().isoformat()))
+        conn.commit()
+        conn.close()
+
+    def _query_all(self, sql, params=()):
+        import sqlite3
+        conn = sqlite3.connect(self.db_path)
+        res = conn.execute(sql, params).fetchall()
+        conn.close()
+        return res
+
+    def get_recent_history(self, limit=10):
+        return self._query_all("SELECT role, content FROM episodic_memory ORDER BY id DESC LIMIT ?", (limit,))
+
+    def get_personality(self):
+        return self._query_all("SELECT trait, current_value FROM personality")
+
+    def get_long_term(self, category: str):
+        return self._query_all("SELECT item, value FROM long_term_memory WHERE category=?", (category,))
+
+
+def _memory_turn(mem):
+    """The SQL a single _think_fast turn performs."""
+    mem.log_interaction("user", "What is on my calendar today?")
+    mem.get_recent_history(limit=5)
+    mem.get_personality()
+    mem.get_long_term("user_preferences")
+    mem.log_interaction("assistant", "You have two meetings this afternoon.")
+
+
+def _ops_per_sec(fn, ops: int) -> float:
+    start = time.perf_counter()
+    for _ in range(ops):
+        fn()
+    return ops / (time.perf_counter() - start)
+
+
+def bench_memory_pool(args):
+    from memory import AlanMemory
+
+    with tempfile.TemporaryDirectory() as tmp:
+        pooled = AlanMemory(os.path.join(tmp, "bench.db"))
+        baseline = _ConnectPerCallMemory(pooled.db_path)
+        cases = {
+            "read personality": lambda m: m.get_personality(),
+            "read history": lambda m: m.get_recent_history(limit=5),
+            "log interaction": lambda m: m.log_interaction("user", "ping"),
+            "full turn (5 ops)": _memory_turn,
+        }
+        print(f"{'operation':<20}{'connect/call ops/s':>20}{'pooled ops/s':>15}{'speedup':>10}")
+        for name, op in cases.items():
+            base = _ops_per_sec(lambda: op(baseline), args.ops)
+            pool = _ops_per_sec(lambda: op(pooled), args.ops)
+            print(f"{name:<20}{base:>20,.0f}{pool:>15,.0f}{pool / base:>9.1f}x")
+        pooled.close()
+        _check_reads_during_locked_flush(os.path.join(tmp, "locked.db"))
+
+
+def _check_reads_during_locked_flush(db_path: str, lock_seconds: float = 3.0):
+    """Another connection holds the write lock (as compaction does) while rows are queued."""
+    import sqlite3
+    import threading
+    from memory import AlanMemory
+
+    mem = AlanMemory(db_path)
+    for i in range(30):
+        mem.log_interaction("user" if i % 2 == 0 else "assistant", f"turn {i} about deploy")
+    mem.flush()
+    blocker = sqlite3.connect(db_path, check_same_thread=False)
+    blocker.execute("BEGIN IMMEDIATE")
+    release = threading.Timer(lock_seconds, blocker.rollback)
+    release.start()
+    for i in range(30, 34):
+        mem.log_interaction("user" if i % 2 == 0 else "assistant", f"turn {i} about deploy")
+    flusher = threading.Thread(target=lambda: mem.flush())  # Stalls on the busy timeout
+    flusher.start()
+    time.sleep(0.1)
+    start = time.perf_counter()
+    history = mem.get_recent_history(limit=10)
+    hits = mem.search("deploy", k=5, exclude_recent=10)
+    took = time.perf_counter() - start
+    release.join()
+    flusher.join()
+    expected = [f"turn {i} about deploy" for i in range(24, 34)]
+    assert [h["content"] for h in history] == expected, history
+    assert hits and all(int(h["content"].split()[1]) < 24 for h in hits), hits
+    after = [h["content"] for h in mem.get_recent_history(limit=10)]
+    assert after == expected, after
+    print(f"\nreads while another connection held the write lock for {lock_seconds:.0f}s: "
+          f"{took * 1000:.1f} ms, no duplicates")
+    blocker.close()
+    mem.close()
+
+
+_SEARCH_TOPICS = (
+    "weather calendar meeting deploy server error timeout dosa coffee music playlist "
+    "mountain hiking flight hotel reminder birthday invoice budget python docker kubernetes "
+    "battery charger screen keyboard password backup camera project deadline report "
+    "tamil english translation recipe gym workout doctor appointment train ticket movie"
+).split()
+_SEARCH_FILLER = "the a is to and of for with my your please can you what when".split()
+
+
+class _SyntheticTurns:
+    """Zipf-distributed vocabulary, closer to real conversation than uniform sampling."""
+    def __init__(self, rng: random.Random, vocab_size: int = 20_000):
+        self.rng = rng
+        self.vocab = _SEARCH_TOPICS + [f"term{i}" for i in range(vocab_size - len(_SEARCH_TOPICS))]
+        self.cum_weights = []
+        total = 0.0
+        for rank in range(1, len(self.vocab) + 1):
+            total += 1.0 / rank
+            self.cum_weights.append(total)
+
+    def words(self, k: int) -> list:
+        return self.rng.choices(self.vocab, cum_weights=self.cum_weights, k=k)
+
+    def turn(self) -> str:
+        words = self.words(self.rng.randint(2, 6)) + self.rng.choices(_SEARCH_FILLER, k=self.rng.randint(4, 10))
+        self.rng.shuffle(words)
+        return " ".join(words)
+
+
+def _percentile(samples: list, pct: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def bench_memory_search(args):
+    from memory import AlanMemory
+
+    turns = _SyntheticTurns(random.Random(42))
+    with tempfile.TemporaryDirectory() as tmp:
+        mem = AlanMemory(os.path.join(tmp, "bench.db"))
+        conn = mem.connections.get()
+        start = time.perf_counter()
+        batch = 50_000
+        for offset in range(0, args.rows, batch):
+            rows = [("user" if i % 2 else "assistant", turns.turn(), "2025-01-01T00:00:00")
+                    for i in range(offset, min(args.rows, offset + batch))]
+            with conn:
+                conn.executemany("INSERT INTO episodic_memory (role, content, timestamp) VALUES (?, ?, ?)", rows)
+        print(f"Seeded {args.rows:,} interactions in {time.perf_counter() - start:.1f}s")
+
+        queries = ["what about " + " ".join(turns.words(turns.rng.randint(1, 3))) for _ in range(args.queries)]
+        mem.search(queries[0], k=args.k)  # Warm the page cache
+        latencies = []
+        for q in queries:
+            t0 = time.perf_counter()
+            mem.search(q, k=args.k)
+            latencies.append((time.perf_counter() - t0) * 1000)
+        print(f"search(k={args.k}) over {args.queries} queries: "
+              f"p50 {_percentile(latencies, 50):.2f} ms, p95 {_percentile(latencies, 95):.2f} ms, "
+              f"p99 {_percentile(latencies, 99):.2f} ms, max {max(latencies):.2f} ms")
+
+        # How much of the recall repeats turns the prompt already carries (brain: 20-29 turn window)
+        # Follow-up style queries: words from the turns just discussed
+        recent_turns = [t["content"] for t in mem.get_recent_history(limit=30)]
+        recent = set(recent_turns)
+        follow_ups = [" ".join(turns.rng.sample(t.split(), min(3, len(t.split())))) for t in recent_turns]
+        for exclude in (0, 30):
+            results = [r for q in follow_ups for r in mem.search(q, k=args.k, exclude_recent=exclude)]
+            dupes = sum(r["content"] in recent for r in results)
+            print(f"search(exclude_recent={exclude}): {dupes} of {len(results)} results already in the last 30 turns")
+        mem.close()
+
+
+# --- LLM Backends ---
+def _start_openai_standin():
+    """
+    Local HTTP/1.1 stand-in for the OpenAI chat completions and Gemini generateContent APIs.
+    Counts TCP connections it accepts.
+    """
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # Keep-alive
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("content-length", 0)))
+            self.server.connections.add(self.client_address)
+            if ":generateContent" in self.path:
+                reply = {"candidates": [{"index": 0, "finishReason": "STOP",
+                                         "content": {"role": "model", "parts": [{"text": "pong"}]}}]}
+            else:
+                reply = {
+                    "id": "chatcmpl-bench", "object": "chat.completion", "created": 0, "model": "stand-in",
+                    "choices": [{"index": 0, "finish_reason": "stop",
+                                 "message": {"role": "assistant", "content": "pong"}}],
+                }
+            body = json.dumps(reply).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.connections = set()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def bench_backend_reuse(args):
+    from backends import BackendRegistry
+
+    server = _start_openai_standin()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}/v1"
+    messages = [{"role": "user", "content": "ping"}]
+
+    async def run(make_client) -> tuple:
+        server.connections.clear()
+        start = time.perf_counter()
+        for _ in range(args.requests):
+            await make_client().chat.completions.create(model="stand-in", messages=messages)
+        return len(server.connections), (time.perf_counter() - start) / args.requests * 1000
+
+    def fresh_client():
+        return BackendRegistry(openrouter_base_url=base_url, openrouter_key="bench").openrouter()
+
+    async def compare():
+        registry = BackendRegistry(openrouter_base_url=base_url, openrouter_key="bench")
+        return await run(fresh_client), await run(registry.openrouter), registry
+
+    async def gemini():
+        # genai's client.aio, through the registry's own httpx pool (not genai's default transport)
+        registry = BackendRegistry(gemini_base_url=f"http://127.0.0.1:{server.server_address[1]}", gemini_key="bench")
+        server.connections.clear()
+        start = time.perf_counter()
+        for _ in range(args.requests):
+            await registry.gemini().aio.models.generate_content(model="stand-in", contents="ping")
+        return len(server.connections), (time.perf_counter() - start) / args.requests * 1000, registry
+
+    (base_conns, base_ms), (pooled_conns, pooled_ms), registry = asyncio.run(compare())
+    gemini_conns, gemini_ms, gemini_registry = asyncio.run(gemini())
+    server.shutdown()
+
+    print(f"{'client':<22}{'requests':>10}{'TCP connections':>17}{'avg ms/request':>16}")
+    print(f"{'new per request':<22}{args.requests:>10}{base_conns:>17}{base_ms:>16.2f}")
+    print(f"{'registry (shared)':<22}{args.requests:>10}{pooled_conns:>17}{pooled_ms:>16.2f}")
+    print(f"{'registry (gemini)':<22}{args.requests:>10}{gemini_conns:>17}{gemini_ms:>16.2f}")
+    print("registry timings:", json.dumps(registry.stats()["openrouter"]))
+    print("gemini timings:", json.dumps(gemini_registry.stats()["gemini"]))
+    if pooled_conns != 1 or gemini_conns != 1:
+        sys.exit(f"FAIL: expected one reused connection, server saw {pooled_conns} (openrouter), {gemini_conns} (gemini)")
+    if gemini_registry.stats()["gemini"]["requests"] != args.requests:
+        sys.exit("FAIL: Gemini requests bypassed the registry's HTTP pool")
+
+
+class _FakeBackend:
+    """Scripted streaming backend: waits `delay` before its first token, or raises."""
+    def __init__(self, delay: float = 0.0, fail: bool = False, text: str = "ok", token_delay: float = 0.0):
+        self.delay = delay
+        self.fail = fail
+        self.text = text
+        self.token_delay = token_delay
+        self.started = 0
+        self.cancelled = 0
+        self.closed_early = 0
+        self.tokens_generated = 0
+
+    async def __call__(self, *args):
+        self.started += 1
+        try:
+            await asyncio.sleep(self.delay)
+            if self.fail:
+                raise RuntimeError("scripted failure")
+            for word in self.text.split():
+                self.tokens_generated += 1
+                yield word
+                await asyncio.sleep(self.token_delay)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        except GeneratorExit:
+            self.closed_early += 1
+            raise
+
+
+def bench_dispatch(args):
+    from backends import AllBackendsFailed, Backend, CircuitBreaker, Dispatcher
+
+    async def ask(dispatcher, names=None):
+        start = time.perf_counter()
+        try:
+            text = " ".join([d async for d in dispatcher.stream(names or dispatcher.order)])
+        except AllBackendsFailed:
+            text = None
+        return text, (time.perf_counter() - start) * 1000
+
+    def check(name: str, ok: bool, detail: str):
+        print(f"{'PASS' if ok else 'FAIL':<6}{name:<28}{detail}")
+        return ok
+
+    async def scenarios() -> list:
+        results = []
+
+        # Failure falls straight through to the next backend
+        a, b = _FakeBackend(fail=True), _FakeBackend(text="from b")
+        d = Dispatcher([Backend("a", a), Backend("b", b)])
+        text, ms = await ask(d)
+        results.append(check("fallback on error", text == "from b" and ms < 100, f"{text!r} in {ms:.0f} ms"))
+
+        # A hanging backend costs its first-token timeout, not forever
+        a, b = _FakeBackend(delay=10), _FakeBackend(text="from b")
+        d = Dispatcher([Backend("a", a, first_token_timeout=0.2), Backend("b", b)], hedge=False)
+        text, ms = await ask(d)
+        results.append(check("first-token timeout", text == "from b" and 200 <= ms < 400 and a.cancelled == 1,
+                             f"{text!r} in {ms:.0f} ms, a cancelled={a.cancelled}"))
+
+        # Warm up a's p95 at ~50 ms, then make it slow: the hedge fires and b wins
+        a, b = _FakeBackend(delay=0.05, text="from a"), _FakeBackend(delay=0.02, text="from b")
+        d = Dispatcher([Backend("a", a, first_token_timeout=5), Backend("b", b)], min_hedge_delay=0.05)
+        for _ in range(10):
+            await ask(d)
+        a.delay = 2.0
+        text, ms = await ask(d)
+        stats = d.stats()["a"]
+        results.append(check("hedge past p95", text == "from b" and ms < 300 and stats["hedged"] == 1 and a.cancelled == 1,
+                             f"{text!r} in {ms:.0f} ms, a hedged={stats['hedged']} cancelled={a.cancelled}"))
+
+        # A backend with a bad error rate is demoted behind healthy ones
+        a, b = _FakeBackend(fail=True), _FakeBackend(text="from b")
+        d = Dispatcher([Backend("a", a), Backend("b", b)])
+        for _ in range(5):
+            await ask(d)
+        before = a.started
+        await ask(d)
+        results.append(check("routing demotes failures", d.route()[0].name == "b" and a.started == before,
+                             f"order={[x.name for x in d.route()]}, error_rate={d.stats()['a']['error_rate']}"))
+
+        # A dead backend opens its circuit and is then skipped without being called
+        now = [0.0]
+        a, b = _FakeBackend(fail=True), _FakeBackend(text="from b")
+        breaker = CircuitBreaker("a", failure_threshold=3, base_interval=5, clock=lambda: now[0])
+        d = Dispatcher([Backend("a", a, breaker=breaker), Backend("b", b)], max_error_rate=1.0)
+        for _ in range(3):
+            await ask(d)
+        before = a.started
+        text, ms = await ask(d)
+        results.append(check("open circuit skips backend", breaker.state == "open" and a.started == before and text == "from b",
+                             f"state={breaker.state}, calls while open={a.started - before}, {ms:.1f} ms"))
+
+        # Failed probe doubles the interval; a successful probe closes the circuit
+        now[0] = 5.0
+        await ask(d)
+        reopened = breaker.state == "open" and breaker.interval == 10
+        now[0] = 15.0
+        a.fail, a.text = False, "from a"
+        text, _ = await ask(d)
+        results.append(check("half-open probe and backoff", reopened and breaker.state == "closed" and text == "from a",
+                             f"reopened at 10s interval={reopened}, then {breaker.state} with {text!r}"))
+
+        # Barge-in mid-reply: cancelling the consumer closes the backend stream and audits the tokens
+        words = " ".join(f"w{i}" for i in range(200))
+        a = _FakeBackend(text=words, token_delay=0.001)
+        d = Dispatcher([Backend("a", a)])
+        await ask(d)  # One full reply sets the typical length
+        a.tokens_generated = 0
+
+        async def consume():
+            async for _ in d.stream(["a"]):
+                await asyncio.sleep(0)
+        task = asyncio.create_task(consume())
+        await asyncio.sleep(0.02)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        stats = d.stats()["a"]
+        results.append(check("cancel stops generation", a.tokens_generated < 200 and stats["aborted"] == 1
+                             and stats["tokens_avoided_est"] > 0,
+                             f"generated {a.tokens_generated}/200 words, audit={stats['aborted_tokens']} spent / "
+                             f"~{stats['tokens_avoided_est']} avoided"))
+
+        # Nothing answers: AllBackendsFailed
+        d = Dispatcher([Backend("a", _FakeBackend(fail=True)), Backend("b", _FakeBackend(fail=True))])
+        text, ms = await ask(d)
+        results.append(check("all backends failed", text is None, f"{ms:.0f} ms"))
+
+        print("stats:", json.dumps(d.stats()))
+        return results
+
+    if not all(asyncio.run(scenarios())):
+        sys.exit("FAIL: dispatcher checks failed")
+
+
+# --- Response cache ---
+CACHE_QUESTIONS = [
+    ("hello alan", ["hello alan!", "Hello, Alan.", "hey hello alan"]),
+    ("how are you today", ["how are you", "How are you?"]),
+    ("what can you do", ["What can you do?", "what can you do for me"]),
+    ("how do i restart the backend service", ["how do I restart the backend service?", "restart the backend service how"]),
+    ("summarize my preferences", ["Summarize my preferences.", "please summarize my preferences"]),
+    ("tell me a joke", ["Tell me a joke!", "tell me another joke"]),
+]
+FOLLOW_UP = object()
+# Near-misses that must NOT be served from another question's entry
+CACHE_DISTRACTORS = [
+    "how do i restart the frontend service",
+    "tell me a story",
+    "what can you not do",
+    "how are you built",
+]
+
+
+def bench_response_cache(args):
+    from memory import AlanMemory
+    from response_cache import ResponseCache
+
+    rng = random.Random(7)
+    workload = []  # (text, canonical question, or FOLLOW_UP: the answer depends on the previous reply)
+    for _ in range(args.turns):
+        roll = rng.random()
+        if roll < 0.1:
+            workload.append((rng.choice(CACHE_DISTRACTORS), None))
+        elif roll < 0.2 and workload:
+            workload.append((rng.choice(["why?", "tell me more"]), FOLLOW_UP))
+        else:
+            canonical, variants = rng.choice(CACHE_QUESTIONS)
+            workload.append((rng.choice([canonical] + variants), canonical))
+
+    print(f"{'tier':<10}{'turns':>7}{'hit rate':>10}{'paraphrases':>13}{'wrong hits':>12}{'p50 us':>9}{'p95 us':>9}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for semantic in (False, True):
+            mem = AlanMemory(os.path.join(tmp, f"cache_{semantic}.db"))
+            cache = ResponseCache(mem, semantic=semantic, threshold=args.threshold)
+            version = mem.config_version()
+
+            # Paraphrase recall: cache only the canonical phrasing, then ask variants and near-misses once
+            for canonical, _ in CACHE_QUESTIONS:
+                cache.put(canonical, "fast", version, f"answer:{canonical}")
+            paraphrased = wrong = 0
+            for canonical, variants in CACHE_QUESTIONS:
+                for variant in variants:
+                    reply = cache.get(variant, "fast", version)
+                    paraphrased += reply == f"answer:{canonical}"
+                    wrong += reply is not None and reply != f"answer:{canonical}"
+            wrong += sum(cache.get(text, "fast", version) is not None for text in CACHE_DISTRACTORS)
+            n_variants = sum(len(v) for _, v in CACHE_QUESTIONS)
+
+            # Steady-state replay through a running conversation (what the brain passes as history):
+            # misses are answered and stored
+            cache.counters = dict.fromkeys(cache.counters, 0)
+            lookups = []
+            history = []
+            for text, canonical in workload:
+                if canonical is FOLLOW_UP:
+                    expected = f"{text} -> {history[-1]['content']}"
+                else:
+                    expected = f"answer:{canonical or text}"
+                window = history[-20:]
+                start = time.perf_counter()
+                reply = cache.get(text, "fast", version, history=window)
+                lookups.append((time.perf_counter() - start) * 1e6)
+                if reply is None:
+                    reply = expected
+                    cache.put(text, "fast", version, reply, history=window)
+                elif reply != expected:
+                    wrong += 1
+                history += [{"role": "user", "content": text}, {"role": "assistant", "content": reply}]
+            stats = cache.stats()
+            print(f"{'semantic' if semantic else 'exact':<10}{len(workload):>7}{stats['hit_rate']:>10.1%}"
+                  f"{f'{paraphrased}/{n_variants}':>13}{wrong:>12}"
+                  f"{_percentile(lookups, 50):>9.1f}{_percentile(lookups, 95):>9.1f}")
+
+            # Follow-ups: the same "why?" after two different answers must not share a reply
+            history = []
+            for topic in ("Paris", "Rome"):
+                history += [{"role": "user", "content": f"Tell me about {topic}"},
+                            {"role": "assistant", "content": f"{topic} is a capital city."}]
+                reply = cache.get("why?", "fast", version, history=history)
+                if reply is not None and reply != f"because:{topic}":
+                    print(f"  FAIL follow-up after {topic} returned {reply!r}")
+                cache.put("why?", "fast", version, f"because:{topic}", history=history)
+            mem.close()
+
+
+# --- Prompt prefix ---
+def bench_prompt_prefix(args):
+    """
+    How much of each local prompt has to be evaluated again, i.e. lies after the prefix it
+    shares with the previous turn's prompt (what llama_cpp keeps in its KV cache).
+    """
+    from context_builder import ContextBuilder, approx_tokens
+    from local_llm import _chatml
+    from memory import AlanMemory
+
+    system = "You are ALAN. Role: Advanced AI Assistant. Traits: {...}. Instruction: Reply directly to the user."
+    rng = random.Random(3)
+    layouts = {
+        # Recall on the system prompt, history sliding one turn at a time
+        "before": dict(align=1, drop_block=1, note=False),
+        "recall note + blocks": dict(align=10, drop_block=4, note=True),
+    }
+    print(f"{'layout':<22}{'budget':>8}{'turns':>7}{'avg evaluated tok':>19}{'avg prompt tok':>16}{'prefix kept':>13}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for budget in (3000, args.budget):
+            for name, layout in layouts.items():
+                mem = AlanMemory(os.path.join(tmp, f"{name}_{budget}.db"))
+                builder = ContextBuilder(budget_tokens=budget, drop_block=layout["drop_block"])
+                previous, evaluated, total = "", [], []
+                for turn in range(args.turns):
+                    words = rng.sample(_SEARCH_TOPICS, 3)
+                    text = f"tell me about {' and '.join(words)} for turn {turn}"
+                    mem.log_interaction("user", text)
+                    history = mem.get_recent_history(limit=20, align=layout["align"])[:-1]
+                    recalled = [m["content"] for m in mem.search(text, k=3) if m["content"] != text]
+                    recall = f"Relevant Memories: {json.dumps(recalled)}." if recalled else None
+                    if layout["note"]:
+                        messages = builder.build(system, text, history, note=recall)
+                    else:
+                        messages = builder.build(system + (f" {recall}" if recall else ""), text, history)
+                    prompt = _chatml(messages)
+                    shared = len(os.path.commonprefix([previous, prompt]))
+                    evaluated.append(approx_tokens(prompt[shared:]))
+                    total.append(approx_tokens(prompt))
+                    previous = prompt
+                    reply = f"Here is what I know about {words[0]}, {words[1]} and {words[2]}."
+                    previous += reply  # The reply's tokens are in the KV cache too
+                    mem.log_interaction("assistant", reply)
+                    mem.flush()
+                kept = 1 - sum(evaluated) / sum(total)
+                print(f"{name:<22}{budget:>8}{args.turns:>7}{sum(evaluated) / len(evaluated):>19.1f}"
+                      f"{sum(total) / len(total):>16.1f}{kept:>13.1%}")
+                mem.close()
+
+
+# --- Intent ---
+# (text, intent, needs vision)
+INTENT_FIXTURES = [
+    ("hello friday", "fast", False),
+    ("how are you today", "fast", False),
+    ("I'm deeply sorry about earlier", "fast", False),
+    ("take a deep breath and tell me a joke", "fast", False),
+    ("what are my plans for tonight", "fast", False),
+    ("see you later", "fast", False),
+    ("I see, thanks", "fast", False),
+    ("let's see what happens tomorrow", "fast", False),
+    ("I'm looking forward to the weekend", "fast", False),
+    ("it looks like rain", "fast", False),
+    ("we got there by trial and error", "fast", False),
+    ("the build was error-free this time", "fast", False),
+    ("remind me to call mom", "fast", False),
+    ("play some music", "fast", False),
+    ("what's the capital of France", "fast", False),
+    ("tell me about the planets", "fast", False),
+    ("who directed Interstellar", "fast", False),
+    ("can you look up the word serendipity", "fast", False),
+    ("plan my week step by step", "deep", False),
+    ("analyze the trade-offs between postgres and sqlite", "deep", False),
+    ("give me a deep dive on transformers", "deep", False),
+    ("help me think this through", "deep", False),
+    ("compare the pros and cons of renting vs buying", "deep", False),
+    ("design a roadmap for the mobile app", "deep", False),
+    ("break it down in depth", "deep", False),
+    ("what's the best strategy for learning Rust", "deep", False),
+    ("analyze the chart on my screen", "deep", True),
+    ("my script throws a KeyError", "debug", False),
+    ("the server keeps crashing after deploy", "debug", False),
+    ("npm install failed with exit code 1", "debug", False),
+    ("here's the traceback from pytest", "debug", False),
+    ("the app won't start anymore", "debug", False),
+    ("why is my request timing out", "debug", False),
+    ("I found a bug in the parser", "debug", False),
+    ("the wifi is not working", "debug", False),
+    ("what's this error on my screen", "debug", True),
+    ("look at this stack trace", "debug", True),
+    ("can you see my screen", "fast", True),
+    ("what do you see", "fast", True),
+    ("look at this", "fast", True),
+    ("read this out for me", "fast", True),
+    ("what's on the display right now", "fast", True),
+    ("describe this picture", "fast", True),
+    ("take a look at the camera", "fast", True),
+]
+
+# Not used while writing the rules: casual phrasings with a trigger word, plus real requests
+INTENT_HELD_OUT = [
+    ("I have a plan for dinner", "fast", False),
+    ("what's the plan", "fast", False),
+    ("compare these phones", "fast", False),
+    ("I failed my exam, cheer me up", "fast", False),
+    ("you're broken", "fast", False),
+    ("my heart is broken", "fast", False),
+    ("I'm planning a birthday party for Sam", "fast", False),
+    ("no plans tonight, just relaxing", "fast", False),
+    ("I crashed on the couch after work", "fast", False),
+    ("there's a bug in my room, gross", "fast", False),
+    ("the movie was a total failure", "fast", False),
+    ("I love gothic architecture", "fast", False),
+    ("it was human error, sorry", "fast", False),
+    ("let's plan the product launch", "deep", False),
+    ("compare postgres with mysql for analytics", "deep", False),
+    ("what are the options for scaling our backend long-term", "deep", False),
+    ("give me a comparison between the two job offers", "deep", False),
+    ("my laptop keeps crashing when I open chrome", "debug", False),
+    ("the deploy failed again", "debug", False),
+    ("there's a bug in the login flow", "debug", False),
+    ("the website is broken on mobile", "debug", False),
+    ("I get a ValueError when I run it", "debug", False),
+]
+
+
+def _substring_intent(text: str):
+    """The routing this classifier replaced (brain._route / agent vision check)."""
+    lower = text.lower()
+    if "deep" in lower or "plan" in lower:
+        intent = "deep"
+    elif "debug" in lower or "error" in lower:
+        intent = "debug"
+    else:
+        intent = "fast"
+    return intent, "see" in lower or "look" in lower or "screen" in lower
+
+
+def bench_intent(args):
+    from input_processor import IntentClassifier, VISION_FLAG
+
+    classifier = IntentClassifier()
+
+    def classify(text):
+        intent, flags = classifier.classify(text)
+        return intent.value, VISION_FLAG in flags
+
+    print(f"{'router':<12}{'fixtures':<10}{'intent acc':>12}{'vision acc':>12}{'expensive misroutes':>21}{'us/turn':>10}")
+    for name, route in (("substring", _substring_intent), ("classifier", classify)):
+        for set_name, fixtures in (("rules", INTENT_FIXTURES), ("held-out", INTENT_HELD_OUT)):
+            intent_ok = vision_ok = misroutes = 0
+            for text, intent, vision in fixtures:
+                got_intent, got_vision = route(text)
+                intent_ok += got_intent == intent
+                vision_ok += got_vision == vision
+                # Deep/debug prompts and image uploads that weren't needed
+                misroutes += (got_intent != "fast" and intent == "fast") + (got_vision and not vision)
+                if args.verbose and (got_intent, got_vision) != (intent, vision):
+                    print(f"    {name}: {text!r} -> {got_intent}/{got_vision}, expected {intent}/{vision}")
+
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                for text, _, _ in fixtures:
+                    route(text)
+            per_turn_us = (time.perf_counter() - start) / (args.repeat * len(fixtures)) * 1e6
+
+            n = len(fixtures)
+            print(f"{name:<12}{set_name:<10}{intent_ok / n:>12.1%}{vision_ok / n:>12.1%}{misroutes:>21}"
+                  f"{per_turn_us:>10.2f}")
+
+
+# --- Input scheduler ---
+def bench_scheduler(args):
+    from input_processor import InputProcessor, InputSource
+    from scheduler import InputScheduler
+
+    processor = InputProcessor()
+    handled = []
+
+    async def handler(event):
+        handled.append(event.normalized)
+        await asyncio.sleep(args.turn_ms / 1000)  # Stand-in for think + speak
+
+    async def scenario():
+        scheduler = InputScheduler(handler)
+        scheduler.start()
+        # A chat burst, then the user starts talking over the reply, then more chat
+        for i in range(5):
+            scheduler.submit(processor.process(InputSource.TEXT, f"chat {i}"))
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(args.turn_ms / 2000)
+        scheduler.submit(processor.process(InputSource.VOICE, "voice 1"))
+        await asyncio.sleep(0.01)
+        scheduler.submit(processor.process(InputSource.TEXT, "chat 5"))
+        scheduler.submit(processor.process(InputSource.VOICE, "voice 2"))
+        while scheduler.stats()["queued"] or scheduler.stats()["running"]:
+            await asyncio.sleep(0.01)
+        # A VAD onset (cough) during a text-chat turn must not cancel it
+        scheduler.submit(processor.process(InputSource.TEXT, "chat 6"))
+        await asyncio.sleep(0.01)
+        barged = scheduler.interrupt(InputSource.VOICE)
+        while scheduler.stats()["queued"] or scheduler.stats()["running"]:
+            await asyncio.sleep(0.01)
+        await scheduler.stop()
+        return scheduler.stats(), barged
+
+    stats, barged = asyncio.run(scenario())
+    print("handled:", [h.replace("\n", " + ") for h in handled])
+    print(json.dumps(stats, indent=2))
+    if barged or stats["completed"] < 1 or handled[-1] != "chat 6":
+        sys.exit("FAIL: voice barge-in cancelled a text-chat turn")
+
+
+# --- Audio input ---
+def _synthetic_speech(seconds: float, rate: int = 16000, seed: int = 3):
+    """int16 mono: alternating ~1 s of voiced harmonics (amplitude-modulated) and low room noise."""
+    import numpy as np
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * rate)) / rate
+    voiced = (np.floor(t) % 2 == 0)
+    f0 = 120 + 30 * np.sin(2 * np.pi * 0.5 * t)
+    phase = 2 * np.pi * np.cumsum(f0) / rate
+    harmonics = sum(np.sin(k * phase) / k for k in range(1, 8))
+    envelope = 0.5 + 0.5 * np.sin(2 * np.pi * 4 * t) ** 2  # Syllable-rate modulation
+    signal = np.where(voiced, 6000 * envelope * harmonics, 0) + rng.normal(0, 60, len(t))
+    return np.clip(signal, -32768, 32767).astype(np.int16)
+
+
+def bench_vad(args):
+    from audio_input import VoiceActivityDetector, load_vad_session
+
+    start = time.perf_counter()
+    session = load_vad_session()
+    load_ms = (time.perf_counter() - start) * 1000
+    start = time.perf_counter()
+    VoiceActivityDetector(session)
+    track_ms = (time.perf_counter() - start) * 1000
+    print(f"session load (once per worker): {load_ms:.1f} ms; per-track detector: {track_ms:.2f} ms")
+
+    audio = _synthetic_speech(args.seconds)
+    frame = 160  # 10 ms LiveKit frames at 16 kHz
+    print(f"{'detector':<12}{'windows':>9}{'fallback':>10}{'VAD CPU ms/audio s':>20}{'speech frames':>15}")
+    for name, sess in (("silero", session), ("rms only", None)):
+        vad = VoiceActivityDetector(sess)
+        speech = 0
+        for offset in range(0, len(audio), frame):
+            speech += vad.process(audio[offset:offset + frame]) > 0.5
+        stats = vad.stats()
+        cpu = stats["cpu_ms_per_audio_s"] if sess else float("nan")
+        print(f"{name:<12}{stats['windows']:>9}{stats['fallback_rate']:>10.1%}{cpu:>20.2f}"
+              f"{speech / (len(audio) // frame):>15.1%}")
+
+
+def bench_audio_alloc(args):
+    """Transient Python allocations per 10 ms frame on the speech accumulation path (tracemalloc)."""
+    import audioop
+    import tracemalloc
+    import numpy as np
+    from audio_input import SpeechRingBuffer, VoiceActivityDetector
+
+    audio = _synthetic_speech(args.seconds)
+    frames = [audio[i:i + 160].tobytes() for i in range(0, len(audio), 160)]  # As LiveKit delivers them
+    utterance_every = 100  # Hand off an utterance every second
+
+    def old_path():
+        speech_buffer = bytearray()
+        for n, data in enumerate(frames):
+            audio_int16 = np.frombuffer(data, dtype=np.int16)
+            audio_float32 = audio_int16.astype(np.float32) / 32768.0
+            audioop.rms(data, 2)  # The VAD path it always fell back to
+            speech_buffer.extend(data)
+            if n % utterance_every == utterance_every - 1:
+                handoff = bytes(speech_buffer)
+                speech_buffer = bytearray()
+            yield
+
+    def new_path():
+        ring, vad = SpeechRingBuffer(), VoiceActivityDetector(None)
+        ring.begin()
+        for n, data in enumerate(frames):
+            samples = np.frombuffer(data, dtype=np.int16)
+            ring.write(samples)
+            vad.process(samples)
+            if n % utterance_every == utterance_every - 1:
+                ring.end().release()
+                ring.begin()
+            yield
+
+    print(f"{'path':<10}{'frames':>8}{'avg B/frame':>13}{'max B/frame':>13}{'CPU us/frame':>14}")
+    for name, path in (("bytearray", old_path), ("ring", new_path)):
+        steps = path()
+        next(steps)  # Setup (ring/pool preallocation) isn't per-frame
+        start = time.process_time()
+        for _ in steps:
+            pass
+        cpu_us = (time.process_time() - start) / len(frames) * 1e6
+
+        steps = path()
+        next(steps)
+        tracemalloc.start()
+        transient = []
+        for _ in steps:
+            current, peak = tracemalloc.get_traced_memory()
+            transient.append(peak - current)
+            tracemalloc.reset_peak()
+        tracemalloc.stop()
+        print(f"{name:<10}{len(frames):>8}{sum(transient) / len(transient):>13.0f}{max(transient):>13}{cpu_us:>14.1f}")
+    print("(VAD in RMS mode so only this repo's code is measured; frames are bytes as LiveKit hands them over)")
+
+
+def bench_resample(args):
+    """48 kHz -> 16 kHz mono: realtime factor, alias rejection and frame-boundary continuity."""
+    import audioop
+    import numpy as np
+    from audio_input import StreamResampler
+
+    rate, frame = 48000, 480  # LiveKit delivers 10 ms frames
+
+    def tone(hz: float, channels: int) -> np.ndarray:
+        t = np.arange(int(args.seconds * rate)) / rate
+        x = (8000 * np.sin(2 * np.pi * hz * t)).astype(np.int16)
+        return np.repeat(x, channels)
+
+    def audioop_path(pcm: np.ndarray, channels: int):
+        # As transcribe_track did it: fresh state per frame, resample before downmix
+        step = frame * channels
+        out = []
+        for i in range(0, len(pcm), step):
+            data, _ = audioop.ratecv(pcm[i:i + step].tobytes(), 2, 1, rate, 16000, None)
+            if channels == 2:
+                data = audioop.tomono(data, 2, 0.5, 0.5)
+            out.append(np.frombuffer(data, dtype=np.int16))
+        return np.concatenate(out)
+
+    def stateful_path(pcm: np.ndarray, channels: int):
+        resampler = StreamResampler(rate, channels)
+        step = frame * channels
+        return np.concatenate([resampler.process(pcm[i:i + step]).copy() for i in range(0, len(pcm), step)])
+
+    def rms(x: np.ndarray) -> float:
+        return float(np.sqrt(np.mean(np.square(x.astype(np.float64))))) or 1e-9
+
+    def boundary_snr(out: np.ndarray, reference: np.ndarray) -> float:
+        """SNR of the frame-by-frame output against one continuous run (ignoring a fixed delay)."""
+        n = min(len(out), len(reference)) - 64
+        best = min(np.sum((out[d:d + n].astype(np.float64) - reference[:n]) ** 2) for d in range(0, 32))
+        return 10 * np.log10(np.sum(reference[:n].astype(np.float64) ** 2) / max(best, 1e-9))
+
+    print(f"{'path':<12}{'input':<9}{'realtime x':>12}{'alias dB':>10}{'boundary SNR dB':>17}")
+    for name, path in (("audioop", audioop_path), ("stateful", stateful_path)):
+        for channels in (1, 2):
+            pcm = tone(440, channels)
+            start = time.process_time()
+            out = path(pcm, channels)
+            rtf = args.seconds / max(time.process_time() - start, 1e-9)
+
+            # 10 kHz is above the 8 kHz output Nyquist: whatever survives is aliasing
+            alias = 20 * np.log10(rms(path(tone(10_000, channels), channels)) / rms(tone(10_000, 1)))
+            if name == "audioop":
+                continuous, _ = audioop.ratecv(tone(440, 1).tobytes(), 2, 1, rate, 16000, None)
+                reference = np.frombuffer(continuous, dtype=np.int16)
+            else:
+                reference = StreamResampler(rate, 1).process(tone(440, 1)).copy()
+            snr = boundary_snr(out if channels == 1 else out[:len(reference)], reference)
+            label = "mono" if channels == 1 else "stereo"
+            print(f"{name:<12}{label:<9}{rtf:>12.0f}{alias:>10.1f}{snr:>17.1f}")
+
+
+def bench_pcm_cache(args):
+    """Time to first frame for a stock phrase: synthesis (miss) vs memory and mmap'd disk hits."""
+    import numpy as np
+    from pcm_cache import PcmCache
+    from speech import DEFAULT_VOICE, TTS_SAMPLE_RATE, pipelined_synthesis
+
+    text = TTS_TEXTS["short"]
+
+    async def play(cache):
+        start = time.perf_counter()
+        first, frames = None, 0
+        async for _ in pipelined_synthesis([text], cache=cache):
+            first = first or time.perf_counter()
+            frames += 1
+        total = time.perf_counter() - start
+        await asyncio.sleep(0.05)  # Let the background store finish
+        return ((first or start + total) - start) * 1000, total * 1000, frames
+
+    def row(label, ttff, total, frames):
+        print(f"{label:<14}{ttff:>16.2f}{total:>11.2f}{frames:>8}")
+
+    with tempfile.TemporaryDirectory() as directory:
+        cache = PcmCache(directory)
+        print(f"{'path':<14}{'first frame ms':>16}{'total ms':>11}{'frames':>8}")
+        ttff, total, frames = asyncio.run(play(cache))
+        if frames:
+            row("miss (edge)", ttff, total, frames)
+        else:
+            # No network: seed the cache with a phrase-length buffer so the hit paths can still be timed
+            print("miss (edge)   synthesis unavailable, seeding 3 s of synthetic PCM")
+            pcm = (np.random.default_rng(0).standard_normal(3 * TTS_SAMPLE_RATE) * 3000).astype(np.int16)
+            cache.put(DEFAULT_VOICE, text, TTS_SAMPLE_RATE, pcm.tobytes())
+
+        runs = [asyncio.run(play(cache)) for _ in range(args.repeat)]
+        row("memory hit", *(sorted(r[i] for r in runs)[len(runs) // 2] for i in range(3)))
+
+        cold = PcmCache(directory)  # Fresh process view: only the disk tier is warm
+        row("disk hit", *asyncio.run(play(cold)))
+        row("memory hit", *asyncio.run(play(cold)))
+
+        print(f"\nwarm cache stats: {json.dumps(cache.stats())}")
+        print(f"cold cache stats: {json.dumps(cold.stats())}")
+
+        small = PcmCache(directory, max_memory_bytes=1 << 20, max_disk_bytes=1 << 20)
+        for i in range(8):
+            small.put(DEFAULT_VOICE, f"phrase {i}", TTS_SAMPLE_RATE, bytes(256 << 10))
+        stats = small.stats()
+        within = stats["memory_bytes"] <= 1 << 20 and stats["disk_bytes"] <= 1 << 20
+        print(f"bounded tiers (1 MiB each, 8 x 256 KiB phrases): memory {stats['memory_bytes']} B, "
+              f"disk {stats['disk_bytes']} B -> {'ok' if within else 'OVER LIMIT'}")
+
+
+class _FakeRoom:
+    """Stands in for rtc.Room: publish_track costs one signalling round-trip and is counted."""
+    def __init__(self, publish_delay: float):
+        self.local_participant = self
+        self.publish_delay = publish_delay
+        self.publishes = 0
+
+    async def publish_track(self, track):
+        await asyncio.sleep(self.publish_delay)
+        self.publishes += 1
+
+
+def bench_audio_output(args):
+    """Per-utterance cost of publishing a fresh track vs the session's persistent AudioOutput."""
+    from livekit import rtc
+    from audio_output import AudioOutput
+    from speech import TTS_CHANNELS, TTS_SAMPLE_RATE
+
+    frame = bytes(TTS_SAMPLE_RATE // 50 * 2)  # 20 ms of silence
+
+    async def utterance(frames: int = 10):
+        for _ in range(frames):
+            yield frame, TTS_SAMPLE_RATE // 50
+
+    async def per_utterance_track(room):
+        # As speak_stream did it: new source + track + publish before every reply
+        source = rtc.AudioSource(TTS_SAMPLE_RATE, TTS_CHANNELS)
+        track = rtc.LocalAudioTrack.create_audio_track("agent_voice", source)
+        await room.local_participant.publish_track(track)
+        async for data, samples in utterance():
+            await source.capture_frame(rtc.AudioFrame(data=data, sample_rate=TTS_SAMPLE_RATE,
+                                                      num_channels=TTS_CHANNELS, samples_per_channel=samples))
+        return source
+
+    async def run():
+        delay = args.publish_ms / 1000
+        old_room, new_room = _FakeRoom(delay), _FakeRoom(delay)
+        out = AudioOutput(new_room, TTS_SAMPLE_RATE, TTS_CHANNELS)
+        await out.start()  # Once, at session start
+        old_times, new_times = [], []
+        for _ in range(args.utterances):
+            start = time.perf_counter()
+            source = await per_utterance_track(old_room)
+            old_times.append(time.perf_counter() - start)
+            source.clear_queue()  # Stands in for the audio having played out
+
+            start = time.perf_counter()
+            await out.play(utterance())
+            new_times.append(time.perf_counter() - start)
+            out.source.clear_queue()
+
+        # Barge-in: a long utterance is cut off and nothing it queued keeps playing
+        playing = asyncio.create_task(out.play(utterance(500)))
+        await asyncio.sleep(0.05)
+        out.interrupt()
+        completed = await playing
+        await asyncio.sleep(0.05)  # A producer blocked on put() may add one stale frame; the player discards it
+        cleared = out._queue.empty() and out.source.queued_duration == 0
+
+        # A cancelled turn drops its queued audio too
+        playing = asyncio.create_task(out.play(utterance(500)))
+        await asyncio.sleep(0.05)
+        playing.cancel()
+        await asyncio.gather(playing, return_exceptions=True)
+        await asyncio.sleep(0.05)
+        cancelled_cleared = out._queue.empty() and out.source.queued_duration == 0
+
+        await out.aclose()
+        return old_room.publishes, new_room.publishes, old_times, new_times, completed, cleared, cancelled_cleared, out.stats()
+
+    old_publishes, new_publishes, old_times, new_times, completed, cleared, cancelled_cleared, stats = asyncio.run(run())
+    print(f"{'path':<22}{'publishes':>10}{'p50 ms':>9}{'max ms':>9}")
+    for label, publishes, times in (("track per utterance", old_publishes, old_times),
+                                    ("session AudioOutput", new_publishes, new_times)):
+        print(f"{label:<22}{publishes:>10}{_percentile(times, 50) * 1000:>9.1f}{max(times) * 1000:>9.1f}")
+    saved = (_percentile(old_times, 50) - _percentile(new_times, 50)) * 1000
+    print(f"\nsaved per utterance (p50): {saved:.1f} ms over {args.utterances} utterances")
+    print(f"stats: {json.dumps(stats)}")
+    checks = [
+        ("one publish per session", new_publishes == 1),
+        ("interrupt stops the utterance", completed is False),
+        ("interrupt clears queued audio", cleared),
+        ("cancelled turn clears queued audio", cancelled_cleared),
+    ]
+    for name, ok in checks:
+        print(f"{'PASS' if ok else 'FAIL'}  {name}")
+    if not all(ok for _, ok in checks):
+        sys.exit(1)
+
+
+def _synthetic_screen_rgb(width: int, height: int, seed: int = 0, photo: bool = True):
+    """RGB array that looks like a screen share: white page, lines of 'text', optionally a photo panel."""
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    rgb = np.full((height, width, 3), 245, dtype=np.uint8)
+    rgb[:height // 14] = (40, 44, 52)  # Title bar
+    panel = width * 2 // 3 if photo else width
+    for top in range(height // 10, height - 20, 22):
+        x = 40
+        while x < panel - 80:
+            word = int(rng.integers(20, 90))
+            rgb[top:top + 12, x:x + word] = rng.integers(0, 80)
+            x += word + 10
+    if photo:
+        # Photo-like panel (image viewer / video): smooth gradient plus sensor noise
+        rows, cols = height - height // 14, width - panel
+        gradient = np.linspace(0, 1, cols)[None, :, None] * np.array([120, 60, -80]) + np.array([40, 100, 170])
+        noise = rng.normal(0, 6, (rows, cols, 3))
+        rgb[height // 14:, panel:] = np.clip(gradient + noise, 0, 255).astype(np.uint8)
+    return rgb
+
+
+def _i420(rgb):
+    from livekit import rtc
+    height, width = rgb.shape[:2]
+    return rtc.VideoFrame(width, height, rtc.VideoBufferType.RGB24, rgb.tobytes()).convert(rtc.VideoBufferType.I420)
+
+
+def _synthetic_screen(width: int, height: int, seed: int = 0, photo: bool = True):
+    return _i420(_synthetic_screen_rgb(width, height, seed, photo))
+
+
+def bench_vision(args):
+    """On-demand full-res conversion (old path) vs sampled, pre-encoded JPEG snapshots."""
+    import io
+    from livekit import rtc
+    from PIL import Image
+    from vision import VisionFrameService
+
+    def old_path(frame):
+        # At the moment the user says "look": RGBA convert + PIL RGB copy, then the SDK
+        # encodes the full-size PIL image as PNG (google.genai pil_to_blob)
+        rgba = frame.convert(rtc.VideoBufferType.RGBA)
+        image = Image.frombytes("RGBA", (rgba.width, rgba.height), rgba.data).convert("RGB")
+        out = io.BytesIO()
+        image.save(out, "PNG")
+        return len(out.getvalue())
+
+    async def sampled(frames):
+        service = VisionFrameService()
+        take_ms = []
+        for frame in frames:
+            await service.add_frame(frame)  # In the background, every `interval` seconds
+            start = time.perf_counter()
+            service.mark_sent(service.take())
+            take_ms.append((time.perf_counter() - start) * 1000)
+        return service, take_ms
+
+    print(f"{args.width}x{args.height} screen frames, {args.frames} samples per content type\n")
+    print(f"{'content':<8}{'path':<22}{'on request ms':>15}{'background ms':>15}{'upload KB':>11}")
+    for content, photo in (("text", False), ("mixed", True)):
+        frames = [_synthetic_screen(args.width, args.height, seed, photo) for seed in range(args.frames)]
+        old_ms, old_bytes = [], []
+        for frame in frames:
+            start = time.perf_counter()
+            old_bytes.append(old_path(frame))
+            old_ms.append((time.perf_counter() - start) * 1000)
+        service, take_ms = asyncio.run(sampled(frames))
+        stats = service.stats()
+        print(f"{content:<8}{'full-res PIL -> PNG':<22}{_percentile(old_ms, 50):>15.1f}{'-':>15}"
+              f"{_percentile(old_bytes, 50) / 1024:>11.1f}")
+        print(f"{content:<8}{'sampled JPEG ring':<22}{_percentile(take_ms, 50):>15.3f}{stats['convert_ms_avg']:>15.1f}"
+              f"{stats['upload_bytes'] / stats['sent'] / 1024:>11.1f}")
+    print(f"\nsent size: {stats['size']}; background conversions: one per {service.interval:g}s whatever the stream fps")
+    print(f"stats: {json.dumps(stats)}")
+
+
+def _dhash(frame, bits: int = 8) -> int:
+    """64-bit difference hash of a frame's luma plane (the usual perceptual-hash baseline)."""
+    from PIL import Image
+    luma = Image.frombuffer("L", (frame.width, frame.height), memoryview(frame.data)[:frame.width * frame.height],
+                            "raw", "L", 0, 1)
+    pixels = luma.resize((bits + 1, bits), Image.BOX).tobytes()
+    value = 0
+    for row in range(bits):
+        for col in range(bits):
+            value = value << 1 | (pixels[row * (bits + 1) + col] > pixels[row * (bits + 1) + col + 1])
+    return value
+
+
+def bench_scene_change(args):
+    """Change detection accuracy on a synthetic screen-share sequence, and what reuse saves."""
+    import numpy as np
+    from vision import VisionFrameService, encode_frame, scene_changed
+
+    w, h = args.width, args.height
+    rng = np.random.default_rng(7)
+
+    def codec_noise(rgb):
+        return np.clip(rgb.astype(np.int16) + rng.integers(-3, 4, rgb.shape), 0, 255).astype(np.uint8)
+
+    base = _synthetic_screen_rgb(w, h, seed=1, photo=False)
+    caret = base.copy()
+    caret[h // 2:h // 2 + 18, w // 3:w // 3 + 2] = 0
+    typed = base.copy()
+    typed[h - 60:h - 48, 40:100] = 20  # One new word at the bottom
+    scrolled = np.roll(typed, -22, axis=0)
+    other_window = _synthetic_screen_rgb(w, h, seed=2, photo=True)
+    photo_noise = other_window.copy()
+    photo_noise[h // 14:, w * 2 // 3:] = codec_noise(photo_noise[h // 14:, w * 2 // 3:])
+
+    # (label, frame, changed vs previous step)
+    sequence = [
+        ("first frame", base, True),
+        ("codec noise", codec_noise(base), False),
+        ("codec noise", codec_noise(base), False),
+        ("caret blink", caret, False),
+        ("caret blink", base, False),
+        ("typed word", typed, True),
+        ("codec noise", codec_noise(typed), False),
+        ("scroll 22 px", scrolled, True),
+        ("codec noise", codec_noise(scrolled), False),
+        ("window switch", other_window, True),
+        ("photo noise", photo_noise, False),
+        ("codec noise", codec_noise(other_window), False),
+    ]
+    frames = [_i420(rgb) for _, rgb, _ in sequence]
+
+    snapshots = [encode_frame(frame) for frame in frames]
+    diff_says = [True] + [scene_changed(b.signature, a.signature) for a, b in zip(snapshots, snapshots[1:])]
+    hashes = [_dhash(frame) for frame in frames]
+    dhash_says = [True] + [bin(a ^ b).count("1") > 2 for a, b in zip(hashes, hashes[1:])]
+
+    print(f"{'step':<16}{'truth':>8}{'diff':>8}{'dHash':>8}")
+    for (label, _, truth), diff, dhash in zip(sequence, diff_says, dhash_says):
+        mark = lambda said: ("chg" if said else "same") + ("" if said == truth else "!")
+        print(f"{label:<16}{mark(truth):>8}{mark(diff):>8}{mark(dhash):>8}")
+    truths = [truth for _, _, truth in sequence]
+    for name, said in (("downsampled diff", diff_says), ("dHash (64 bit)", dhash_says)):
+        misses = sum(t and not s for t, s in zip(truths, said))
+        false_alarms = sum(s and not t for t, s in zip(truths, said))
+        print(f"{name:<18} missed changes: {misses}  false changes: {false_alarms}")
+
+    start = time.perf_counter()
+    for _ in range(200):
+        scene_changed(snapshots[1].signature, snapshots[0].signature)
+    compare_us = (time.perf_counter() - start) / 200 * 1e6
+
+    # A vision turn at every step: send the JPEG every time vs attach an uploaded copy while unchanged
+    image_tokens = 258  # Gemini: one image tile up to 768x768 (same whether inline or by file reference)
+
+    async def turns():
+        service = VisionFrameService()
+        for i, frame in enumerate(frames):
+            await service.add_frame(frame)
+            snapshot = service.take()
+            if service.prior_upload(snapshot) is None:
+                service.mark_sent(snapshot, f"files/bench-{i}")  # Stand-in for brain.upload_image
+        return service
+
+    service = asyncio.run(turns())
+    stats = service.stats()
+    always_bytes = sum(len(snapshot.jpeg) for snapshot in snapshots)
+    reuse_bytes = stats["upload_bytes"]  # One file upload per distinct scene
+    print(f"\n{len(frames)} vision turns at {w}x{h}, compare cost {compare_us:.1f} us")
+    print(f"{'policy':<18}{'image uploads':>15}{'upload KB':>11}{'vision tokens':>15}")
+    print(f"{'always send':<18}{len(frames):>15}{always_bytes / 1024:>11.1f}{len(frames) * image_tokens:>15}")
+    print(f"{'reuse unchanged':<18}{stats['sent']:>15}{reuse_bytes / 1024:>11.1f}{len(frames) * image_tokens:>15}")
+    print(f"sampler: {stats['unchanged_samples']} of {stats['sampled']} samples reused the previous JPEG")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ALAN backend benchmarks")
+    sub = parser.add_subparsers(dest="bench", required=True)
+
+    p = sub.add_parser("tts", help="Time-to-first-frame and peak RSS for EdgeTTS playback")
+    p.add_argument("--voice", default=None)
+    p.set_defaults(func=bench_tts)
+
+    p = sub.add_parser("memory-pool", help="AlanMemory ops/sec: connect-per-call vs pooled connections")
+    p.add_argument("--ops", type=int, default=2000)
+    p.set_defaults(func=bench_memory_pool)
+
+    p = sub.add_parser("memory-search", help="FTS recall latency percentiles over synthetic episodic memory")
+    p.add_argument("--rows", type=int, default=1_000_000)
+    p.add_argument("--queries", type=int, default=500)
+    p.add_argument("--k", type=int, default=5)
+    p.set_defaults(func=bench_memory_search)
+
+    p = sub.add_parser("backend-reuse", help="Check cloud clients reuse one keep-alive connection (local stand-in)")
+    p.add_argument("--requests", type=int, default=50)
+    p.set_defaults(func=bench_backend_reuse)
+
+    p = sub.add_parser("response-cache", help="Hit rate and lookup latency for the exact and semantic cache tiers")
+    p.add_argument("--turns", type=int, default=2000)
+    p.add_argument("--threshold", type=float, default=0.9)
+    p.set_defaults(func=bench_response_cache)
+
+    p = sub.add_parser("prompt-prefix", help="Local prompt tokens re-evaluated per turn: recall/history layout vs KV prefix reuse")
+    p.add_argument("--turns", type=int, default=60)
+    p.add_argument("--budget", type=int, default=900)
+    p.set_defaults(func=bench_prompt_prefix)
+
+    p = sub.add_parser("intent", help="Accuracy and latency of intent routing on a labelled fixture set")
+    p.add_argument("--repeat", type=int, default=2000)
+    p.add_argument("--verbose", action="store_true")
+    p.set_defaults(func=bench_intent)
+
+    p = sub.add_parser("scheduler", help="Priority ordering, coalescing, preemption and queue waits with a fake handler")
+    p.add_argument("--turn-ms", type=int, default=200)
+    p.set_defaults(func=bench_scheduler)
+
+    p = sub.add_parser("vad", help="VAD CPU per second of audio and fallback rate on synthetic speech")
+    p.add_argument("--seconds", type=float, default=30.0)
+    p.set_defaults(func=bench_vad)
+
+    p = sub.add_parser("audio-alloc", help="Per-frame allocations on the speech accumulation path (tracemalloc)")
+    p.add_argument("--seconds", type=float, default=20.0)
+    p.set_defaults(func=bench_audio_alloc)
+
+    p = sub.add_parser("resample", help="Realtime factor and quality of 48k -> 16k mono: audioop vs stateful resampler")
+    p.add_argument("--seconds", type=float, default=20.0)
+    p.set_defaults(func=bench_resample)
+
+    p = sub.add_parser("pcm-cache", help="Time to first frame for a stock phrase: TTS miss vs memory / disk cache hits")
+    p.add_argument("--repeat", type=int, default=20)
+    p.set_defaults(func=bench_pcm_cache)
+
+    p = sub.add_parser("audio-output", help="One publish per session and per-utterance latency saved vs a track per reply")
+    p.add_argument("--utterances", type=int, default=20)
+    p.add_argument("--publish-ms", type=float, default=120.0)
+    p.set_defaults(func=bench_audio_output)
+
+    p = sub.add_parser("vision", help="On-request cost and upload bytes: full-res frame conversion vs sampled JPEG snapshots")
+    p.add_argument("--width", type=int, default=1920)
+    p.add_argument("--height", type=int, default=1080)
+    p.add_argument("--frames", type=int, default=10)
+    p.set_defaults(func=bench_vision)
+
+    p = sub.add_parser("scene-change", help="Screen change detection (diff vs dHash) and upload savings from reusing unchanged screens")
+    p.add_argument("--width", type=int, default=1920)
+    p.add_argument("--height", type=int, default=1080)
+    p.set_defaults(func=bench_scene_change)
+
+    p = sub.add_parser("dispatch", help="Fallback, timeout, hedging, routing, circuit-breaker and cancellation checks with fake backends")
+    p.set_defaults(func=bench_dispatch)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,19 @@
 import logging
+import io
 import json
 import os
 
 # import google.generativeai as genai # Deprecated
 from enum import Enum
 import asyncio
+import threading
+from contextlib import aclosing
 from memory import AlanMemory
+from retention import RetentionEngine, RetentionPolicy
+from context_builder import ContextBuilder, approx_tokens, flatten_messages
+from local_llm import LocalSession
+from response_cache import ResponseCache
+from backends import BackendRegistry, Backend, Dispatcher, AllBackendsFailed, GEMINI_MODEL, OPENROUTER_MODEL
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -13,6 +21,9 @@ load_dotenv()
 
 logger = logging.getLogger("alan.brain")
 
+# Spoken when no backend produced anything
+UNAVAILABLE_REPLY = "I am unable to process that request safely explicitly."
+
 class AgentRole(Enum):
     PLANNER = "planner"
     WORKER = "worker"
@@ -22,9 +33,24 @@ class AlanBrain:
     def __init__(self):
         self.mode = "fast" 
         self.memory = AlanMemory()
+        # Episodic retention runs on its own thread once started (see agent.prewarm)
+        self.retention = RetentionEngine(self.memory, RetentionPolicy.from_env())
+        # Token-budgeted prompt assembly (system + history + current turn)
+        self.context = ContextBuilder(budget_tokens=int(os.getenv("ALAN_CONTEXT_TOKENS", 3000)), drop_block=4)
+        # Finished replies to repeated questions (exact, optionally semantic)
+        self.response_cache = ResponseCache.from_env(self.memory)
+        # Cloud clients are built once and keep their connection pools warm
+        self.backends = BackendRegistry()
+        # Per-backend timeouts, latency-driven hedging and routing (see backend_stats())
+        self.dispatcher = Dispatcher([
+            Backend("local", self._stream_local, first_token_timeout=30.0),
+            Backend("gemini", self._stream_gemini, first_token_timeout=10.0),
+            Backend("openrouter", self._stream_openrouter, first_token_timeout=15.0),
+        ], hedge=os.getenv("ALAN_HEDGE", "1") != "0")
         
         # Local Model Setup
         self.local_model = None
+        self.local_session = None
         self.model_path = os.path.join(os.path.dirname(__file__), "models/Qwen3-14B-Gemini-3-Pro-Preview-Distill.q4_k_m.gguf")
         
         try:
@@ -37,6 +63,8 @@ class AlanBrain:
                     n_ctx=8192,      # Decent context window
                     verbose=True
                 )
+                # Reuses the evaluated prompt prefix / KV state across turns
+                self.local_session = LocalSession(self.local_model, int(os.getenv("ALAN_LLM_STATE_CACHE_MB", 0)))
                 logger.info("Local Qwen3 Model Loaded Successfully.")
             else:
                 logger.warning(f"Local model not found at {self.model_path}. Using Cloud APIs.")
@@ -48,18 +76,37 @@ class AlanBrain:
         Core reasoning loop.
         Accepts: str OR UnifiedInputEvent
         """
+        text = self._route(user_input)
+        history = self._history(text)
+
+        # Dispatch
+        if self.mode == "deep":
+            return await self._think_deep(text, images, history)
+        elif self.mode == "debug":
+            return await self._think_debug(text, images, history)
+        else:
+            return await self._think_fast(text, images, history)
+
+    async def think_stream(self, user_input, agent_ctx, images: list = None):
+        """
+        Streaming variant of think().
+        Async generator yielding text deltas as the backend produces them.
+        """
+        text = self._route(user_input)
+        history = self._history(text)
+        recall = self._recall(text, history) if self.mode == "fast" else None
+        async with aclosing(self._generate_stream(self._system_prompt(), text, images, history, recall)) as deltas:
+            async for delta in deltas:
+                yield delta
+
+    def _route(self, user_input) -> str:
+        """Unpacks the input, picks the mode and logs the user turn."""
         # 0. Unpack Input
         if hasattr(user_input, "normalized"):
             text = user_input.normalized
             source = user_input.source
-            # Check flags/intent for Mode
-            # Simple heuristic: if "deeply" or "analyze" in text, user DEEP mode
-            if "deep" in text.lower() or "plan" in text.lower():
-                self.mode = "deep"
-            elif "debug" in text.lower() or "error" in text.lower():
-                self.mode = "debug"
-            else:
-                self.mode = "fast"
+            # Mode comes from the input processor's intent stage
+            self.mode = user_input.intent if user_input.intent in ("deep", "debug") else "fast"
         else:
             text = str(user_input)
             source = "text"
@@ -67,36 +114,68 @@ class AlanBrain:
 
         logger.info(f"Thinking [{self.mode.upper()}] about: {text} [{source}]")
         self.memory.log_interaction("user", text)
+        return text
 
-        # Dispatch
+    def _history(self, text: str) -> list:
+        """
+        Recent turns for the context builder, minus the user turn just logged.
+        The window grows from 20 to 29 turns and then drops 10 at once, so the history
+        prefix the local model has evaluated stays valid for most turns.
+        """
+        history = self.memory.get_recent_history(limit=20, align=10)
+        if history and history[-1] == {"role": "user", "content": text}:
+            history = history[:-1]
+        return history
+
+    def _system_prompt(self) -> str:
         if self.mode == "deep":
-            return await self._think_deep(text, images)
+            return self._deep_prompt()
         elif self.mode == "debug":
-            return await self._think_debug(text, images)
+            return self._debug_prompt()
         else:
-            return await self._think_fast(text, images)
+            return self._fast_prompt()
 
-    async def _think_fast(self, text: str, images: list = None) -> str:
+    async def _think_fast(self, text: str, images: list = None, history: list = None) -> str:
         """Standard single-pass response (Gemini Flash)."""
-        history = self.memory.get_recent_history(limit=5)
+        return await self._generate(self._fast_prompt(), text, images, history, self._recall(text, history))
+
+    async def _think_deep(self, text: str, images: list = None, history: list = None) -> str:
+        """Chain-of-Thought / Planning Mode."""
+        return await self._generate(self._deep_prompt(), text, images, history)
+
+    async def _think_debug(self, text: str, images: list = None, history: list = None) -> str:
+        """Forensic Mode."""
+        return await self._generate(self._debug_prompt(), text, images, history)
+
+    def _fast_prompt(self) -> str:
         personality = self.memory.get_personality()
         prefs = self.memory.get_long_term("user_preferences")
         
-        system_prompt = (
+        return (
             "You are ALAN. "
             "Role: Advanced AI Assistant. "
             f"Traits: {json.dumps(personality)}. "
             f"User Preferences: {json.dumps(prefs)}. "
-            f"Context: {len(history)} recent messages. "
             "Instruction: Reply directly to the user, adhering to your personality traits."
         )
-        return await self._generate(system_prompt, text, images)
 
-    async def _think_deep(self, text: str, images: list = None) -> str:
-        """Chain-of-Thought / Planning Mode."""
+    def _recall(self, text: str, history: list = None):
+        """
+        Older turns relevant to this request (FTS recall beyond the recent window), as a note
+        the context builder places right before the user turn: it changes every turn, so it
+        must come after the system prompt and history the local KV cache can reuse.
+        """
+        # Skip the history window and the user turn just logged: they're in the prompt already
+        recalled = [m for m in self.memory.search(text, k=3, exclude_recent=len(history or []) + 1)
+                    if m["content"] != text]
+        if not recalled:
+            return None
+        return f"Relevant Memories: {json.dumps([{'role': m['role'], 'content': m['content']} for m in recalled])}."
+
+    def _deep_prompt(self) -> str:
         personality = self.memory.get_personality()
         
-        system_prompt = (
+        return (
             "You are ALAN in DEEP THINKING MODE. "
             f"Traits: {json.dumps(personality)}. "
             "Instruction: First, analyze the user's request step-by-step. "
@@ -107,94 +186,181 @@ class AlanBrain:
             "**Plan**: ... "
             "**Solution**: ..."
         )
-        return await self._generate(system_prompt, text, images)
 
-    async def _think_debug(self, text: str, images: list = None) -> str:
-        """Forensic Mode."""
-        system_prompt = (
+    def _debug_prompt(self) -> str:
+        return (
             "You are ALAN in DEBUG MODE. "
             "Instruction: Analyze the input as a technical problem. "
             "Look for keywords indicating errors, crashes, or anomalies. "
             "Suggest potential fixes or diagnostic steps. "
             "Be terse and technical."
         )
-        return await self._generate(system_prompt, text, images)
 
-    async def _generate(self, system_prompt: str, user_input: str, images: list = None) -> str:
+    def _local_messages(self, system_prompt: str, user_input: str, history: list = None, recall: str = None) -> list:
+        return self.context.build(system_prompt, user_input, history, count_tokens=self.local_session.count_tokens,
+                                  note=recall)
+
+    def _cloud_messages(self, system_prompt: str, user_input: str, history: list = None, recall: str = None) -> list:
+        return self.context.build(system_prompt, user_input, history, count_tokens=approx_tokens, note=recall)
+
+    async def _generate(self, system_prompt: str, user_input: str, images: list = None, history: list = None,
+                        recall: str = None) -> str:
         """Shared Generation Logic with Fallback."""
-        
-        # 1. Local Model (Priority, if no images)
+        parts = []
+        async with aclosing(self._generate_stream(system_prompt, user_input, images, history, recall)) as deltas:
+            async for delta in deltas:
+                parts.append(delta)
+        return "".join(parts)
+
+    async def _generate_stream(self, system_prompt: str, user_input: str, images: list = None, history: list = None,
+                               recall: str = None):
+        """
+        Streams the reply from whichever backend answers first (or the response cache).
+        Order: Local Qwen3 (text-only) -> Gemini -> OpenRouter; the dispatcher falls back
+        on errors/timeouts and hedges with the next backend when one runs past its p95.
+        """
         # Note: Current GGUF setup implies text-only unless we add vision adapters.
-        if self.local_model and not images:
-            try:
-                logger.info("Using Local Qwen3 Model...")
-                messages = [
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_input}
-                ]
-                
-                # Run blocking inference in thread
-                response = await asyncio.to_thread(
-                    self.local_model.create_chat_completion,
-                    messages=messages,
-                    max_tokens=512,
-                    temperature=0.7
-                )
-                
-                text_response = response["choices"][0]["message"]["content"]
-                self.memory.log_interaction("assistant", text_response)
-                return text_response
-            except Exception as e:
-                logger.error(f"Local model inference failed: {e}. Falling back to Cloud.")
-
-        # 2. Cloud APIs (Gemini / OpenRouter)
+        names = ["gemini", "openrouter"]
+        if self.local_session and not images:
+            names.insert(0, "local")
+
+        mode = self.mode
+        version = self.memory.config_version()
+        cached = self.response_cache.get(user_input, mode, version, images, history)
+        if cached is not None:
+            self.memory.log_interaction("assistant", cached)
+            yield cached
+            return
+
+        parts = []
+        completed = False
         try:
-            from google import genai
-            api_key = os.getenv("GOOGLE_API_KEY1") or os.getenv("GOOGLE_API_KEY")
-            client = genai.Client(api_key=api_key)
-            
-
-            
-            content_payload = [f"{system_prompt}\n\nUser: {user_input}"]
-            if images:
-                # Assuming images are already in a format Gemini accepts (PIL Image or similar)
-                content_payload.extend(images)
-
-            response = client.models.generate_content(
-                model="gemini-2.0-flash-exp",
-                contents=content_payload
-            )
-            text_response = response.text
-            self.memory.log_interaction("assistant", text_response)
-            return text_response
-            
-        except Exception as google_e:
-            logger.warning(f"Google Brain error: {google_e}. Switch to OpenRouter...")
-            try:
-                # OPENROUTER FALLBACK
-                from openai import OpenAI
-                or_key = os.getenv("OPENROUTER_API")
-                if not or_key:
-                    raise Exception("No OPENROUTER_API key configured.")
-
-                client = OpenAI(
-                    base_url="https://openrouter.ai/api/v1",
-                    api_key=or_key,
-                )
-                
-                completion = client.chat.completions.create(
-                    model="meta-llama/llama-3.2-3b-instruct:free",
-                    messages=[
-                        {"role": "system", "content": system_prompt},
-                        {"role": "user", "content": user_input}
-                    ]
-                )
-                text_response = completion.choices[0].message.content
-                self.memory.log_interaction("assistant", text_response)
-                return text_response
-                
-            except Exception as e:
-                logger.error(f"Brain total freeze: {e}")
-                return "I am unable to process that request safely explicitly."
+            async with aclosing(self.dispatcher.stream(names, system_prompt, user_input, images, history,
+                                                              recall)) as deltas:
+                async for delta in deltas:
+                    parts.append(delta)
+                    yield delta
+            completed = True
+        except AllBackendsFailed as e:
+            logger.error(f"Brain total freeze: {e}")
+        except Exception as e:
+            # Already spoken/published text can't be retracted; keep what we have
+            logger.error(f"Stream broke mid-reply: {e}")
+
+        if parts:
+            reply = "".join(parts)
+            self.memory.log_interaction("assistant", reply)
+            if completed:
+                await asyncio.to_thread(self.response_cache.put, user_input, mode, version, reply, images, history)
+        else:
+            yield UNAVAILABLE_REPLY
 
+    async def upload_image(self, jpeg: bytes):
+        """
+        Uploads an encoded frame to the Gemini Files API and returns a Part referencing it;
+        the turn attaches the Part, and so do later turns while the screen is unchanged.
+        None if the upload fails (callers then send the bytes inline).
+        """
+        from google.genai import types
+        try:
+            file = await self.backends.gemini().aio.files.upload(
+                file=io.BytesIO(jpeg), config=types.UploadFileConfig(mime_type="image/jpeg"))
+            return types.Part.from_uri(file_uri=file.uri, mime_type=file.mime_type or "image/jpeg")
+        except Exception as e:
+            logger.warning(f"Image upload failed: {e}")
+            return None
+
+    def backend_stats(self) -> dict:
+        """Rolling per-backend latency/error stats plus HTTP pool timings."""
+        return {"dispatch": self.dispatcher.stats(), "http": self.backends.stats()}
+
+    async def _stream_local(self, system_prompt: str, user_input: str, images: list = None, history: list = None,
+                            recall: str = None):
+        logger.info("Streaming from Local Qwen3 Model...")
+        messages = self._local_messages(system_prompt, user_input, history, recall)
+        cancel = threading.Event()
+        chunks = lambda: self.local_session.stream(
+            messages,
+            max_tokens=512,
+            temperature=0.7,
+            cancel=cancel
+        )
+        try:
+            async for delta in _iterate_in_thread(chunks):
+                yield delta
+        finally:
+            # Barge-in / preemption: llama_cpp stops at the next token instead of finishing the reply
+            cancel.set()
+
+    async def _stream_gemini(self, system_prompt: str, user_input: str, images: list = None, history: list = None,
+                             recall: str = None):
+        client = self.backends.gemini()
+
+        content_payload = [flatten_messages(self._cloud_messages(system_prompt, user_input, history, recall))]
+        if images:
+            from google.genai import types
+            # Encoded frames (vision.VisionFrameService) go up as-is; file Parts (upload_image) and
+            # PIL images are passed to the SDK unchanged
+            content_payload.extend(
+                types.Part.from_bytes(data=image, mime_type="image/jpeg") if isinstance(image, bytes) else image
+                for image in images)
+
+        stream = await client.aio.models.generate_content_stream(
+            model=GEMINI_MODEL,
+            contents=content_payload
+        )
+        async with aclosing(stream) as chunks:
+            async for chunk in chunks:
+                if chunk.text:
+                    yield chunk.text
+
+    async def _stream_openrouter(self, system_prompt: str, user_input: str, images: list = None, history: list = None,
+                                 recall: str = None):
+        client = self.backends.openrouter()
+        stream = await client.chat.completions.create(
+            model=OPENROUTER_MODEL,
+            messages=self._cloud_messages(system_prompt, user_input, history, recall),
+            stream=True
+        )
+        async with stream:
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+
+
+class _StreamError:
+    def __init__(self, error: Exception):
+        self.error = error
+
+
+_STREAM_DONE = object()
+
+
+async def _iterate_in_thread(make_iterator):
+    """
+    Drives a blocking iterator (local llama_cpp generation) on a worker thread
+    and yields its items on the event loop as they arrive.
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    stop = threading.Event()
+
+    def pump():
+        try:
+            for item in make_iterator():
+                if stop.is_set():
+                    break
+                loop.call_soon_threadsafe(queue.put_nowait, item)
+            loop.call_soon_threadsafe(queue.put_nowait, _STREAM_DONE)
+        except Exception as e:
+            loop.call_soon_threadsafe(queue.put_nowait, _StreamError(e))
 
+    loop.run_in_executor(None, pump)
+    try:
+        while (item := await queue.get()) is not _STREAM_DONE:
+            if isinstance(item, _StreamError):
+                raise item.error
+            yield item
+    finally:
+        # Consumer stopped early: let the worker drop the rest of the stream
+        stop.set()
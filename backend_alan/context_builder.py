@@ -0,0 +1,88 @@
+import logging
+
+from retention import extractive_summary
+
+logger = logging.getLogger("alan.context")
+
+# Per-message framing cost (role markers, separators) in chat templates
+MESSAGE_OVERHEAD = 4
+
+
+def approx_tokens(text: str) -> int:
+    """Fast approximate counter: ~4 characters per token for English text."""
+    return len(text) // 4 + 1
+
+
+class ContextBuilder:
+    """
+    Assembles the system prompt, history turns and the current user turn into a
+    chat message list that fits a token budget. The newest turns are kept; older
+    turns that don't fit are folded into a one-line summary on the system prompt,
+    `drop_block` turns at a time so the kept prefix doesn't shift every turn.
+    Per-turn context (`note`, e.g. recalled memories) goes in a system message right
+    before the user turn, after everything that stays the same between turns.
+    """
+    def __init__(self, budget_tokens: int = 3000, reply_reserve: int = 512, summary_chars: int = 400,
+                 drop_block: int = 1):
+        self.budget_tokens = budget_tokens
+        self.reply_reserve = reply_reserve
+        self.summary_chars = summary_chars
+        self.drop_block = max(1, drop_block)
+        self.last_stats = {}
+
+    def build(self, system_prompt: str, user_input: str, history: list = None, count_tokens=None,
+              note: str = None) -> list:
+        count = count_tokens or approx_tokens
+        history = history or []
+
+        cost = lambda text: count(text) + MESSAGE_OVERHEAD
+        used = cost(system_prompt) + cost(user_input) + self.reply_reserve
+        if note:
+            used += cost(note)
+
+        # Newest first until the budget runs out
+        kept = []
+        for turn in reversed(history):
+            turn_cost = cost(turn["content"])
+            if used + turn_cost > self.budget_tokens:
+                break
+            kept.append(turn)
+            used += turn_cost
+        kept.reverse()
+        # Round the cut up to a whole block
+        while kept and (len(history) - len(kept)) % self.drop_block:
+            used -= cost(kept.pop(0)["content"])
+        dropped = history[:len(history) - len(kept)]
+
+        if dropped:
+            summary = extractive_summary([(t["role"], t["content"]) for t in dropped], self.summary_chars)
+            summary_note = f" Earlier in this conversation the user asked about: {summary}." if summary else ""
+            # Make room for the summary by giving up the oldest kept turns (whole blocks) if needed
+            while summary_note and kept and used + count(summary_note) > self.budget_tokens:
+                used -= cost(kept.pop(0)["content"])
+                while kept and (len(history) - len(kept)) % self.drop_block:
+                    used -= cost(kept.pop(0)["content"])
+            if summary_note and used + count(summary_note) <= self.budget_tokens:
+                system_prompt += summary_note
+                used += count(summary_note)
+
+        messages = [{"role": "system", "content": system_prompt}]
+        messages.extend({"role": t["role"], "content": t["content"]} for t in kept)
+        if note:
+            messages.append({"role": "system", "content": note})
+        messages.append({"role": "user", "content": user_input})
+
+        self.last_stats = {
+            "prompt_tokens": used - self.reply_reserve,
+            "history_turns": len(kept),
+            "dropped_turns": len(history) - len(kept),
+        }
+        return messages
+
+
+def flatten_messages(messages: list) -> str:
+    """Renders a message list as a single prompt for text-only APIs (Gemini contents)."""
+    system, turns = messages[0]["content"], messages[1:]
+    speaker = {"user": "User: ", "system": ""}
+    lines = [f"{speaker.get(m['role'], 'ALAN: ')}{m['content']}" for m in turns]
+    return system + "\n\n" + "\n".join(lines)
@@ -1,4 +1,5 @@
 import logging
+import re
 import uuid
 import datetime
 from pydantic import BaseModel, Field
@@ -45,11 +46,109 @@ class UnifiedInputEvent(BaseModel):
     class Config:
         use_enum_values = True
 
+# --- INTENT ---
+
+class Intent(str, Enum):
+    FAST = "fast"    # Default conversational reply
+    DEEP = "deep"    # Planning / analysis (expensive chain-of-thought prompt)
+    DEBUG = "debug"  # Technical fault finding
+
+VISION_FLAG = "vision" # The turn refers to what's on screen / camera
+
+def _words(*patterns: str):
+    return re.compile(r"\b(?:" + "|".join(patterns) + r")\b")
+
+class IntentClassifier:
+    """
+    Rule-based intent stage over lowercased text: each intent is a few compiled alternations, with a second
+    alternation of idioms that contain a trigger word but don't mean it
+    ("deeply sorry", "see you", "trial and error"). Runs in a few microseconds.
+    Deep/debug are expensive prompts, so a single everyday word ("plan", "compare", "failed", "broken")
+    isn't enough: strong phrases score 2, weak words 1 (+1 with a topic word nearby), and an intent
+    needs MIN_SCORE.
+    """
+    MIN_SCORE = 2
+
+    DEEP = _words(
+        r"step[- ]by[- ]step", r"analy[sz](?:e|is|ing)", r"in[- ]depth", r"strateg(?:y|ies|ize)",
+        r"deep(?:ly)? (?:dive|analysis|think|thinking|look|consider)", r"think (?:it |this )?through",
+        r"break (?:it|this|that) down", r"pros and cons", r"trade-?offs?", r"roadmap", r"design (?:a|an|the)",
+        r"think (?:deeply|hard|carefully)", r"(?:help me|let'?s|can you|could you|please) plan",
+        r"(?:make|create|draft|write|build) (?:me )?(?:a|an) (?:\w+ )?plan", r"plan (?:out )?(?:my|our) ",
+        r"compare \w+(?: \w+)? (?:and|with|to|vs\.?|versus) ",
+    )
+    DEEP_WEAK = _words(r"plan(?:s|ning)?", r"compare", r"comparison", r"architect(?:ure)?")
+    DEEP_TOPICS = _words(
+        r"between", r"versus", r"vs", r"options", r"alternatives", r"approach(?:es)?", r"long[- ]term",
+        r"migration", r"career", r"business", r"startup", r"budget", r"system", r"project",
+    )
+    DEEP_IDIOMS = _words(
+        r"deep(?:ly)? (?:sorry|grateful|appreciate\w*|regret\w*)", r"deep breath", r"(?:my|your|our|the) plans? (?:for|today|tonight|tomorrow)",
+        r"(?:any|what are (?:my|your|our)) plans",
+    )
+    DEBUG = _words(
+        r"debug(?:ging)?", r"errors?", r"\w+(?:error|exception)", r"exceptions?", r"traceback", r"stack ?trace",
+        r"segfault", r"not working", r"exit code", r"stderr", r"null ?pointer", r"tim(?:ed|ing|es)? ?out",
+        r"(?:doesn'?t|does not|won'?t|will not|can'?t|cannot) (?:work|start|run|compile|build|load|connect)",
+        r"(?:keeps?|kept) (?:crashing|failing|freezing|hanging)",
+    )
+    DEBUG_WEAK = _words(
+        r"crash(?:es|ed|ing)?", r"bugs?", r"fail(?:s|ed|ing|ure)?", r"broken", r"undefined", r"freez(?:e|es|ing)",
+    )
+    DEBUG_TOPICS = _words(
+        r"server", r"apps?", r"application", r"script", r"code", r"program", r"builds?", r"deploy(?:ment)?",
+        r"install(?:er|ation)?", r"compil(?:e|er)", r"parser", r"database", r"db", r"api", r"endpoint",
+        r"request", r"function", r"pytest", r"unit tests?", r"test suite", r"ci", r"module", r"package",
+        r"dependenc(?:y|ies)", r"laptop", r"computer", r"pc", r"browser", r"wifi", r"network", r"router",
+        r"driver", r"docker", r"container", r"query", r"login", r"website",
+    )
+    DEBUG_IDIOMS = _words(
+        r"trial and error", r"error[- ]free", r"no errors?", r"fail(?:ed)? to mention", r"without fail",
+        r"human error", r"my (?:error|mistake)",
+    )
+    VISION = _words(
+        r"see", r"look(?:ing)?(?: at)?", r"screen(?:shot)?s?", r"display", r"monitor", r"camera", r"webcam",
+        r"on (?:my|the) (?:screen|display|page|window|tab)", r"this (?:page|window|tab|image|picture|photo|chart|diagram)",
+        r"what(?:'s| is) (?:this|that)", r"read (?:this|that|it) (?:out|for me)",
+    )
+    VISION_IDIOMS = _words(
+        r"see (?:you|ya)", r"(?:i|let me|let'?s|we'?ll|you'?ll) see", r"see(?:s|ing)? (?:if|whether|what happens)",
+        r"look(?:ing)? forward", r"look(?:s|ed)? like", r"look (?:it |that )?up", r"look after",
+    )
+
+    def classify(self, text: str):
+        """Returns (Intent, flags)."""
+        text = text.lower()
+        deep = self._score(text, self.DEEP, self.DEEP_IDIOMS, self.DEEP_WEAK, self.DEEP_TOPICS)
+        debug = self._score(text, self.DEBUG, self.DEBUG_IDIOMS, self.DEBUG_WEAK, self.DEBUG_TOPICS)
+        deep = deep if deep >= self.MIN_SCORE else 0
+        debug = debug if debug >= self.MIN_SCORE else 0
+        if debug > deep:
+            intent = Intent.DEBUG
+        elif deep:
+            intent = Intent.DEEP
+        else:
+            intent = Intent.FAST
+        flags = [VISION_FLAG] if self._score(text, self.VISION, self.VISION_IDIOMS) else []
+        return intent, flags
+
+    @staticmethod
+    def _score(text: str, pattern, idioms, weak=None, topics=None) -> int:
+        if idioms.search(text):
+            text = idioms.sub(" ", text)
+        score = 2 * len(pattern.findall(text))
+        if weak is not None:
+            weak_hits = len(weak.findall(text))
+            if weak_hits:
+                score += weak_hits + bool(topics.search(text))
+        return score
+
 # --- ADAPTERS ---
 
 class InputProcessor:
     def __init__(self):
         self.history = []
+        self.classifier = IntentClassifier()
 
     def process(self, source: InputSource, raw_input: Any, **kwargs) -> UnifiedInputEvent:
         """
@@ -70,11 +169,17 @@ class InputProcessor:
         elif source == InputSource.SYSTEM:
             self._process_system(event)
             
-        # 2. Global Safety/Guardrails (Stub)
+        # 2. Early intent classification (drives brain mode and vision uploads)
+        if source in (InputSource.TEXT, InputSource.VOICE):
+            intent, flags = self.classifier.classify(event.normalized)
+            event.intent = intent.value
+            event.flags = event.flags + flags
+
+        # 3. Global Safety/Guardrails (Stub)
         # if "shutdown" in event.normalized: event.priority = InputPriority.CRITICAL
 
-        # 3. Log
-        logger.info(f"Input Event [{event.priority.upper()}]: {event.normalized} ({event.source})")
+        # 4. Log
+        logger.info(f"Input Event [{event.priority.upper()}]: {event.normalized} ({event.source}, intent={event.intent}, flags={event.flags})")
         
         return event
 
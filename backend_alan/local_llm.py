@@ -0,0 +1,108 @@
+import logging
+import threading
+
+logger = logging.getLogger("alan.local_llm")
+
+# Fallback when the GGUF ships no chat template (Qwen models use ChatML)
+_CHATML_STOP = ["<|im_end|>", "<|endoftext|>"]
+
+
+def _chatml(messages: list) -> str:
+    prompt = "".join(f"<|im_start|>{m['role']}\n{m['content']}<|im_end|>\n" for m in messages)
+    return prompt + "<|im_start|>assistant\n"
+
+
+class LocalSession:
+    """
+    Persistent session over a llama_cpp model.
+    Prompts are rendered and tokenized here and passed to llama_cpp as tokens, so the
+    KV state left by the previous turn is reused for the longest shared prefix (the
+    system prompt and older history) and only the new suffix is evaluated.
+    Every request reports how many prompt tokens were served from the KV cache.
+    """
+    def __init__(self, model, state_cache_mb: int = 0):
+        self.model = model
+        self._lock = threading.Lock() # One generation at a time on the shared KV state
+        self._template = self._load_template()
+        if state_cache_mb > 0:
+            # Keeps KV snapshots of other prompts (e.g. deep/debug system prompts) across mode switches
+            from llama_cpp import LlamaRAMCache
+            model.set_cache(LlamaRAMCache(capacity_bytes=state_cache_mb << 20))
+        self.last_stats = {}
+        self.totals = {"requests": 0, "prompt_tokens": 0, "prefix_hit_tokens": 0}
+
+    def count_tokens(self, text: str) -> int:
+        return len(self.model.tokenize(text.encode("utf-8"), add_bos=False, special=True))
+
+    def complete(self, messages: list, max_tokens: int = 512, temperature: float = 0.7) -> str:
+        """Blocking completion; run it via asyncio.to_thread."""
+        return "".join(self.stream(messages, max_tokens, temperature))
+
+    def stream(self, messages: list, max_tokens: int = 512, temperature: float = 0.7, cancel=None):
+        """
+        Blocking iterator of text deltas. Closing it early stops generation; so does setting
+        `cancel` (a threading.Event), checked by llama_cpp after every sampled token.
+        """
+        stopping_criteria = None
+        if cancel is not None:
+            from llama_cpp import StoppingCriteriaList
+            stopping_criteria = StoppingCriteriaList([lambda input_ids, logits: cancel.is_set()])
+        with self._lock:
+            prompt, stop = self._render(messages)
+            tokens = self.model.tokenize(prompt.encode("utf-8"), special=True)
+            self._record(tokens)
+            for chunk in self.model.create_completion(
+                prompt=tokens,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                stop=stop,
+                stopping_criteria=stopping_criteria,
+                stream=True
+            ):
+                text = chunk["choices"][0]["text"]
+                if text:
+                    yield text
+
+    def _record(self, tokens: list):
+        from llama_cpp import Llama
+        # input_ids is the whole n_ctx buffer; only the first n_tokens are evaluated state.
+        # llama_cpp always re-evaluates the last prompt token, so at most tokens[:-1] is reused.
+        reusable = tokens[:-1]
+        hit = Llama.longest_token_prefix(self.model.input_ids[:self.model.n_tokens].tolist(), reusable)
+        cache = getattr(self.model, "cache", None)
+        if cache is not None:
+            try:
+                key = cache._find_longest_prefix_key(tuple(tokens))
+                if key:
+                    hit = max(hit, Llama.longest_token_prefix(key, reusable))
+            except AttributeError:
+                pass # Cache implementation without prefix lookup
+
+        self.last_stats = {"prompt_tokens": len(tokens), "prefix_hit_tokens": hit, "evaluated_tokens": len(tokens) - hit}
+        self.totals["requests"] += 1
+        self.totals["prompt_tokens"] += len(tokens)
+        self.totals["prefix_hit_tokens"] += hit
+        logger.info(f"Local prompt: {len(tokens)} tokens, {hit} reused from KV cache, {len(tokens) - hit} evaluated")
+
+    def _render(self, messages: list):
+        if self._template is None:
+            return _chatml(messages), _CHATML_STOP
+        result = self._template(messages=messages)
+        return result.prompt, result.stop
+
+    def _load_template(self):
+        """The GGUF's own chat template, i.e. exactly what create_chat_completion would render."""
+        template = self.model.metadata.get("tokenizer.chat_template")
+        if not template:
+            return None
+        try:
+            from llama_cpp.llama_chat_format import Jinja2ChatFormatter
+            special = lambda token_id: self.model.detokenize([token_id], special=True).decode("utf-8", "ignore") if token_id != -1 else ""
+            return Jinja2ChatFormatter(
+                template=template,
+                eos_token=special(self.model.token_eos()),
+                bos_token=special(self.model.token_bos()),
+            )
+        except Exception as e:
+            logger.warning(f"Chat template unusable ({e}); falling back to ChatML.")
+            return None
@@ -1,21 +1,116 @@
+import atexit
 import logging
 import json
 import sqlite3
 import os
+import re
+import threading
+import time
 from datetime import datetime
 
 logger = logging.getLogger("alan.memory")
 
+# In-process config generation per DB file. Every AlanMemory writing personality or
+# long-term rows bumps it, so caches in other threads (e.g. the HTTP server) drop instantly.
+_config_generations = {}
+_config_generations_lock = threading.Lock()
+
+
+def _config_generation(db_path: str) -> int:
+    return _config_generations.get(os.path.abspath(db_path), 0)
+
+
+# Words too common to help recall; dropping them keeps FTS posting lists short
+_STOPWORDS = frozenset("""
+a an and are as at be but by can could do does for from have he her him his how i if in
+is it its me my no not of on or our please she so that the their them then there these
+they this to us was we were what when where which who why will with would you your
+""".split())
+_WORD = re.compile(r"\w+", re.UNICODE)
+
+
+_MAX_ID = (1 << 63) - 1
+
+
+def _bump_config_generation(db_path: str):
+    key = os.path.abspath(db_path)
+    with _config_generations_lock:
+        _config_generations[key] = _config_generations.get(key, 0) + 1
+
+
+class ConnectionManager:
+    """
+    Keeps one WAL-mode SQLite connection alive per thread.
+    Threads never share a connection, so this is safe from asyncio.to_thread workers
+    and the HTTP server thread alike. Each connection keeps its own prepared statement
+    cache, so repeated queries skip SQL parsing.
+    """
+    def __init__(self, db_path: str, cached_statements: int = 128):
+        self.db_path = db_path
+        self.cached_statements = cached_statements
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []
+
+    def get(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=10, cached_statements=self.cached_statements)
+            # Only takes effect on a fresh file; lets retention return freed pages incrementally
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def close_all(self):
+        with self._lock:
+            for conn in self._connections:
+                try:
+                    conn.close()
+                except sqlite3.Error:
+                    pass
+            self._connections.clear()
+        self._local = threading.local()
+
 class AlanMemory:
-    def __init__(self, db_path=None):
+    def __init__(self, db_path=None, batch_size: int = 32, flush_interval: float = 0.5,
+                 cache_revalidate_interval: float = 2.0):
         if db_path is None:
             db_path = os.path.join(os.path.expanduser("~"), "alan_memory.db")
         self.db_path = db_path
+        self.connections = ConnectionManager(db_path)
+
+        # Write-behind journal for episodic rows: flushed in batches by size or time
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._pending = []
+        self._pending_cond = threading.Condition()
+        self._flush_lock = threading.Lock() # Serializes flushers only; readers never take it
+        self._committed_id = 0 # Highest episodic id this instance has committed (see _pending_snapshot)
+        self._writer = None
+        self._closed = False
+
+        # Read-through cache for personality / long-term rows.
+        # Same-process writes invalidate via the config generation; writes from other
+        # processes are caught by polling memory_meta.config_version (trigger-maintained)
+        # at most once per cache_revalidate_interval.
+        self.cache_revalidate_interval = cache_revalidate_interval
+        self._config_cache = {}
+        self._cache_lock = threading.Lock()
+        self._cache_generation = None
+        self._cache_db_version = None
+        self._cache_prompt_version = 0
+        self._cache_checked_at = 0.0
+        self._cache_counters = {"hits": 0, "misses": 0, "invalidations": 0}
+
         self._init_db()
         
     def _init_db(self):
         """Initialize local SQLite for fast episodic recall"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self.connections.get()
         c = conn.cursor()
         
         # 1. Short-Term / Context (Key-Value)
@@ -46,8 +141,73 @@ class AlanMemory:
             ]
             c.executemany("INSERT INTO personality VALUES (?, ?)", defaults)
 
+        # 5. Config version, bumped by triggers on every personality / long-term change
+        c.execute('''CREATE TABLE IF NOT EXISTS memory_meta
+                     (key TEXT PRIMARY KEY, value INTEGER)''')
+        c.execute("INSERT OR IGNORE INTO memory_meta VALUES ('config_version', 0)")
+        for table in ("personality", "long_term_memory"):
+            for op in ("INSERT", "UPDATE", "DELETE"):
+                c.execute(f'''CREATE TRIGGER IF NOT EXISTS {table}_{op.lower()}_version
+                              AFTER {op} ON {table} BEGIN
+                              UPDATE memory_meta SET value = value + 1 WHERE key = 'config_version';
+                              END''')
+        # Prompt version: only what the prompts are built from (personality, user preferences),
+        # so retention summaries and other long-term rows don't orphan cached replies
+        c.execute("INSERT OR IGNORE INTO memory_meta VALUES ('prompt_version', 0)")
+        for op, row in (("INSERT", "new"), ("UPDATE", "new"), ("DELETE", "old")):
+            c.execute(f'''CREATE TRIGGER IF NOT EXISTS personality_{op.lower()}_prompt_version
+                          AFTER {op} ON personality BEGIN
+                          UPDATE memory_meta SET value = value + 1 WHERE key = 'prompt_version';
+                          END''')
+            c.execute(f'''CREATE TRIGGER IF NOT EXISTS preferences_{op.lower()}_prompt_version
+                          AFTER {op} ON long_term_memory WHEN {row}.category = 'user_preferences' BEGIN
+                          UPDATE memory_meta SET value = value + 1 WHERE key = 'prompt_version';
+                          END''')
+
+        # 6. Full-Text Recall over episodic memory (external content, kept in sync by triggers)
+        self.fts_enabled = True
+        try:
+            exists = c.execute("SELECT 1 FROM sqlite_master WHERE name='episodic_fts'").fetchone()
+            c.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS episodic_fts USING fts5
+                         (content, content='episodic_memory', content_rowid='id',
+                          tokenize='porter unicode61')''')
+            c.execute('''CREATE TRIGGER IF NOT EXISTS episodic_fts_insert AFTER INSERT ON episodic_memory BEGIN
+                         INSERT INTO episodic_fts (rowid, content) VALUES (new.id, new.content);
+                         END''')
+            c.execute('''CREATE TRIGGER IF NOT EXISTS episodic_fts_delete AFTER DELETE ON episodic_memory BEGIN
+                         INSERT INTO episodic_fts (episodic_fts, rowid, content) VALUES ('delete', old.id, old.content);
+                         END''')
+            c.execute('''CREATE TRIGGER IF NOT EXISTS episodic_fts_update AFTER UPDATE ON episodic_memory BEGIN
+                         INSERT INTO episodic_fts (episodic_fts, rowid, content) VALUES ('delete', old.id, old.content);
+                         INSERT INTO episodic_fts (rowid, content) VALUES (new.id, new.content);
+                         END''')
+            if not exists:
+                # Index rows logged before the FTS table existed
+                c.execute("INSERT INTO episodic_fts (episodic_fts) VALUES ('rebuild')")
+        except sqlite3.OperationalError as e:
+            logger.warning(f"SQLite FTS5 unavailable, episodic search disabled: {e}")
+            self.fts_enabled = False
+
+        # 7. Response cache (see response_cache.py)
+        c.execute('''CREATE TABLE IF NOT EXISTS response_cache
+                     (key TEXT PRIMARY KEY, mode TEXT, version INTEGER, context TEXT DEFAULT '', prompt TEXT,
+                      response TEXT, created REAL, embedding TEXT)''')
+        if "context" not in [r[1] for r in c.execute("PRAGMA table_info(response_cache)")]:
+            # Tables created before follow-ups were keyed on conversation context
+            c.execute("ALTER TABLE response_cache ADD COLUMN context TEXT DEFAULT ''")
+
         conn.commit()
-        conn.close()
+        self._committed_id = c.execute("SELECT coalesce(max(id), 0) FROM episodic_memory").fetchone()[0]
+
+    def close(self):
+        """Flushes pending writes and releases all connections."""
+        with self._pending_cond:
+            self._closed = True
+            self._pending_cond.notify()
+        if self._writer and self._writer is not threading.current_thread():
+            self._writer.join()
+        self.flush()
+        self.connections.close_all()
 
     # --- Short Term ---
     def save_context(self, key: str, value: dict):
@@ -59,17 +219,130 @@ class AlanMemory:
 
     # --- Episodic ---
     def log_interaction(self, role: str, content: str):
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        c.execute("INSERT INTO episodic_memory (role, content, timestamp) VALUES (?, ?, ?)",
-                  (role, content, datetime.now().isoformat()))
-        conn.commit()
-        conn.close()
+        """Queues the row for the background writer; never blocks on SQLite."""
+        with self._pending_cond:
+            self._pending.append((role, content, datetime.now().isoformat()))
+            if self._writer is None and not self._closed:
+                self._start_writer()
+            if len(self._pending) >= self.batch_size:
+                self._pending_cond.notify()
+
+    def flush(self) -> int:
+        """Commits all queued episodic rows in one transaction. Returns the number written."""
+        with self._flush_lock:
+            with self._pending_cond:
+                batch = list(self._pending)
+            if not batch:
+                return 0
+            conn = self.connections.get()
+            with conn:
+                conn.executemany("INSERT INTO episodic_memory (role, content, timestamp) VALUES (?, ?, ?)", batch)
+                # Still inside our write transaction, so the newest id is the batch's last row
+                last_id = conn.execute("SELECT max(id) FROM episodic_memory").fetchone()[0]
+            # Rows leave the queue only once committed; newer rows were appended after the snapshot
+            with self._pending_cond:
+                del self._pending[:len(batch)]
+                self._committed_id = last_id
+            return len(batch)
+
+    def _pending_snapshot(self, limit: int = None):
+        """
+        (queued count, last `limit` queued (role, content) rows, id ceiling for committed rows).
+        Readers don't wait for a flush in progress: a batch committed after this snapshot is
+        still in the snapshot, so committed rows above the ceiling are skipped as duplicates.
+        """
+        with self._pending_cond:
+            queued = len(self._pending)
+            rows = self._pending if limit is None else self._pending[-limit:] if limit > 0 else []
+            pending = [(r[0], r[1]) for r in rows]
+            ceiling = self._committed_id if queued else _MAX_ID
+        return queued, pending, ceiling
+
+    def get_recent_history(self, limit=10, align=1):
+        """
+        Last N interactions, including rows still waiting in the write-behind queue.
+        With align > 1 the window's oldest row only moves in steps of `align` rows, so it
+        holds between `limit` and `limit + align - 1` rows and keeps the same start for
+        several turns (a stable prompt prefix for the local model's KV cache).
+        """
+        if limit <= 0:
+            return []
+        span = limit + align - 1
+        queued, pending, ceiling = self._pending_snapshot(span)
+        rows = self._query_all("SELECT id, role, content FROM episodic_memory WHERE id <= ? ORDER BY id DESC LIMIT ?",
+                               (ceiling, max(1, span - len(pending))))
+        # Position of the newest row in the whole log (ids are AUTOINCREMENT, pending rows come next)
+        newest = (rows[0][0] if rows else 0) + queued
+        excess = max(0, newest - limit) % align
+        combined = [(r[1], r[2]) for r in reversed(rows)] + pending
+        combined = combined[-(limit + excess):]
+        return [{"role": r[0], "content": r[1]} for r in combined]
+
+    def search(self, query: str, k: int = 5, window: int = 500, exclude_recent: int = 0) -> list:
+        """
+        Full-text recall over episodic memory, best BM25 matches first.
+        Only the `window` most recent matching rows are ranked, so common terms
+        can't turn a lookup into a scan of the whole history.
+        The newest `exclude_recent` rows (the turns already in the prompt's history window,
+        queued ones included) are skipped, so recall only brings back older turns.
+        Rows still in the write-behind queue are not indexed yet.
+        """
+        if not self.fts_enabled or k <= 0:
+            return []
+        terms = [w for w in _WORD.findall(query.lower()) if w not in _STOPWORDS and len(w) > 1]
+        if not terms:
+            return []
+        ceiling = _MAX_ID
+        if exclude_recent > 0:
+            queued, _, committed = self._pending_snapshot(0)
+            skip = exclude_recent - queued
+            if skip > 0:
+                row = self._query_one("SELECT id FROM episodic_memory WHERE id <= ? ORDER BY id DESC LIMIT 1 OFFSET ?",
+                                      (committed, skip - 1))
+                if row is None:
+                    return []  # Everything logged is already in the window
+                ceiling = row[0]
+        # Quoted terms so user text can't inject FTS query syntax
+        match = " OR ".join(f'"{t}"' for t in dict.fromkeys(terms[:8]))
+        # Walking the doclists newest-first is cheap; ranking every match is not
+        floor = self._query_one(
+            "SELECT rowid FROM episodic_fts WHERE episodic_fts MATCH ? AND rowid < ? "
+            "ORDER BY rowid DESC LIMIT 1 OFFSET ?",
+            (match, ceiling, window - 1))
+        rows = self._query_all(
+            """SELECT e.role, e.content, e.timestamp, f.rank
+               FROM episodic_fts f JOIN episodic_memory e ON e.id = f.rowid
+               WHERE episodic_fts MATCH ? AND f.rowid >= ? AND f.rowid < ? ORDER BY f.rank LIMIT ?""",
+            (match, floor[0] if floor else 0, ceiling, k))
+        return [{"role": r[0], "content": r[1], "timestamp": r[2], "score": -r[3]} for r in rows]
+
+    def _start_writer(self):
+        self._writer = threading.Thread(target=self._write_behind, name="alan-memory-writer", daemon=True)
+        self._writer.start()
+        # Durability on interpreter shutdown
+        atexit.register(self.close)
 
-    def get_recent_history(self, limit=10):
-        # Return last N interactions
-        rows = self._query_all("SELECT role, content FROM episodic_memory ORDER BY id DESC LIMIT ?", (limit,))
-        return [{"role": r[0], "content": r[1]} for r in reversed(rows)]
+    def _write_behind(self):
+        failures = 0
+        while True:
+            with self._pending_cond:
+                if failures:
+                    # Back off while the DB stays locked (e.g. retention compaction); only close() cuts it short
+                    deadline = time.monotonic() + min(30.0, self.flush_interval * 2 ** failures)
+                    while not self._closed and (remaining := deadline - time.monotonic()) > 0:
+                        self._pending_cond.wait(remaining)
+                elif not self._closed and len(self._pending) < self.batch_size:
+                    self._pending_cond.wait(self.flush_interval)
+                closed = self._closed
+            try:
+                self.flush()
+                failures = 0
+            except sqlite3.Error as e:
+                # Rows stay queued and are retried after the backoff
+                failures += 1
+                logger.error(f"Episodic flush failed: {e}")
+            if closed:
+                return
 
     # --- Long Term / Personality ---
     def save_long_term(self, category: str, item: str, value: str):
@@ -77,44 +350,99 @@ class AlanMemory:
             "category": category, "item": item, 
             "value": value, "timestamp": datetime.now().isoformat()
         })
+        _bump_config_generation(self.db_path)
 
     def get_long_term(self, category: str) -> dict:
-        rows = self._query_all("SELECT item, value FROM long_term_memory WHERE category=?", (category,))
-        return {r[0]: r[1] for r in rows}
+        def load():
+            rows = self._query_all("SELECT item, value FROM long_term_memory WHERE category=?", (category,))
+            return {r[0]: r[1] for r in rows}
+        return self._cached(("long_term", category), load)
 
     def get_personality(self) -> dict:
-        rows = self._query_all("SELECT trait, current_value FROM personality")
-        return {r[0]: r[1] for r in rows}
+        def load():
+            rows = self._query_all("SELECT trait, current_value FROM personality")
+            return {r[0]: r[1] for r in rows}
+        return self._cached(("personality",), load)
+
+    def set_personality(self, traits: dict):
+        conn = self.connections.get()
+        with conn:
+            conn.executemany("INSERT OR REPLACE INTO personality (trait, current_value) VALUES (?, ?)",
+                             list(traits.items()))
+        _bump_config_generation(self.db_path)
+
+    def config_version(self) -> int:
+        """
+        Counter bumped on every personality / user-preference change (any process).
+        Served from the revalidated config cache state, so it costs no query per call.
+        """
+        self._revalidate_cache()
+        with self._cache_lock:
+            return self._cache_prompt_version
+
+    def cache_stats(self) -> dict:
+        stats = dict(self._cache_counters)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
+
+    # --- Config Cache ---
+    def _cached(self, key, load) -> dict:
+        generation = self._revalidate_cache()
+        with self._cache_lock:
+            value = self._config_cache.get(key)
+            if value is not None:
+                self._cache_counters["hits"] += 1
+                return dict(value)
+            self._cache_counters["misses"] += 1
+        value = load()
+        with self._cache_lock:
+            # Don't store a value that may predate a write that landed while loading
+            if generation == self._cache_generation == _config_generation(self.db_path):
+                self._config_cache[key] = value
+        return dict(value)
+
+    def _revalidate_cache(self) -> int:
+        generation = _config_generation(self.db_path)
+        now = time.monotonic()
+        db_version = None
+        # Same-process writes re-read the versions right away; other processes are polled
+        if generation != self._cache_generation or now - self._cache_checked_at >= self.cache_revalidate_interval:
+            versions = dict(self._query_all(
+                "SELECT key, value FROM memory_meta WHERE key IN ('config_version', 'prompt_version')"))
+            db_version = versions.get("config_version", 0)
+        with self._cache_lock:
+            stale = generation != self._cache_generation
+            if db_version is not None:
+                self._cache_checked_at = now
+                stale = stale or db_version != self._cache_db_version
+                self._cache_db_version = db_version
+                self._cache_prompt_version = versions.get("prompt_version", 0)
+            if stale:
+                if self._config_cache:
+                    self._cache_counters["invalidations"] += 1
+                self._config_cache.clear()
+                self._cache_generation = generation
+        return generation
 
     # --- Helpers ---
     def _upsert(self, table, data):
         columns = ', '.join(data.keys())
         placeholders = ', '.join(['?'] * len(data))
         values = list(data.values())
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        c.execute(f"INSERT OR REPLACE INTO {table} ({columns}) VALUES ({placeholders})", values)
-        conn.commit()
-        conn.close()
+        conn = self.connections.get()
+        with conn:
+            conn.execute(f"INSERT OR REPLACE INTO {table} ({columns}) VALUES ({placeholders})", values)
 
     def _query_one(self, sql, params=()):
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        c.execute(sql, params)
-        res = c.fetchone()
-        conn.close()
-        return res
+        return self.connections.get().execute(sql, params).fetchone()
 
     def _query_all(self, sql, params=()):
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        c.execute(sql, params)
-        res = c.fetchall()
-        conn.close()
-        return res
+        return self.connections.get().execute(sql, params).fetchall()
 
 if __name__ == "__main__":
     mem = AlanMemory()
     mem.log_interaction("user", "Hello Alan")
     print(mem.get_recent_history())
+    mem.flush()
     print("Personality:", mem.get_personality())
@@ -0,0 +1,47 @@
+import asyncio
+import logging
+
+logger = logging.getLogger("alan.monitoring")
+
+
+class LoopLagMonitor:
+    """
+    Watches event-loop responsiveness. A ticker sleeps for `interval` and measures how
+    late it wakes up; any lag over `threshold` means something blocked the loop
+    (audio frames, VAD and data packets all stall meanwhile) and is logged and counted.
+    """
+    def __init__(self, interval: float = 0.1, threshold: float = 0.1):
+        self.interval = interval
+        self.threshold = threshold
+        self.stalls = 0
+        self.max_lag = 0.0
+        self.total_stall_time = 0.0
+        self._task = None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = loop.time() - start - self.interval
+            self.max_lag = max(self.max_lag, lag)
+            if lag > self.threshold:
+                self.stalls += 1
+                self.total_stall_time += lag
+                logger.warning(f"Event loop stalled for {lag * 1000:.0f} ms (stall #{self.stalls})")
+
+    def stats(self) -> dict:
+        return {
+            "stalls": self.stalls,
+            "max_lag_ms": round(self.max_lag * 1000, 1),
+            "total_stall_ms": round(self.total_stall_time * 1000, 1),
+        }
@@ -0,0 +1,129 @@
+import hashlib
+import logging
+import mmap
+import os
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger("alan.pcm_cache")
+
+BYTES_PER_SAMPLE = 2  # s16 mono
+
+
+class PcmCache:
+    """
+    Content-addressed cache of decoded TTS audio, keyed by (voice, text, sample rate).
+    - memory tier: LRU of whole-phrase PCM buffers, bounded by `max_memory_bytes`.
+    - disk tier: one raw s16 file per phrase under `directory`, mapped with mmap on a hit
+      (pages come from the OS page cache, nothing is re-decoded), bounded by `max_disk_bytes`.
+    A hit plays with no network call and no MP3 decode.
+    """
+    def __init__(self, directory: str, max_memory_bytes: int = 16 << 20, max_disk_bytes: int = 256 << 20):
+        self.directory = directory
+        os.makedirs(self.directory, exist_ok=True)
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self._memory = OrderedDict()  # key -> bytes or mmap
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        self.counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0}
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            os.getenv("ALAN_TTS_CACHE_DIR") or os.path.join(os.path.expanduser("~"), ".cache", "alan", "tts"),
+            max_memory_bytes=int(float(os.getenv("ALAN_TTS_CACHE_MEMORY_MB", 16)) * (1 << 20)),
+            max_disk_bytes=int(float(os.getenv("ALAN_TTS_CACHE_DISK_MB", 256)) * (1 << 20)),
+        )
+
+    @staticmethod
+    def key(voice: str, text: str, sample_rate: int) -> str:
+        return hashlib.sha256(f"{voice}\x00{sample_rate}\x00{text.strip()}".encode("utf-8")).hexdigest()
+
+    def get(self, voice: str, text: str, sample_rate: int):
+        """Whole-phrase PCM as a buffer (bytes or read-only mmap), or None."""
+        key = self.key(voice, text, sample_rate)
+        with self._lock:
+            pcm = self._memory.get(key)
+            if pcm is not None:
+                self._memory.move_to_end(key)
+                self.counters["memory_hits"] += 1
+                return pcm
+
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                pcm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            os.utime(path) # Recency for disk eviction
+        except (FileNotFoundError, ValueError): # ValueError: empty file can't be mapped
+            with self._lock:
+                self.counters["misses"] += 1
+            return None
+
+        with self._lock:
+            self.counters["disk_hits"] += 1
+            self._remember(key, pcm)
+        return pcm
+
+    def put(self, voice: str, text: str, sample_rate: int, pcm: bytes):
+        """Stores a fully synthesized phrase in both tiers."""
+        if not pcm:
+            return
+        key = self.key(voice, text, sample_rate)
+        path = self._path(key)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp, "wb") as f:
+                f.write(pcm)
+            os.replace(tmp, path) # Readers never see a half-written file
+        except OSError as e:
+            logger.warning(f"PCM cache write failed: {e}")
+        with self._lock:
+            self.counters["stores"] += 1
+            self._remember(key, bytes(pcm))
+        self._evict_disk()
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self.counters)
+            stats["memory_bytes"] = self._memory_bytes
+            stats["memory_entries"] = len(self._memory)
+        lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = round((stats["memory_hits"] + stats["disk_hits"]) / lookups, 3) if lookups else 0.0
+        stats["disk_bytes"] = sum(size for _, size, _ in self._disk_files())
+        return stats
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.s16")
+
+    def _remember(self, key: str, pcm):
+        """Adds to the memory LRU. Caller holds the lock."""
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self._memory_bytes -= len(old)
+        self._memory[key] = pcm
+        self._memory_bytes += len(pcm)
+        while self._memory_bytes > self.max_memory_bytes and len(self._memory) > 1:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+            # mmaps are not closed here: a playing utterance may still hold a view; GC unmaps them
+
+    def _disk_files(self) -> list:
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".s16"):
+                stat = entry.stat()
+                files.append((entry.path, stat.st_size, stat.st_mtime))
+        return files
+
+    def _evict_disk(self):
+        files = self._disk_files()
+        total = sum(size for _, size, _ in files)
+        for path, size, _ in sorted(files, key=lambda f: f[2]):
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
@@ -0,0 +1,196 @@
+import hashlib
+import json
+import logging
+import math
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from memory import _STOPWORDS
+
+logger = logging.getLogger("alan.response_cache")
+
+_WORD = re.compile(r"[a-z0-9']+")
+# Answers to these go stale within minutes, whatever the TTL says
+_VOLATILE = re.compile(r"\b(time|date|today|tonight|tomorrow|yesterday|now|weather|latest|news|current(ly)?)\b")
+
+
+def normalize(text: str) -> str:
+    """Lowercase, drop punctuation, collapse whitespace: 'What's up?!' -> "what's up"."""
+    return " ".join(_WORD.findall(text.lower()))
+
+
+def hashed_embedding(text: str, dims: int = 1024) -> dict:
+    """
+    Dependency-free sparse embedding: hashed content-word unigrams and bigrams, L2-normalized.
+    Good enough to match rephrasings of short, repeated questions.
+    """
+    words = [w for w in normalize(text).split() if w not in _STOPWORDS]
+    features = words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+    vector = {}
+    for feature in features:
+        index = int.from_bytes(hashlib.blake2b(feature.encode("utf-8"), digest_size=4).digest(), "little") % dims
+        vector[index] = vector.get(index, 0.0) + 1.0
+    norm = math.sqrt(sum(v * v for v in vector.values())) or 1.0
+    return {i: v / norm for i, v in vector.items()}
+
+
+# Prompts that only make sense next to the previous reply: "why?", "tell me more", "and her sister?"
+_ANAPHORA = re.compile(r"\b(it|its|that|this|these|those|they|them|their|he|him|his|she|her|there)\b")
+_CONTINUATION = re.compile(r"^(and|so|but|then|or|also)\b")
+_SHORT_FOLLOW_UP = re.compile(r"\b(why|really|more|else|again|example)\b|^(how so|how come|what about|what then|like what)\b")
+
+
+def is_follow_up(text: str) -> bool:
+    text = normalize(text)
+    return bool(_ANAPHORA.search(text) or _CONTINUATION.search(text)
+                or (len(text.split()) <= 3 and _SHORT_FOLLOW_UP.search(text)))
+
+
+def conversation_context(text: str, history: list = None) -> str:
+    """
+    Fingerprint of where a follow-up sits in the conversation: a hash of the last assistant
+    turn (or last turn). "why?" after two different answers must not share a cache entry.
+    '' for standalone questions, which are keyed on the prompt alone.
+    """
+    if not history or not is_follow_up(text):
+        return ""
+    turn = next((t for t in reversed(history) if t["role"] == "assistant"), history[-1])
+    return hashlib.sha1(f"{turn['role']}\x00{turn['content']}".encode("utf-8")).hexdigest()[:16]
+
+
+def cosine(a: dict, b: dict) -> float:
+    if len(a) > len(b):
+        a, b = b, a
+    return sum(v * b.get(i, 0.0) for i, v in a.items())
+
+
+class ResponseCache:
+    """
+    Cache of finished replies, keyed on normalized prompt + mode + config version
+    (personality / preference changes bump the version and orphan old entries), plus the
+    conversation context for follow-ups (see conversation_context).
+    - exact tier: hash lookup on the normalized prompt.
+    - semantic tier (optional, standalone questions only): nearest cached prompt by
+      embedding similarity >= threshold.
+    Entries live in an in-memory LRU backed by the `response_cache` table of the memory DB,
+    so they survive restarts. Lookups never touch SQLite; writes do (call them off the loop).
+    """
+    def __init__(self, memory, max_entries: int = 512, ttl: float = 6 * 3600, semantic: bool = False,
+                 threshold: float = 0.9, embed=None):
+        self.memory = memory
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.semantic = semantic
+        self.threshold = threshold
+        self.embed = embed or hashed_embedding
+        self._entries = OrderedDict()  # key -> entry dict, least recently used first
+        self._lock = threading.Lock()
+        self.counters = {"exact_hits": 0, "semantic_hits": 0, "misses": 0, "bypassed": 0, "stores": 0, "evictions": 0}
+        self._load()
+
+    @classmethod
+    def from_env(cls, memory):
+        return cls(
+            memory,
+            max_entries=int(os.getenv("ALAN_CACHE_MAX_ENTRIES", 512)),
+            ttl=float(os.getenv("ALAN_CACHE_TTL", 6 * 3600)),
+            semantic=os.getenv("ALAN_CACHE_SEMANTIC", "0") == "1",
+            threshold=float(os.getenv("ALAN_CACHE_THRESHOLD", 0.9)),
+        )
+
+    @staticmethod
+    def cacheable(text: str, images: list = None) -> bool:
+        return not images and bool(normalize(text)) and not _VOLATILE.search(text.lower())
+
+    @staticmethod
+    def key(text: str, mode: str, version: int, context: str = "") -> str:
+        return hashlib.sha1(f"{mode}\x00{version}\x00{context}\x00{normalize(text)}".encode("utf-8")).hexdigest()
+
+    def get(self, text: str, mode: str, version: int, images: list = None, history: list = None):
+        """Cached reply for this prompt in this conversation, or None."""
+        if not self.cacheable(text, images):
+            self.counters["bypassed"] += 1
+            return None
+        now = time.time()
+        context = conversation_context(text, history)
+        key = self.key(text, mode, version, context)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and now - entry["created"] <= self.ttl:
+                self._entries.move_to_end(key)
+                entry["hits"] += 1
+                self.counters["exact_hits"] += 1
+                return entry["response"]
+
+            # Follow-ups are exact-match only: a paraphrase in another conversation means something else
+            if self.semantic and not context:
+                vector = self.embed(text)
+                best, best_score = None, self.threshold
+                for candidate in self._entries.values():
+                    if (candidate["mode"] != mode or candidate["version"] != version or candidate["context"]
+                            or now - candidate["created"] > self.ttl):
+                        continue
+                    score = cosine(vector, candidate["embedding"])
+                    if score >= best_score:
+                        best, best_score = candidate, score
+                if best:
+                    self._entries.move_to_end(best["key"])
+                    best["hits"] += 1
+                    self.counters["semantic_hits"] += 1
+                    logger.info(f"Semantic cache hit ({best_score:.2f}): {text!r} ~ {best['prompt']!r}")
+                    return best["response"]
+
+            self.counters["misses"] += 1
+        return None
+
+    def put(self, text: str, mode: str, version: int, response: str, images: list = None, history: list = None):
+        """Stores a finished reply. Blocking SQLite write; run via asyncio.to_thread."""
+        if not response or not self.cacheable(text, images):
+            return
+        context = conversation_context(text, history)
+        entry = {
+            "key": self.key(text, mode, version, context), "mode": mode, "version": version, "context": context,
+            "prompt": normalize(text), "response": response, "created": time.time(), "hits": 0,
+            "embedding": self.embed(text),
+        }
+        with self._lock:
+            self._entries[entry["key"]] = entry
+            self._entries.move_to_end(entry["key"])
+            evicted = []
+            while len(self._entries) > self.max_entries:
+                evicted.append(self._entries.popitem(last=False)[0])
+            self.counters["stores"] += 1
+            self.counters["evictions"] += len(evicted)
+
+        conn = self.memory.connections.get()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO response_cache (key, mode, version, context, prompt, response, created, embedding) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (entry["key"], mode, version, context, entry["prompt"], response, entry["created"],
+                 json.dumps(entry["embedding"])))
+            conn.executemany("DELETE FROM response_cache WHERE key = ?", [(k,) for k in evicted])
+            conn.execute("DELETE FROM response_cache WHERE created < ? OR version < ?", (time.time() - self.ttl, version))
+
+    def stats(self) -> dict:
+        stats = dict(self.counters)
+        lookups = stats["exact_hits"] + stats["semantic_hits"] + stats["misses"]
+        stats["entries"] = len(self._entries)
+        stats["hit_rate"] = round((stats["exact_hits"] + stats["semantic_hits"]) / lookups, 3) if lookups else 0.0
+        return stats
+
+    def _load(self):
+        rows = self.memory._query_all(
+            "SELECT key, mode, version, context, prompt, response, created, embedding FROM response_cache "
+            "WHERE created >= ? ORDER BY created DESC LIMIT ?", (time.time() - self.ttl, self.max_entries))
+        for key, mode, version, context, prompt, response, created, embedding in reversed(rows):
+            vector = {int(i): v for i, v in json.loads(embedding).items()} if embedding else self.embed(prompt)
+            self._entries[key] = {
+                "key": key, "mode": mode, "version": version, "context": context or "", "prompt": prompt,
+                "response": response, "created": created, "hits": 0, "embedding": vector,
+            }
+        if rows:
+            logger.info(f"Response cache: loaded {len(rows)} entries.")
@@ -0,0 +1,172 @@
+import json
+import logging
+import os
+import re
+import threading
+import time
+from datetime import datetime, timedelta
+
+logger = logging.getLogger("alan.retention")
+
+SUMMARY_CATEGORY = "episodic_summary"
+
+
+class RetentionPolicy:
+    """Caps for episodic_memory. Rows past either cap are compacted into summaries."""
+    def __init__(self, max_rows: int = 50_000, max_age_days: float = 90, chunk_size: int = 200,
+                 vacuum_pages: int = 2_000, interval: float = 3600):
+        self.max_rows = max_rows
+        self.max_age_days = max_age_days
+        self.chunk_size = chunk_size       # Rows folded into one summary (one short write transaction each)
+        self.vacuum_pages = vacuum_pages   # Pages freed per incremental_vacuum pass
+        self.interval = interval           # Seconds between scheduled runs
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            max_rows=int(os.getenv("ALAN_MEMORY_MAX_ROWS", 50_000)),
+            max_age_days=float(os.getenv("ALAN_MEMORY_MAX_AGE_DAYS", 90)),
+            interval=float(os.getenv("ALAN_MEMORY_RETENTION_INTERVAL", 3600)),
+        )
+
+
+def extractive_summary(rows: list, max_chars: int = 600) -> str:
+    """Cheap offline summary: the opening words of each user turn, deduplicated."""
+    seen = set()
+    parts = []
+    for role, content in rows:
+        if role != "user" or not content:
+            continue
+        gist = " ".join(re.findall(r"\S+", content)[:12])
+        if gist.lower() in seen:
+            continue
+        seen.add(gist.lower())
+        parts.append(gist)
+    summary = "; ".join(parts)
+    return summary[:max_chars]
+
+
+class RetentionEngine:
+    """
+    Bounds episodic_memory: compacts the oldest ranges into summary rows in
+    long_term_memory, deletes them, then returns freed pages with incremental VACUUM.
+    Runs on its own thread, off the hot path.
+    """
+    def __init__(self, memory, policy: RetentionPolicy = None, summarizer=None):
+        self.memory = memory
+        self.policy = policy or RetentionPolicy()
+        self.summarizer = summarizer or extractive_summary
+        self.last_report = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name="alan-memory-retention", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+    def _loop(self):
+        while not self._stop.wait(self.policy.interval):
+            try:
+                self.run()
+            except Exception as e:
+                logger.error(f"Retention run failed: {e}")
+
+    def run(self) -> dict:
+        """One retention pass. Returns (and logs) a report of what was reclaimed."""
+        start = time.perf_counter()
+        conn = self.memory.connections.get()
+        bytes_before = self._db_bytes(conn)
+
+        cutoff_id = self._cutoff_id(conn)
+        compacted = summaries = 0
+        while cutoff_id and not self._stop.is_set():
+            n = self._compact_chunk(conn, cutoff_id)
+            if n == 0:
+                break
+            compacted += n
+            summaries += 1
+
+        if compacted:
+            self._vacuum(conn)
+        bytes_after = self._db_bytes(conn)
+
+        self.last_report = {
+            "rows_compacted": compacted,
+            "summaries_written": summaries,
+            "bytes_reclaimed": max(0, bytes_before - bytes_after),
+            "duration_ms": round((time.perf_counter() - start) * 1000, 1),
+        }
+        if compacted:
+            logger.info(f"Retention: {self.last_report}")
+        return self.last_report
+
+    def _cutoff_id(self, conn) -> int:
+        """Highest episodic id that is over the row cap or the age cap (0 if none)."""
+        cutoff = 0
+        total = conn.execute("SELECT count(*) FROM episodic_memory").fetchone()[0]
+        excess = total - self.policy.max_rows
+        if excess > 0:
+            row = conn.execute("SELECT id FROM episodic_memory ORDER BY id LIMIT 1 OFFSET ?", (excess - 1,)).fetchone()
+            cutoff = row[0] if row else 0
+        if self.policy.max_age_days:
+            oldest_kept = (datetime.now() - timedelta(days=self.policy.max_age_days)).isoformat()
+            row = conn.execute("SELECT max(id) FROM episodic_memory WHERE timestamp < ?", (oldest_kept,)).fetchone()
+            cutoff = max(cutoff, row[0] or 0)
+        return cutoff
+
+    def _compact_chunk(self, conn, cutoff_id: int) -> int:
+        # IMMEDIATE takes the write lock up front, so two workers can't fold the same range
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute(
+                "SELECT id, role, content, timestamp FROM episodic_memory WHERE id <= ? ORDER BY id LIMIT ?",
+                (cutoff_id, self.policy.chunk_size)).fetchall()
+            if not rows:
+                conn.commit()
+                return 0
+            first, last = rows[0], rows[-1]
+            summary = {
+                "from": first[3], "to": last[3], "turns": len(rows),
+                "summary": self.summarizer([(r[1], r[2]) for r in rows]),
+            }
+            conn.execute(
+                "INSERT OR REPLACE INTO long_term_memory (category, item, value, timestamp) VALUES (?, ?, ?, ?)",
+                (SUMMARY_CATEGORY, f"{first[0]:012d}-{last[0]:012d}", json.dumps(summary), datetime.now().isoformat()))
+            conn.execute("DELETE FROM episodic_memory WHERE id BETWEEN ? AND ?", (first[0], last[0]))
+            conn.commit()
+            return len(rows)
+        except Exception:
+            conn.rollback()
+            raise
+
+    def _vacuum(self, conn):
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            # Databases created before incremental mode need one full VACUUM to switch
+            logger.info("Retention: converting memory DB to incremental auto_vacuum (one-time VACUUM)...")
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            conn.execute("VACUUM")
+        else:
+            # Small steps so the write lock is only ever held briefly
+            free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            while free and not self._stop.is_set():
+                conn.execute(f"PRAGMA incremental_vacuum({int(self.policy.vacuum_pages)})").fetchall()
+                remaining = conn.execute("PRAGMA freelist_count").fetchone()[0]
+                if remaining >= free:
+                    break
+                free = remaining
+        # Let the main DB file actually shrink instead of parking pages in the WAL
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+
+    @staticmethod
+    def _db_bytes(conn) -> int:
+        page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+        page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+        return page_count * page_size
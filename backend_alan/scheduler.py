@@ -0,0 +1,145 @@
+import asyncio
+import heapq
+import itertools
+import logging
+
+from input_processor import InputPriority
+
+logger = logging.getLogger("alan.scheduler")
+
+_RANK = {
+    InputPriority.CRITICAL.value: 0,
+    InputPriority.HIGH.value: 1,
+    InputPriority.NORMAL.value: 2,
+    InputPriority.LOW.value: 3,
+}
+
+
+def _rank(event) -> int:
+    priority = getattr(event.priority, "value", event.priority)
+    return _RANK.get(priority, _RANK[InputPriority.NORMAL.value])
+
+
+class InputScheduler:
+    """
+    Runs UnifiedInputEvents through `handler` in priority order with bounded concurrency.
+    - A LOW event submitted while another LOW event is still queued is merged into it
+      (a burst of chat messages gets one reply).
+    - A HIGH/CRITICAL event drops queued LOW events (the voice turn supersedes them) and,
+      with `preempt`, cancels in-flight turns of the same or lower priority (barge-in).
+    Queue-wait times are tracked per priority.
+    """
+    def __init__(self, handler, max_concurrency: int = 1, preempt: bool = True):
+        self.handler = handler
+        self.max_concurrency = max_concurrency
+        self.preempt = preempt
+        self._heap = []  # (rank, seq, enqueued_at, event)
+        self._seq = itertools.count()
+        self._ready = asyncio.Event()
+        self._workers = []
+        self._running = {}  # handler task -> event
+        self._waits = {p.value: [] for p in InputPriority}
+        self.counters = {"submitted": 0, "completed": 0, "failed": 0, "coalesced": 0, "dropped": 0, "preempted": 0,
+                         "interrupted": 0}
+
+    def start(self):
+        if not self._workers:
+            self._workers = [asyncio.create_task(self._worker()) for _ in range(self.max_concurrency)]
+
+    async def stop(self):
+        for task in self._workers + list(self._running):
+            task.cancel()
+        await asyncio.gather(*self._workers, *self._running, return_exceptions=True)
+        self._workers = []
+        self._heap.clear()
+
+    def submit(self, event):
+        loop = asyncio.get_running_loop()
+        rank = _rank(event)
+        self.counters["submitted"] += 1
+
+        if rank == _RANK[InputPriority.LOW.value]:
+            queued = next((e for r, _, _, e in self._heap if r == rank), None)
+            if queued is not None:
+                self._merge(queued, event)
+                self.counters["coalesced"] += 1
+                logger.info(f"Coalesced LOW event {event.id} into {queued.id}")
+                return
+
+        if rank <= _RANK[InputPriority.HIGH.value]:
+            stale = [item for item in self._heap if item[0] == _RANK[InputPriority.LOW.value]]
+            if stale:
+                self._heap = [item for item in self._heap if item[0] != _RANK[InputPriority.LOW.value]]
+                heapq.heapify(self._heap)
+                self.counters["dropped"] += len(stale)
+                logger.info(f"Dropped {len(stale)} stale LOW event(s) for {event.priority} event {event.id}")
+            if self.preempt:
+                for task, running in self._running.items():
+                    if _rank(running) >= rank and not task.done():
+                        logger.info(f"Preempting {running.priority} event {running.id} for {event.id}")
+                        self.counters["preempted"] += 1
+                        task.cancel()
+
+        heapq.heappush(self._heap, (rank, next(self._seq), loop.time(), event))
+        self._ready.set()
+
+    def interrupt(self, source=None) -> int:
+        """
+        Cancels in-flight turns (user barge-in), or only those from `source` (an InputSource).
+        Queued events still run.
+        """
+        cancelled = 0
+        for task, event in self._running.items():
+            if not task.done() and (source is None or event.source == source):
+                logger.info(f"Interrupting {event.priority} event {event.id}")
+                task.cancel()
+                cancelled += 1
+        self.counters["interrupted"] += cancelled
+        return cancelled
+
+    def stats(self) -> dict:
+        waits = {}
+        for priority, samples in self._waits.items():
+            if not samples:
+                continue
+            ordered = sorted(samples)
+            waits[priority] = {
+                "count": len(samples),
+                "avg_ms": round(sum(samples) / len(samples) * 1000, 1),
+                "p95_ms": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000, 1),
+                "max_ms": round(ordered[-1] * 1000, 1),
+            }
+        return {**self.counters, "queued": len(self._heap), "running": len(self._running), "queue_wait": waits}
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            while not self._heap:
+                self._ready.clear()
+                await self._ready.wait()
+            _, _, enqueued_at, event = heapq.heappop(self._heap)
+            samples = self._waits.setdefault(getattr(event.priority, "value", event.priority), [])
+            samples.append(loop.time() - enqueued_at)
+            del samples[:-500] # Rolling window
+
+            task = asyncio.create_task(self.handler(event))
+            self._running[task] = event
+            try:
+                # wait() doesn't forward our own cancellation into the handler; stop() cancels both
+                await asyncio.wait([task])
+            finally:
+                self._running.pop(task, None)
+            if task.cancelled():
+                continue
+            if task.exception():
+                self.counters["failed"] += 1
+                logger.error(f"Input event {event.id} failed: {task.exception()}")
+            else:
+                self.counters["completed"] += 1
+
+    @staticmethod
+    def _merge(queued, event):
+        queued.normalized = f"{queued.normalized}\n{event.normalized}"
+        queued.flags = list(dict.fromkeys(queued.flags + event.flags))
+        if queued.intent in (None, "fast"):
+            queued.intent = event.intent
@@ -2,7 +2,6 @@ import os
 import json
 import logging
 import threading
-import sqlite3
 from http.server import HTTPServer, SimpleHTTPRequestHandler
 from livekit import api
 
@@ -13,6 +12,15 @@ logger = logging.getLogger("alan.server")
 # Directory where Next.js static export will be
 STATIC_DIR = os.path.join(os.path.dirname(__file__), "public")
 
+# One AlanMemory per process: it owns the pooled connections and the write-behind writer
+_memory = None
+
+def get_memory() -> AlanMemory:
+    global _memory
+    if _memory is None:
+        _memory = AlanMemory()
+    return _memory
+
 class AlanRequestHandler(SimpleHTTPRequestHandler):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, directory=STATIC_DIR, **kwargs)
@@ -63,7 +71,7 @@ class AlanRequestHandler(SimpleHTTPRequestHandler):
 
     def handle_get_settings(self):
         try:
-            mem = AlanMemory()
+            mem = get_memory()
             personality = mem.get_personality()
             # Also get other config if we had it
             
@@ -78,16 +86,8 @@ class AlanRequestHandler(SimpleHTTPRequestHandler):
             field_data = self.rfile.read(length)
             data = json.loads(field_data)
             
-            mem = AlanMemory()
-            conn = sqlite3.connect(mem.db_path) # Direct access for simplicty or add method in memory.py
-            c = conn.cursor()
-            
-            # Update personality traits
-            for trait, value in data.items():
-                c.execute("INSERT OR REPLACE INTO personality (trait, current_value) VALUES (?, ?)", (trait, value))
-            
-            conn.commit()
-            conn.close()
+            # Update personality traits (invalidates the brain's config cache)
+            get_memory().set_personality(data)
             
             self.send_json({"status": "updated", "data": data})
             
@@ -0,0 +1,201 @@
+import asyncio
+import logging
+import re
+from contextlib import aclosing
+
+logger = logging.getLogger("alan.speech")
+
+DEFAULT_VOICE = "en-US-ChristopherNeural"
+TTS_SAMPLE_RATE = 24000
+TTS_CHANNELS = 1
+
+
+class IncrementalDecoder:
+    """
+    Decodes an MP3 byte stream chunk by chunk into s16 mono PCM.
+    Packets are parsed as bytes arrive, so no file or full-utterance buffer is needed.
+    """
+    def __init__(self, sample_rate: int = TTS_SAMPLE_RATE, codec: str = "mp3"):
+        import av
+        self.sample_rate = sample_rate
+        self.codec = av.CodecContext.create(codec, "r")
+        self.resampler = av.AudioResampler(format="s16", layout="mono", rate=sample_rate)
+
+    def feed(self, data: bytes) -> list:
+        """Returns the (pcm_bytes, samples) chunks decodable so far."""
+        out = []
+        for packet in self.codec.parse(data):
+            for frame in self.codec.decode(packet):
+                self._resample(frame, out)
+        return out
+
+    def flush(self) -> list:
+        """Drains the parser, decoder and resampler at end of stream."""
+        out = []
+        for packet in self.codec.parse(None):
+            for frame in self.codec.decode(packet):
+                self._resample(frame, out)
+        for frame in self.codec.decode(None):
+            self._resample(frame, out)
+        self._resample(None, out)
+        return out
+
+    def _resample(self, frame, out: list):
+        for rf in self.resampler.resample(frame):
+            out.append((rf.to_ndarray().tobytes(), rf.samples))
+
+
+async def synthesize_stream(text: str, voice: str = DEFAULT_VOICE, sample_rate: int = TTS_SAMPLE_RATE):
+    """
+    Async generator of (pcm_bytes, samples) for `text`.
+    MP3 chunks from edge-tts are decoded while synthesis is still running.
+    """
+    import edge_tts
+    communicate = edge_tts.Communicate(text, voice)
+    decoder = IncrementalDecoder(sample_rate)
+
+    # Decoding a few KB of MP3 is sub-millisecond, so it stays on the loop
+    async with aclosing(communicate.stream()) as chunks:
+        async for chunk in chunks:
+            if chunk["type"] != "audio":
+                continue
+            for pcm in decoder.feed(chunk["data"]):
+                yield pcm
+
+    for pcm in decoder.flush():
+        yield pcm
+
+
+# --- Sentence Chunking ---
+# A boundary is terminal punctuation (plus closing quotes/brackets) followed by whitespace, or a newline
+_SENTENCE_END = re.compile(r'[.!?;:]+["\')\]]*\s+|\n+')
+
+
+class SentenceChunker:
+    """
+    Splits text into sentence/clause chunks for pipelined synthesis.
+    Text can be fed incrementally (e.g. LLM deltas); complete chunks come out as soon as they close.
+    """
+    def __init__(self, min_chars: int = 20, max_chars: int = 250):
+        self.min_chars = min_chars
+        self.max_chars = max_chars
+        self._buffer = ""
+
+    def feed(self, text: str) -> list:
+        self._buffer += text
+        chunks = []
+        while True:
+            cut = self._next_cut()
+            if cut is None:
+                break
+            chunk = self._buffer[:cut].strip()
+            self._buffer = self._buffer[cut:]
+            if chunk:
+                chunks.append(chunk)
+        return chunks
+
+    def flush(self) -> list:
+        chunk = self._buffer.strip()
+        self._buffer = ""
+        return [chunk] if chunk else []
+
+    def _next_cut(self):
+        # First sentence boundary that leaves a chunk long enough to be worth a TTS request
+        for match in _SENTENCE_END.finditer(self._buffer):
+            if len(self._buffer[:match.start()].strip()) >= self.min_chars:
+                if match.end() <= self.max_chars:
+                    return match.end()
+                break
+        if len(self._buffer) <= self.max_chars:
+            return None
+        # Run-on sentence: break at the last clause or word boundary inside the limit
+        window = self._buffer[:self.max_chars]
+        for sep in (", ", " "):
+            idx = window.rfind(sep)
+            if idx >= self.min_chars:
+                return idx + len(sep)
+        return self.max_chars
+
+
+def split_sentences(text: str, min_chars: int = 20, max_chars: int = 250) -> list:
+    chunker = SentenceChunker(min_chars, max_chars)
+    return chunker.feed(text) + chunker.flush()
+
+
+async def _aiter(items):
+    if hasattr(items, "__aiter__"):
+        async for item in items:
+            yield item
+    else:
+        for item in items:
+            yield item
+
+
+def _cached_frames(pcm, sample_rate: int):
+    """Zero-copy (memoryview, samples) frames over a cached phrase."""
+    view = memoryview(pcm)
+    step = sample_rate // 50 * 2
+    for offset in range(0, len(view), step):
+        frame = view[offset:offset + step]
+        yield frame, len(frame) // 2
+
+
+async def pipelined_synthesis(chunks, voice: str = DEFAULT_VOICE, sample_rate: int = TTS_SAMPLE_RATE, lookahead: int = 1,
+                              cache=None):
+    """
+    Async generator of (pcm_bytes, samples) for a sequence of text chunks, in order.
+    While chunk N is being played, up to `lookahead` following chunks are already synthesizing.
+    `chunks` may be a list or an async iterable that is still being produced.
+    With a PcmCache, cached chunks skip edge-tts and decoding entirely, and fully
+    synthesized chunks are stored for next time.
+    """
+    order = asyncio.Queue()
+    slots = asyncio.Semaphore(lookahead + 1)
+    tasks = []
+
+    async def produce(text: str, queue: asyncio.Queue):
+        collected = None
+        try:
+            cached = cache.get(voice, text, sample_rate) if cache else None
+            if cached is not None:
+                for frame in _cached_frames(cached, sample_rate):
+                    queue.put_nowait(frame)
+                return
+            pcm_parts = [] if cache else None
+            async with aclosing(synthesize_stream(text, voice, sample_rate)) as pcm_stream:
+                async for pcm in pcm_stream:
+                    queue.put_nowait(pcm)
+                    if pcm_parts is not None:
+                        pcm_parts.append(pcm[0])
+            collected = pcm_parts # Only phrases synthesized to the end get stored
+        except Exception as e:
+            logger.error(f"Chunk synthesis failed ({text[:40]!r}): {e}")
+        finally:
+            queue.put_nowait(None)
+        if collected:
+            # After the end marker, so the disk write never delays playback
+            await asyncio.to_thread(cache.put, voice, text, sample_rate, b"".join(collected))
+
+    async def feed():
+        try:
+            async for text in _aiter(chunks):
+                await slots.acquire()
+                queue = asyncio.Queue()
+                tasks.append(asyncio.create_task(produce(text, queue)))
+                order.put_nowait(queue)
+        except Exception as e:
+            logger.error(f"Speech chunk source failed: {e}")
+        finally:
+            order.put_nowait(None)
+
+    feeder = asyncio.create_task(feed())
+    try:
+        while (queue := await order.get()) is not None:
+            while (pcm := await queue.get()) is not None:
+                yield pcm
+            slots.release()
+    finally:
+        # Interrupted or done: stop any synthesis still running ahead
+        feeder.cancel()
+        for task in tasks:
+            task.cancel()
@@ -0,0 +1,227 @@
+import asyncio
+import io
+import logging
+import os
+import time
+from collections import deque
+
+import numpy as np
+from livekit import rtc
+from PIL import Image
+
+logger = logging.getLogger("alan.vision")
+
+# BT.601 limited range (what WebRTC decoders emit) -> full range JFIF, applied to the downscaled planes
+_LUMA_LUT = [min(255, max(0, round((v - 16) * 255 / 219))) for v in range(256)]
+_CHROMA_LUT = [min(255, max(0, round((v - 128) * 255 / 224 + 128))) for v in range(256)]
+SIGNATURE_SIDE = 128  # Long side of the luma thumbnail used for scene-change checks
+
+
+def scene_signature(luma) -> np.ndarray:
+    """Small grayscale thumbnail of a frame: each cell averages ~15x15 px of a 1080p screen."""
+    scale = SIGNATURE_SIDE / max(luma.size)
+    size = (max(1, round(luma.width * scale)), max(1, round(luma.height * scale)))
+    return np.asarray(luma.resize(size, Image.BOX))
+
+
+def scene_changed(a: np.ndarray, b: np.ndarray, pixel_threshold: int = 12, min_cells: int = 2) -> bool:
+    """
+    Downsampled diff: changed if at least `min_cells` thumbnail cells moved by more than
+    `pixel_threshold` levels. Codec noise averages out within a cell; a typed word does not.
+    """
+    if a is None or b is None or a.shape != b.shape:
+        return True
+    diff = np.abs(a.astype(np.int16) - b.astype(np.int16))
+    return int(np.count_nonzero(diff > pixel_threshold)) >= min_cells
+
+
+class VisionSnapshot:
+    """One sampled frame, already downscaled and JPEG-encoded for the model."""
+    __slots__ = ("jpeg", "width", "height", "source_width", "source_height", "captured_at", "convert_ms", "signature")
+
+    def __init__(self, jpeg: bytes, width: int, height: int, source_width: int, source_height: int, convert_ms: float,
+                 signature: np.ndarray = None):
+        self.jpeg = jpeg
+        self.signature = signature
+        self.width = width
+        self.height = height
+        self.source_width = source_width
+        self.source_height = source_height
+        self.captured_at = time.monotonic()
+        self.convert_ms = convert_ms
+
+    @property
+    def age(self) -> float:
+        return time.monotonic() - self.captured_at
+
+
+def target_size(width: int, height: int, max_side: int) -> tuple:
+    scale = min(1.0, max_side / max(width, height))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def _downscale(image, size: tuple):
+    # Integer box reduction first (cheap, anti-aliased), then a small bilinear step to the exact size
+    factor = min(image.width // size[0], image.height // size[1])
+    if factor >= 2:
+        image = image.reduce(factor)
+    return image if image.size == size else image.resize(size, Image.BILINEAR)
+
+
+def encode_frame(frame, max_side: int = 768, quality: int = 80, previous: VisionSnapshot = None) -> VisionSnapshot:
+    """
+    VideoFrame -> downscaled JPEG. I420 frames (the WebRTC default) never go through RGB:
+    the Y/U/V planes are resized separately and saved as a YCbCr JPEG, which is what JPEG
+    stores anyway. Other buffer types go through RGB(A).
+    If the scene matches `previous`, its JPEG is reused instead of encoding a new one.
+    """
+    start = time.perf_counter()
+    width, height = frame.width, frame.height
+    size = target_size(width, height, max_side)
+    data = memoryview(frame.data)
+
+    if frame.type == rtc.VideoBufferType.I420:
+        chroma = ((width + 1) // 2, (height + 1) // 2)
+        luma_bytes, chroma_bytes = width * height, chroma[0] * chroma[1]
+        planes = [
+            Image.frombuffer("L", (width, height), data[:luma_bytes], "raw", "L", 0, 1),
+            Image.frombuffer("L", chroma, data[luma_bytes:luma_bytes + chroma_bytes], "raw", "L", 0, 1),
+            Image.frombuffer("L", chroma, data[luma_bytes + chroma_bytes:luma_bytes + 2 * chroma_bytes], "raw", "L", 0, 1),
+        ]
+        luma = _downscale(planes[0], size)
+        signature = scene_signature(luma)
+        if previous is not None and not scene_changed(signature, previous.signature):
+            return _unchanged(previous, start)
+        chroma_planes = [_downscale(plane, size).point(_CHROMA_LUT) for plane in planes[1:]]
+        image = Image.merge("YCbCr", [luma.point(_LUMA_LUT)] + chroma_planes)
+    else:
+        if frame.type == rtc.VideoBufferType.RGB24:
+            mode, pixels = "RGB", frame
+        else:
+            mode, pixels = "RGBA", frame if frame.type == rtc.VideoBufferType.RGBA else frame.convert(rtc.VideoBufferType.RGBA)
+        image = Image.frombuffer(mode, (width, height), memoryview(pixels.data), "raw", mode, 0, 1)
+        image = _downscale(image, size).convert("RGB")
+        signature = scene_signature(image.convert("L"))
+        if previous is not None and not scene_changed(signature, previous.signature):
+            return _unchanged(previous, start)
+
+    out = io.BytesIO()
+    image.save(out, format="JPEG", quality=quality)
+    return VisionSnapshot(out.getvalue(), size[0], size[1], width, height, (time.perf_counter() - start) * 1000,
+                          signature)
+
+
+def _unchanged(previous: VisionSnapshot, start: float) -> VisionSnapshot:
+    # Same JPEG and signature as before, but a fresh capture time
+    return VisionSnapshot(previous.jpeg, previous.width, previous.height, previous.source_width,
+                          previous.source_height, (time.perf_counter() - start) * 1000, previous.signature)
+
+
+class VisionFrameService:
+    """
+    Keeps recent, model-ready snapshots of the session's video tracks.
+    - Each track is read through a VideoStream with capacity 1: frames that arrive while we
+      aren't sampling just replace each other and are never converted.
+    - Every `interval` seconds the newest frame is downscaled and JPEG-encoded off the loop
+      into a small ring, so take() hands one over instantly when the user says "look".
+      A sample whose scene matches the previous one reuses its JPEG.
+    - The last image sent to the brain is remembered together with the handle it was sent
+      as (Gemini Files API); while the screen stays the same (and within `reuse_window`
+      seconds), later turns attach that handle instead of uploading the image again.
+    """
+    def __init__(self, interval: float = 2.0, max_side: int = 768, quality: int = 80, ring_size: int = 3,
+                 reuse_window: float = 300.0):
+        self.interval = interval
+        self.max_side = max_side
+        self.quality = quality
+        self.reuse_window = reuse_window
+        self._ring = deque(maxlen=ring_size)
+        self._convert_ms = deque(maxlen=200)
+        self._sent = None    # Last snapshot sent to the brain
+        self._handle = None  # Reference to its uploaded copy (e.g. a genai file Part), None if sent inline
+        self.counters = {"sampled": 0, "unchanged_samples": 0, "failed": 0, "sent": 0, "sent_inline": 0,
+                         "reused": 0, "upload_bytes": 0, "upload_bytes_saved": 0, "raw_rgb_bytes": 0}
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            interval=float(os.getenv("ALAN_VISION_INTERVAL", 2.0)),
+            max_side=int(os.getenv("ALAN_VISION_MAX_SIDE", 768)),
+            quality=int(os.getenv("ALAN_VISION_JPEG_QUALITY", 80)),
+            reuse_window=float(os.getenv("ALAN_VISION_REUSE_WINDOW", 300.0)),
+        )
+
+    async def run(self, track):
+        """Samples `track` until it ends."""
+        stream = rtc.VideoStream(track, capacity=1)
+        try:
+            while True:
+                try:
+                    event = await stream.__anext__()
+                except StopAsyncIteration:
+                    break
+                await self.add_frame(event.frame)
+                await asyncio.sleep(self.interval)
+        finally:
+            await stream.aclose()
+
+    async def add_frame(self, frame):
+        previous = self._ring[-1] if self._ring else None
+        try:
+            snapshot = await asyncio.to_thread(encode_frame, frame, self.max_side, self.quality, previous)
+        except Exception as e:
+            self.counters["failed"] += 1
+            logger.error(f"Frame conversion failed: {e}")
+            return
+        self.counters["sampled"] += 1
+        if previous is not None and snapshot.jpeg is previous.jpeg:
+            self.counters["unchanged_samples"] += 1
+        self._convert_ms.append(snapshot.convert_ms)
+        self._ring.append(snapshot)
+
+    def take(self, max_age: float = None):
+        """Newest snapshot (or None if there is none, or it's older than `max_age` seconds)."""
+        if not self._ring:
+            return None
+        snapshot = self._ring[-1]
+        if max_age is not None and snapshot.age > max_age:
+            return None
+        return snapshot
+
+    def prior_upload(self, snapshot: VisionSnapshot):
+        """Handle to the last image sent, if `snapshot` shows the same scene; else None."""
+        if self._sent is None or self._handle is None:
+            return None
+        if time.monotonic() - self._sent.captured_at > self.reuse_window:
+            return None
+        if scene_changed(snapshot.signature, self._sent.signature):
+            return None
+        self.counters["reused"] += 1
+        self.counters["upload_bytes_saved"] += len(snapshot.jpeg)
+        return self._handle
+
+    def mark_sent(self, snapshot: VisionSnapshot, handle=None):
+        """
+        Records `snapshot` as the image the brain now sees, with the handle it was uploaded as.
+        Without a handle (the upload failed, bytes went inline) later turns can't reuse it.
+        """
+        self._sent, self._handle = snapshot, handle
+        self.counters["sent"] += 1
+        if handle is None:
+            self.counters["sent_inline"] += 1
+        # Either way the JPEG crosses the wire once
+        self.counters["upload_bytes"] += len(snapshot.jpeg)
+        # What the old path shipped: a full-resolution RGB image
+        self.counters["raw_rgb_bytes"] += snapshot.source_width * snapshot.source_height * 3
+
+    def stats(self) -> dict:
+        stats = dict(self.counters)
+        if self._convert_ms:
+            ordered = sorted(self._convert_ms)
+            stats["convert_ms_avg"] = round(sum(ordered) / len(ordered), 2)
+            stats["convert_ms_p95"] = round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 2)
+        if self._ring:
+            latest = self._ring[-1]
+            stats["jpeg_bytes"] = len(latest.jpeg)
+            stats["size"] = f"{latest.source_width}x{latest.source_height} -> {latest.width}x{latest.height}"
+        return stats
@@ -18,6 +18,7 @@ import { ChatInput } from './ChatInput';
 import { IntroOverlay } from './IntroOverlay';
 
 type Message = {
+    id?: string;
     role: 'user' | 'agent';
     text: string;
     timestamp: number;
@@ -62,8 +63,28 @@ export function ALANInterface() {
             const str = decoder.decode(payload);
             try {
                 const data = JSON.parse(str);
-                if (data.type === 'agent_chat') {
-                    setMessages(prev => [...prev, { role: 'agent', text: data.text, timestamp: Date.now() }]);
+                if (data.type === 'agent_chat_delta') {
+                    // Streaming reply: grow the message with this id as tokens arrive
+                    setMessages(prev => {
+                        const idx = prev.findIndex(m => m.id === data.id);
+                        if (idx === -1) {
+                            return [...prev, { id: data.id, role: 'agent', text: data.text, timestamp: Date.now() }];
+                        }
+                        const next = [...prev];
+                        next[idx] = { ...next[idx], text: next[idx].text + data.text };
+                        return next;
+                    });
+                } else if (data.type === 'agent_chat') {
+                    // Final text replaces the streamed deltas for the same reply
+                    setMessages(prev => {
+                        const idx = data.id ? prev.findIndex(m => m.id === data.id) : -1;
+                        if (idx === -1) {
+                            return [...prev, { id: data.id, role: 'agent', text: data.text, timestamp: Date.now() }];
+                        }
+                        const next = [...prev];
+                        next[idx] = { ...next[idx], text: data.text };
+                        return next;
+                    });
                     addLog("RECEIVED ENCRYPTED PAYLOAD");
                 }
             } catch (e) {